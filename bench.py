@@ -0,0 +1,286 @@
+import argparse
+import itertools
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from functools import partial
+from types import SimpleNamespace
+
+import cotabot
+import fake_redis
+
+# Micro-benchmarks for cotabot internals, run without any Telegram access:
+#
+#   python bench.py render
+#   python bench.py model
+#   python bench.py replay --workload taps --chats 50 --participants 300 --threads 8
+#   python bench.py replay --store redis
+
+def fake_user(user_id):
+    return SimpleNamespace(id=user_id, first_name='User{}'.format(user_id),
+                           last_name='Last' if user_id % 2 else None, username=None)
+
+def make_chat(n_participants, n_cotas=1):
+    cota_chat = cotabot.CotaChat(1)
+    for cota_id in range(n_cotas):
+        cota = cotabot.Cota(cota_id, 0, name='Cota {}'.format(cota_id), value=10.0)
+        for user_id in range(n_participants):
+            user = fake_user(user_id)
+            cota.add_participant(user, cota_chat.user_name(user))
+        cota.check_aggregates()
+        cota_chat.active_cotas[cota_id] = cota
+    cota_chat.next_cota_id = n_cotas
+    return cota_chat
+
+def timeit(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+def bench_render(args):
+    print('{:>12} {:>14} {:>14} {:>14}'.format('participants', 'cold (us)', 'warm (us)', 'after +1 (us)'))
+    for n in args.sizes:
+        cota_chat = make_chat(n)
+        cota = cota_chat.active_cotas[0]
+        state = cotabot.CotaViewState(cotabot.InteractiveBox(cota_chat), cota)
+
+        def cold():
+            cota.touch()
+            for participant in cota.going.values():
+                participant.rendered = None
+            state.render()
+
+        def mutated():
+            # What a +1 tap costs: only the touched participant is re-formatted
+            cota.add_participant(fake_user(0))
+            state.render()
+
+        print('{:>12} {:>14.1f} {:>14.1f} {:>14.1f}'.format(
+            n, timeit(cold, args.repeat) * 1e6, timeit(state.render, args.repeat) * 1e6,
+            timeit(mutated, args.repeat) * 1e6))
+
+def bench_model(args):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    cota_chat = make_chat(args.participants, args.cotas)
+    after = tracemalloc.take_snapshot()
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    tracemalloc.stop()
+
+    snapshot, _ = cota_chat.snapshot()
+    n = args.participants * args.cotas
+    print('participations:        {}'.format(n))
+    print('memory:                {:.1f} bytes/participation'.format(size / n))
+    print('snapshot:              {} bytes'.format(len(snapshot)))
+    print('encode / decode:       {:.1f} / {:.1f} ms'.format(
+        timeit(cota_chat.snapshot, 10) * 1000,
+        timeit(lambda: cotabot.CotaChat.from_dict(cotabot.json.loads(snapshot)), 10) * 1000))
+
+class RecordingBot:
+    """Stands in for telegram.Bot, counting calls and optionally adding latency."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.message_ids = itertools.count(1)
+        self.calls = Counter()
+
+    def record(self, method):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.calls[method] += 1
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.record('send_message')
+        return SimpleNamespace(message_id=next(self.message_ids), chat_id=chat_id, text=text)
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self.record('edit_message_text')
+        return True
+
+    def delete_message(self, chat_id, message_id, **kwargs):
+        self.record('delete_message')
+        return True
+
+    def send_chat_action(self, chat_id, action, **kwargs):
+        self.record('send_chat_action')
+        return True
+
+def fake_update(chat_id, user_id, text=None, data=None, message_id=None):
+    user = fake_user(user_id)
+    chat = SimpleNamespace(id=chat_id)
+    message = SimpleNamespace(chat_id=chat_id, message_id=message_id, text=text)
+    query = SimpleNamespace(data=data, message=message, from_user=user) if data else None
+    return SimpleNamespace(effective_chat=chat, effective_user=user, effective_message=message,
+                           message=None if data else message, callback_query=query)
+
+def press(chat_id, user_id, message_id, handler, *ids):
+    data = cotabot.callback_data(handler, *ids)
+    cotabot.callback_handler(None, fake_update(chat_id, user_id, data=data, message_id=message_id))
+
+def say(chat_id, user_id, text):
+    cotabot.handle_message(None, fake_update(chat_id, user_id, text=text))
+
+def newest_box(chat_id):
+    return list(cotabot.cota_chats.get(chat_id).iBoxes)[-1]
+
+def settle():
+    # Wait for debounced renders, queued API calls and pending writes
+    while True:
+        time.sleep(cotabot.RENDER_DEBOUNCE + 0.1)
+        if not cotabot.outbox.depth() and not cotabot.outbox.busy and not cotabot.flusher.backlog() \
+                and not any(c.render_timer for c in cotabot.cota_chats.values()):
+            return
+
+def prepare_chat(chat_id, args):
+    """A chat with one cota of args.participants and args.boxes boxes showing it."""
+    cota_chat = make_chat(args.participants)
+    cota_chat._id = chat_id
+    cotabot.store.save(cota_chat)
+    for _ in range(args.boxes):
+        cotabot.cotas(None, fake_update(chat_id, 0, text='/cotas'))
+        press(chat_id, 0, newest_box(chat_id), cotabot.open_cota_view, 0)
+    for i in range(args.history):
+        cota = cotabot.Cota(1000 + i, i % 3, name='Antiga {}'.format(i), value=10.0)
+        for user_id in range(20):
+            cota.add_participant(fake_user(user_id))
+        cota.closed_at = time.time() - i
+        cotabot.store.archive_cota(cotabot.cota_chats.get(chat_id), cota)
+
+def taps_workload(chat_id, args, rnd):
+    message_id = newest_box(chat_id)
+    for _ in range(args.ops):
+        user_id = rnd.randrange(args.participants * 2)
+        yield 'tap', partial(press, chat_id, user_id, message_id, cotabot.new_participant, 0)
+
+def history_workload(chat_id, args, rnd):
+    message_id = newest_box(chat_id)
+    yield 'open', partial(press, chat_id, 0, message_id, cotabot.open_history)
+    for i in range(args.ops - 1):
+        # Four pages forward, four back
+        handler = cotabot.history_next_page if (i // 4) % 2 == 0 else cotabot.history_prev_page
+        yield 'page', partial(press, chat_id, 0, message_id, handler)
+
+def press_newest(chat_id, user_id, handler):
+    press(chat_id, user_id, newest_box(chat_id), handler)
+
+def create_workload(chat_id, args, rnd):
+    for i in range(args.ops // 5):
+        creator = 10000 + i
+        yield 'cotas', partial(cotabot.cotas, None, fake_update(chat_id, creator, text='/cotas'))
+        yield 'new', partial(press_newest, chat_id, creator, cotabot.new_cota)
+        yield 'type', partial(press_newest, chat_id, creator, cotabot.create_vaquinha)
+        yield 'name', partial(say, chat_id, creator, 'Cota {}'.format(i))
+        yield 'value', partial(say, chat_id, creator, '12,50')
+
+WORKLOADS = {'taps': taps_workload, 'history': history_workload, 'create': create_workload}
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+def bench_replay(args):
+    """Replays a workload through the real handlers, outbox and store against a RecordingBot."""
+    workdir = tempfile.mkdtemp(prefix='cotabot-bench-')
+    cotabot.DB_FILE = os.path.join(workdir, 'bench.sqlite')
+    cotabot.LEGACY_DB_FILE = os.path.join(workdir, 'none.pickle')
+    cotabot.STORE = args.store
+    if args.store == 'redis':
+        server = fake_redis.FakeRedisServer(('127.0.0.1', 0))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        cotabot.REDIS_URL = 'redis://127.0.0.1:{}'.format(server.server_address[1])
+    # Measure the bot, not Telegram's limits
+    cotabot.CHAT_RATE = cotabot.CHAT_BURST = cotabot.GLOBAL_RATE = 1e9
+    bot = RecordingBot(args.latency)
+    cotabot.load_state()
+    cotabot.start_services(bot)
+
+    chats = range(1, args.chats + 1)
+    for chat_id in chats:
+        prepare_chat(chat_id, args)
+    settle()
+    heads_before = sum(cotabot.cota_chats.get(c).active_cotas[0].heads for c in chats)
+    calls_before = Counter(bot.calls)
+    written_before = cotabot.flusher.stats['chats_written']
+
+    per_chat = {chat_id: list(WORKLOADS[args.workload](chat_id, args, random.Random(args.seed * 1000003 + chat_id)))
+                for chat_id in chats}
+    samples = {}
+    lock = threading.Lock()
+
+    def run(chat_ids):
+        for chat_id in chat_ids:
+            for kind, step in per_chat[chat_id]:
+                start = time.perf_counter()
+                step()
+                elapsed = time.perf_counter() - start
+                with lock:
+                    samples.setdefault(kind, []).append(elapsed)
+
+    threads = [threading.Thread(target=run, args=(list(chats)[i::args.threads],)) for i in range(args.threads)]
+    start = time.perf_counter()
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    elapsed = time.perf_counter() - start
+    settle()
+
+    ops = sum(len(v) for v in samples.values())
+    calls = bot.calls - calls_before
+    print('workload:     {} ({} chats, {} threads, {} store)'.format(args.workload, args.chats, args.threads,
+                                                                     args.store))
+    print('ops:          {} in {:.2f} s, {:.0f} ops/s'.format(ops, elapsed, ops / elapsed))
+    for kind, values in samples.items():
+        print('  {:<10} p50 {:.2f} ms, p99 {:.2f} ms'.format(kind, percentile(values, 0.5) * 1000,
+                                                           percentile(values, 0.99) * 1000))
+    print('api calls/op: {:.2f} {}'.format(sum(calls.values()) / ops,
+                                          {m: round(n / ops, 2) for m, n in calls.items()}))
+    print('writes/op:    {:.2f} chats'.format((cotabot.flusher.stats['chats_written'] - written_before) / ops))
+    if args.workload == 'taps':
+        heads = sum(cotabot.cota_chats.get(c).active_cotas[0].heads for c in chats)
+        expected = heads_before + ops
+        print('consistency:  {} heads, expected {} {}'.format(heads, expected, 'ok' if heads == expected else 'MISMATCH'))
+
+    cotabot.stop_services()
+    cotabot.close_state()
+
+def main():
+    parser = argparse.ArgumentParser(description='CotaBot micro-benchmarks')
+    sub = parser.add_subparsers(dest='command', required=True)
+    render = sub.add_parser('render', help='CotaViewState render time against participant count')
+    render.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 5000])
+    render.add_argument('--repeat', type=int, default=200)
+    model = sub.add_parser('model', help='memory and snapshot size of a chat')
+    model.add_argument('--participants', type=int, default=1000)
+    model.add_argument('--cotas', type=int, default=10)
+    replay = sub.add_parser('replay', help='throughput and API calls per update through the real handlers')
+    replay.add_argument('--workload', choices=sorted(WORKLOADS), default='taps')
+    replay.add_argument('--chats', type=int, default=20)
+    replay.add_argument('--participants', type=int, default=200, help='participants of each chat\'s cota')
+    replay.add_argument('--boxes', type=int, default=3, help='boxes showing the cota in each chat')
+    replay.add_argument('--history', type=int, default=50, help='closed cotas in each chat')
+    replay.add_argument('--ops', type=int, default=100, help='updates per chat')
+    replay.add_argument('--threads', type=int, default=4)
+    replay.add_argument('--latency', type=float, default=0.0, help='seconds added to every API call')
+    replay.add_argument('--seed', type=int, default=1)
+    replay.add_argument('--store', choices=('sqlite', 'file', 'redis'), default='sqlite',
+                        help='backend, redis runs against an in-process fake_redis server')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    if args.command == 'render':
+        bench_render(args)
+    elif args.command == 'model':
+        bench_model(args)
+    elif args.command == 'replay':
+        bench_replay(args)
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,40 @@
 import logging
+import os
 import pickle
+import hmac
+import secrets
+import sqlite3
+import argparse
+import asyncio
+import glob
+import multiprocessing
+import signal
+import socket
+import heapq
+import json
+import re
+import sys
 import time
-from threading import Thread
-from functools import wraps
+import unicodedata
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from threading import Thread, Lock, RLock, Condition, get_ident
+from functools import lru_cache, partial, wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count, islice
+from queue import Empty
+from urllib.parse import urlsplit
 
 from telegram import utils
 from telegram import (ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton,
-                      ReplyKeyboardRemove, InlineKeyboardMarkup,
-                      ChatAction, ParseMode)
+                      ReplyKeyboardRemove, InlineKeyboardMarkup, InlineQueryResultArticle,
+                      InputTextMessageContent,
+                      ChatAction, MessageEntity, ParseMode, Update)
+from telegram.error import BadRequest, NetworkError, RetryAfter
 from telegram.ext import (Updater, CommandHandler, CallbackQueryHandler,
-                          MessageHandler, Filters, 
+                          MessageHandler, InlineQueryHandler, Filters, TypeHandler,
                           RegexHandler, ConversationHandler)
 
 VERSION = '1.0.1'
@@ -25,34 +50,821 @@ VAQUINHA = 'V'
 COM_OBJETIVO = 'O'
 # ------------------
 
-def send_typing_action(func):
-    
-    @wraps(func)
-    def command_func(bot, update, *args, **kwargs):
-        bot.send_chat_action(chat_id=update.effective_message.chat_id, action=ChatAction.TYPING)
-        return func(bot, update, *args, **kwargs)
-        
-    return command_func
+# Box updates arriving within this window are merged into one edit
+RENDER_DEBOUNCE = 0.5
+# Scheduled renders of a chat busy with a handler are tried again this much later
+RENDER_RETRY = 0.05
+
+HISTORY_PAGE_SIZE = 5
+# How far back the 'Recentes' filter of the history goes
+HISTORY_RECENT_DAYS = 30
+MAIN_LIST_PAGE_SIZE = 8
+
+# Seats added by the +N button, and the most one mention of /cota can add
+BULK_STEP = 5
+BULK_MAX_SEATS = 50
+
+# Inline queries: results per answer, seconds Telegram may reuse an answer,
+# and closed cotas of each chat that can be found
+INLINE_RESULTS = 20
+INLINE_CACHE_TIME = 30
+INLINE_HISTORY = 500
+
+# Transfers listed by /saldo
+SETTLEMENT_LINES = 30
+
+# Metrics ----
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One count per bucket plus +Inf, not cumulative
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in labels) + '}'
+
+class Metrics:
+    """Counters and histograms, plus collectors read at scrape time.
+
+    Collectors return (name, type, labels, value) tuples for numbers that
+    other parts of the bot already keep, like queue depths or stats dicts.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def collector(self, func):
+        self.collectors.append(func)
+        return func
+
+    def samples(self):
+        with self.lock:
+            samples = [(name, 'counter', labels, value) for (name, labels), value in self.counters.items()]
+            histograms = [(name, labels, h.buckets, list(h.counts), h.sum)
+                          for (name, labels), h in self.histograms.items()]
+        for func in self.collectors:
+            try:
+                samples.extend((name, kind, tuple(sorted(labels.items())), value)
+                               for name, kind, labels, value in func())
+            except Exception:
+                logger.exception('Metrics collector %s failed', func.__name__)
+        return samples, histograms
+
+    def render(self):
+        samples, histograms = self.samples()
+        lines = []
+        typed = set()
+        for name, kind, labels, value in sorted(samples, key=lambda s: (s[0], s[2])):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} {}'.format(name, kind))
+            lines.append('{}{} {}'.format(name, format_labels(labels), value))
+        for name, labels, buckets, counts, total in sorted(histograms, key=lambda h: (h[0], h[1])):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} histogram'.format(name))
+            cumulative = 0
+            for le, n in zip(buckets + ('+Inf',), counts):
+                cumulative += n
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', le),)), cumulative))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels), total))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels), cumulative))
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+# Outbound limits, roughly Telegram's documented ones
+CHAT_RATE = 1.0
+CHAT_BURST = 3
+GLOBAL_RATE = 30.0
+OUTBOX_WORKERS = 4
+MAX_RETRIES = 5
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+
+    def delay(self, now):
+        # Seconds until a token is available
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def full(self, now):
+        self.delay(now)
+        return self.tokens >= self.capacity
+
+# Result of a queued call that was dropped, replaced by a newer edit of the
+# same message or made pointless by its deletion. Nothing was sent.
+SUPERSEDED = object()
+
+class OutboxJob:
+    def __init__(self, method, chat_id, args, kwargs, key=None):
+        self.method = method
+        self.chat_id = chat_id
+        self.args = args
+        self.kwargs = kwargs
+        self.key = key
+        self.future = Future()
+        self.attempts = 0
+        self.not_before = 0
+        # Jobs in one queue are sent in order; those of a chat share its bucket
+        self.queue = chat_id
+        self.chat_limited = True
+
+class Outbox:
+    """Bot stand-in that queues every call behind per-chat and global rate limits.
+
+    Calls to the same chat are sent in order, one at a time. A queued edit
+    of a message is replaced by a newer edit of the same message, and is
+    dropped if the message gets deleted before it is sent.
+    """
+
+    def __init__(self, bot, workers=OUTBOX_WORKERS):
+        self.bot = bot
+        self.cond = Condition()
+        self.queues = {}
+        self.edits = {}
+        self.busy = set()
+        self.chat_buckets = {}
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+        self.swept = time.monotonic()
+        self.running = True
+        self.stats = {'sent': 0, 'merged': 0, 'retried': 0, 'failed': 0}
+        self.threads = [Thread(target=self.run, name='outbox-{}'.format(i), daemon=True)
+                        for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self.post_message(chat_id, text, **kwargs).result()
+
+    def post_message(self, chat_id, text, **kwargs):
+        # Like send_message, without waiting for the sent message
+        return self.submit(OutboxJob('send_message', chat_id, (chat_id, text), kwargs))
+
+    def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        kwargs.update(chat_id=chat_id, message_id=message_id)
+        return self.submit(OutboxJob('edit_message_text', chat_id, (text,), kwargs,
+                                     key=(chat_id, message_id)))
+
+    def delete_message(self, chat_id, message_id):
+        return self.submit(OutboxJob('delete_message', chat_id, (chat_id, message_id), {}))
+
+    def send_chat_action(self, chat_id, action):
+        return self.submit(OutboxJob('send_chat_action', chat_id, (), {'chat_id': chat_id, 'action': action}))
+
+    def answer_inline_query(self, inline_query_id, results, user_id, **kwargs):
+        # Not a message to the user's chat: answers get their own queue and
+        # only the global limit. A pending answer is replaced by the answer to
+        # the user's newer query, as the older one is no longer shown.
+        job = OutboxJob('answer_inline_query', user_id, (inline_query_id, results), kwargs,
+                        key=('inline', user_id))
+        job.queue = job.key
+        job.chat_limited = False
+        return self.submit(job)
+
+    def depth(self):
+        with self.cond:
+            return sum(len(queue) for queue in self.queues.values())
+
+    def submit(self, job):
+        with self.cond:
+            if job.key:
+                pending = self.edits.get(job.key)
+                if pending:
+                    # The queued job sends the newest content, for the newest caller
+                    superseded, pending.future = pending.future, job.future
+                    pending.args, pending.kwargs = job.args, job.kwargs
+                    self.stats['merged'] += 1
+                    superseded.set_result(SUPERSEDED)
+                    return job.future
+                self.edits[job.key] = job
+            elif job.method == 'delete_message':
+                # Edits of a message about to be deleted are pointless
+                pending = self.edits.pop(job.args, None)
+                if pending:
+                    self.queues[job.queue].remove(pending)
+                    pending.future.set_result(SUPERSEDED)
+                    self.stats['merged'] += 1
+            self.queues.setdefault(job.queue, deque()).append(job)
+            self.cond.notify()
+        return job.future
+
+    def next_job(self):
+        while True:
+            now = time.monotonic()
+            wait = None
+            for queue_id, queue in self.queues.items():
+                if queue_id in self.busy:
+                    continue
+                job = queue[0]
+                bucket = None
+                if job.chat_limited:
+                    bucket = self.chat_buckets.get(job.chat_id)
+                    if not bucket:
+                        bucket = self.chat_buckets[job.chat_id] = TokenBucket(CHAT_RATE, CHAT_BURST)
+                delay = max(job.not_before - now, bucket.delay(now) if bucket else 0, self.global_bucket.delay(now))
+                if delay <= 0:
+                    queue.popleft()
+                    if not queue:
+                        del self.queues[queue_id]
+                    if job.key and self.edits.get(job.key) is job:
+                        del self.edits[job.key]
+                    if bucket:
+                        bucket.take()
+                    self.global_bucket.take()
+                    self.busy.add(queue_id)
+                    return job
+                wait = delay if wait is None else min(wait, delay)
+            if not self.running and not self.queues:
+                return None
+            self.cond.wait(wait)
+
+    def run(self):
+        while True:
+            with self.cond:
+                job = self.next_job()
+            if job is None:
+                return
+            self.execute(job)
+            with self.cond:
+                self.busy.discard(job.queue)
+                self.sweep_buckets()
+                self.cond.notify_all()
+
+    def sweep_buckets(self):
+        # Buckets of idle chats that refilled completely are the same as new ones
+        now = time.monotonic()
+        if now - self.swept < 1.0:
+            return
+        self.swept = now
+        for chat_id, bucket in list(self.chat_buckets.items()):
+            if chat_id not in self.queues and chat_id not in self.busy and bucket.full(now):
+                del self.chat_buckets[chat_id]
+
+    def call(self, job):
+        start = time.perf_counter()
+        try:
+            return getattr(self.bot, job.method)(*job.args, **job.kwargs)
+        finally:
+            metrics.observe('cotabot_api_seconds', time.perf_counter() - start, method=job.method)
+
+    def execute(self, job):
+        try:
+            result = self.call(job)
+        except RetryAfter as e:
+            self.retry(job, e.retry_after)
+        except BadRequest as e:
+            if 'not modified' in e.message.lower():
+                job.future.set_result(True)
+            else:
+                self.fail(job, e)
+        except NetworkError as e:
+            # A timed out send may have been delivered, so only idempotent calls are retried
+            if job.method != 'send_message' and job.attempts < MAX_RETRIES:
+                self.retry(job, 0.5 * 2 ** job.attempts)
+            else:
+                self.fail(job, e)
+        except Exception as e:
+            self.fail(job, e)
+        else:
+            self.stats['sent'] += 1
+            job.future.set_result(result)
+
+    def retry(self, job, delay):
+        job.attempts += 1
+        job.not_before = time.monotonic() + delay
+        self.stats['retried'] += 1
+        with self.cond:
+            if job.key:
+                if job.key in self.edits:
+                    # A newer edit of the same message is already queued
+                    job.future.set_result(SUPERSEDED)
+                    return
+                self.edits[job.key] = job
+            self.queues.setdefault(job.queue, deque()).appendleft(job)
+
+    def fail(self, job, e):
+        logger.warning('%s on chat %d failed: %s', job.method, job.chat_id, e)
+        self.stats['failed'] += 1
+        metrics.inc('cotabot_api_failures_total', method=job.method, error=type(e).__name__)
+        job.future.set_exception(e)
+
+    def stop(self, timeout=10):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join(timeout)
+
+class Scheduler:
+    """Runs delayed calls from a single thread, ordered by a heap of due times."""
+
+    def __init__(self):
+        self.heap = []
+        self.counter = count()
+        self.cond = Condition()
+        self.running = True
+        self.thread = Thread(target=self.run, name='scheduler', daemon=True)
+        self.thread.start()
+
+    def call_later(self, delay, func, *args):
+        return self.call_at(time.time() + delay, func, *args)
+
+    def call_at(self, when, func, *args):
+        entry = [when, next(self.counter), func, args]
+        with self.cond:
+            heapq.heappush(self.heap, entry)
+            self.cond.notify()
+        return entry
+
+    def cancel(self, entry):
+        # Cancelled entries stay in the heap and are skipped when due
+        entry[2] = None
+
+    def pending(self):
+        with self.cond:
+            return len(self.heap)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running and (not self.heap or self.heap[0][0] > time.time()):
+                    self.cond.wait(self.heap[0][0] - time.time() if self.heap else None)
+                if not self.running:
+                    return
+                now = time.time()
+                due = []
+                while self.heap and self.heap[0][0] <= now:
+                    due.append(heapq.heappop(self.heap))
+            for _, _, func, args in due:
+                if func is None:
+                    continue
+                try:
+                    func(*args)
+                except Exception:
+                    logger.exception('Scheduled call %s failed', func.__name__)
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join()
+
+scheduler = None
+
+# Timers of every chat share the timers table. Each kind of them has a single
+# scheduler entry, due at the earliest of them, that reads every due timer
+wakeups = {}
+wakeups_lock = Lock()
+
+def wake_at(due, func):
+    # Moved only when the new due time is earlier
+    with wakeups_lock:
+        entry = wakeups.get(func)
+        if entry and entry[2] and entry[0] <= due:
+            return
+        if entry:
+            scheduler.cancel(entry)
+        wakeups[func] = scheduler.call_at(due, woken, func)
+
+def woken(func):
+    with wakeups_lock:
+        wakeups.pop(func, None)
+    func()
+
+QUICK_MESSAGE_TTL = 10
+
+def schedule_deletion(chat_id, message_id, delay=QUICK_MESSAGE_TTL):
+    # Persisted so the message still gets deleted if the bot restarts meanwhile
+    due = time.time() + delay
+    store.add_timer(due, chat_id, 'delete_message', str(message_id))
+    wake_at(due, delete_expired_messages)
+
+def delete_expired_messages():
+    for chat_id, message_id in store.pop_due_timers('delete_message', time.time()):
+        outbox.delete_message(chat_id, int(message_id))
+    due = store.next_timer_due('delete_message')
+    if due:
+        wake_at(due, delete_expired_messages)
+
+COTA_TIMERS = ('deadline', 'reminder')
+TIMER_KINDS = ('delete_message',) + COTA_TIMERS
+# Timers of a chat that could not be handled are tried again this much later
+TIMER_RETRY = 30
+
+def schedule_cota_timer(chat_id, kind, cota_id, due):
+    # The due time goes along, a timer no longer matching its cota was replaced
+    store.add_timer(due, chat_id, kind, '{}:{!r}'.format(cota_id, due))
+    wake_cota_timers(due)
+
+def wake_cota_timers(due):
+    # Deadlines and reminders share their entry
+    wake_at(due, fire_cota_timers)
+
+def fire_cota_timers():
+    # Everything due in one go, handled one chat at a time. Timers are only
+    # removed once handled, those of busy chats come back soon and the
+    # failed ones a bit later.
+    fired = defaultdict(list)
+    now = time.time()
+    for kind in COTA_TIMERS:
+        for timer in store.claim_timers(kind, store.due_timers(kind, now)):
+            fired[timer[1]].append((kind, timer))
+    for chat_id, timers in fired.items():
+        retry = None
+        try:
+            if not handle_cota_timers(chat_id, [(kind, payload) for kind, (_, _, payload) in timers]):
+                retry = RENDER_RETRY
+        except Exception:
+            logger.exception('Timers of chat %d failed, trying again in %ds', chat_id, TIMER_RETRY)
+            retry = TIMER_RETRY
+        if retry:
+            for kind, (_, _, payload) in timers:
+                store.add_timer(time.time() + retry, chat_id, kind, payload)
+        for kind in COTA_TIMERS:
+            store.remove_timers(kind, [timer for k, timer in timers if k == kind])
+        if retry != RENDER_RETRY:
+            for kind, _ in timers:
+                metrics.inc('cotabot_timers_fired_total', kind=kind)
+    due = [d for d in (store.next_timer_due(kind) for kind in COTA_TIMERS) if d]
+    if due:
+        wake_cota_timers(min(due))
+
+def handle_cota_timers(chat_id, timers):
+    # On the scheduler thread, which must not wait for a busy chat. False
+    # when the chat is in use, nothing was done then.
+    fired = []
+    for kind, payload in timers:
+        cota_id, due = payload.split(':')
+        fired.append((kind, int(cota_id), float(due)))
+    cota_chat = locked_chat(chat_id, blocking=False)
+    if cota_chat is None:
+        return False
+    try:
+        cota_chat.on_timers(outbox, fired)
+    finally:
+        cota_chat.lock.release()
+    return True
+
+outbox = None
+
+@metrics.collector
+def outbox_metrics():
+    if outbox is None:
+        return []
+    return [('cotabot_outbox_queued', 'gauge', {}, outbox.depth()),
+            ('cotabot_scheduler_pending', 'gauge', {}, scheduler.pending())] + \
+           [('cotabot_outbox_jobs_total', 'counter', {'result': k}, v) for k, v in outbox.stats.items()]
+
+# Handler middleware ----
+
+# "typing..." is only shown when a handler takes longer than this
+TYPING_DELAY = 0.5
+# Commands a user may send per second before they are dropped, off unless
+# given with --user-rate. Text input and buttons are never dropped.
+USER_RATE = None
+USER_BURST = 10
+# Handlers slower than this are logged
+SLOW_HANDLER = 1.0
+
+middleware_stats = {'typing_sent': 0, 'typing_skipped': 0, 'throttled': 0}
+
+class HandlerContext:
+    def __init__(self, name, bot, update):
+        self.name = name
+        self.bot = bot
+        self.update = update
+        self.chat_id = update.effective_chat.id if update.effective_chat else None
+        self.user_id = update.effective_user.id if update.effective_user else None
+        self.error = None
+
+class Middleware:
+    """Runs around handlers.
+
+    before() returning False drops the update. after() runs for every
+    middleware whose before() ran, also when the handler raised.
+    """
+
+    def before(self, ctx):
+        return True
+
+    def after(self, ctx):
+        pass
+
+class HandlerChain:
+    """Decorator running a handler inside a list of middlewares, first one outermost."""
+
+    def __init__(self, *middlewares):
+        self.middlewares = middlewares
+
+    def __call__(self, handler):
+
+        @wraps(handler)
+        def command_func(bot, update, *args, **kwargs):
+            ctx = HandlerContext(handler.__name__, bot, update)
+            entered = []
+            try:
+                for middleware in self.middlewares:
+                    if middleware.before(ctx) is False:
+                        return None
+                    entered.append(middleware)
+                return handler(ctx.bot, update, *args, **kwargs)
+            except Exception as e:
+                ctx.error = e
+                raise
+            finally:
+                for middleware in reversed(entered):
+                    middleware.after(ctx)
+
+        return command_func
+
+class UseOutbox(Middleware):
+    # Handlers talk to the outbox instead of the bot
+    def before(self, ctx):
+        ctx.bot = outbox
+
+class Timed(Middleware):
+    def before(self, ctx):
+        ctx.started = time.perf_counter()
+
+    def after(self, ctx):
+        elapsed = time.perf_counter() - ctx.started
+        metrics.observe('cotabot_handler_seconds', elapsed, handler=ctx.name)
+        if ctx.error is not None:
+            metrics.inc('cotabot_handler_errors_total', handler=ctx.name)
+        if elapsed > SLOW_HANDLER:
+            logger.warning('%s on chat %s took %.2fs', ctx.name, ctx.chat_id, elapsed)
+
+class Throttle(Middleware):
+    """Drops updates of users sending more than rate per second, if rate is set.
+
+    Only for stateless commands, a dropped wizard reply or button tap would
+    be lost without the user ever knowing.
+    """
+
+    def __init__(self, rate=USER_RATE, burst=USER_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.lock = Lock()
+
+    def before(self, ctx):
+        if self.rate is None or ctx.user_id is None:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(ctx.user_id)
+            if bucket is None:
+                if len(self.buckets) >= 10000:
+                    # A full bucket is the same as a new one
+                    self.buckets = {k: b for k, b in self.buckets.items() if b.delay(now) or b.tokens < b.capacity}
+                bucket = self.buckets[ctx.user_id] = TokenBucket(self.rate, self.burst)
+            if bucket.delay(now):
+                middleware_stats['throttled'] += 1
+                logger.info('Dropped %s from user %d, too many updates', ctx.name, ctx.user_id)
+                return False
+            bucket.take()
+        return True
+
+class Typing(Middleware):
+    """Sends "typing..." only if the handler is still running after delay."""
+
+    def __init__(self, delay=TYPING_DELAY):
+        self.delay = delay
+
+    def before(self, ctx):
+        ctx.typing_sent = False
+        ctx.typing = scheduler.call_later(self.delay, self.send, ctx)
+
+    def send(self, ctx):
+        ctx.typing_sent = True
+        middleware_stats['typing_sent'] += 1
+        ctx.bot.send_chat_action(ctx.chat_id, ChatAction.TYPING)
+
+    def after(self, ctx):
+        scheduler.cancel(ctx.typing)
+        if not ctx.typing_sent:
+            middleware_stats['typing_skipped'] += 1
+
+class ChatLock(Middleware):
+    # Updates of one chat are handled one at a time, different chats in parallel
+    def before(self, ctx):
+        while True:
+            cota_chat = get_cota_chat(ctx.update)
+            cota_chat.lock.acquire()
+            # Evicted between the lookup and the lock, take the reloaded one
+            if not cota_chat.evicted:
+                ctx.cota_chat = cota_chat
+                return True
+            cota_chat.lock.release()
+
+    def after(self, ctx):
+        ctx.cota_chat.lock.release()
+
+class Members(Middleware):
+    # Remembers who uses the bot in each chat, for inline queries. Needs chat_lock first.
+    def before(self, ctx):
+        if ctx.user_id is not None:
+            ctx.cota_chat.note_member(ctx.update.effective_user)
+
+use_outbox = UseOutbox()
+timed = Timed()
+throttle = Throttle()
+typing = Typing()
+chat_lock = ChatLock()
+members = Members()
+
+DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+def pack_int(n):
+    s = ''
+    while True:
+        n, r = divmod(n, 36)
+        s = DIGITS[r] + s
+        if not n:
+            return s
+
+class CallbackRoute:
+    def __init__(self, opcode, handler, cota):
+        self.opcode = opcode
+        self.handler = handler
+        self.cota = cota
+        self.arity = 1 if cota else 0
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+class CallbackRouter:
+    """Dispatches callback queries to handlers registered by short opcode.
+
+    callback_data is the opcode followed by base 36 ids, separated by dots
+    ('p.1z'). Cota routes take the cota id, and since ids are never reused
+    a click on a button of a closed cota is told apart by the id alone.
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.by_handler = {}
+
+    def route(self, opcode, cota=False):
+
+        def register(handler):
+            if opcode in self.routes or '.' in opcode:
+                raise ValueError('Bad or repeated opcode {!r}'.format(opcode))
+            route = self.routes[opcode] = CallbackRoute(opcode, handler, cota)
+            self.by_handler[handler] = route
+            return handler
+
+        return register
+
+    def data(self, handler, *ids):
+        route = self.by_handler[handler]
+        fields = [route.opcode] + [pack_int(i) for i in ids]
+        data = '.'.join(fields)
+        # Telegram's limit for callback_data
+        if len(data.encode('utf-8')) > 64:
+            raise ValueError('callback_data too long: {!r}'.format(data))
+        return data
+
+    def dispatch(self, bot, update):
+        query = update.callback_query
+        m_id = query.message.message_id
+        fields = query.data.split('.')
+        route = self.routes.get(fields[0])
+        try:
+            args = [int(f, 36) for f in fields[1:]]
+        except ValueError:
+            route = None
+        cota_chat = get_cota_chat(update)
+        if route and len(args) != route.arity:
+            route = None
+        if route and route.cota and args[0] not in cota_chat.active_cotas:
+            route = None
+        if m_id not in cota_chat.iBoxes:
+            route = None
+        if not route:
+            # Buttons from an older layout, of a cota that was closed meanwhile
+            # or of a box the chat no longer keeps
+            stale_click(bot, update, m_id)
+            return
+
+        start = time.perf_counter()
+        try:
+            route.handler(bot, update, m_id, update.effective_user, *args)
+        finally:
+            elapsed = time.perf_counter() - start
+            route.calls += 1
+            route.seconds += elapsed
+            route.max_seconds = max(route.max_seconds, elapsed)
+            metrics.observe('cotabot_callback_seconds', elapsed, action=route.handler.__name__)
+
+    def stats(self):
+        return {route.handler.__name__: {'calls': route.calls, 'seconds': route.seconds,
+                                         'max_seconds': route.max_seconds}
+                for route in self.routes.values()}
+
+callback_router = CallbackRouter()
+callback_data = callback_router.data
+
+class UserName:
+    # Shared by every participation of the same user in a chat
+    __slots__ = ('first_name', 'last_name', 'username')
+
+    def __init__(self, first_name, last_name=None, username=None):
+        self.first_name = first_name
+        self.last_name = last_name if last_name else None
+        self.username = username
+
+    @classmethod
+    def of(cls, user):
+        return cls(user.first_name, user.last_name, getattr(user, 'username', None))
+
+    def matches(self, user):
+        return (self.first_name, self.last_name, self.username) == \
+            (user.first_name, user.last_name if user.last_name else None, getattr(user, 'username', None))
 
 class CotaParticipant:
-    def __init__(self, user):
-        self._id = user.id
-        self.first_name = user.first_name
-        self.last_name = user.last_name if user.last_name else None
+    __slots__ = ('_id', 'user', 'payed', 'n', 'rendered')
+
+    def __init__(self, user_id, user):
+        self._id = user_id
+        self.user = user
         self.payed = False
         self.n = 1
+        self.rendered = None
+
+    def __setstate__(self, state):
+        # Participants pickled before the JSON format kept their own names
+        state = state if isinstance(state, dict) else state[1]
+        self._id = state['_id']
+        self.user = UserName(state['first_name'], state.get('last_name'))
+        self.payed = state['payed']
+        self.n = state['n']
+        self.rendered = None
+
+    @property
+    def first_name(self):
+        return self.user.first_name
+
+    @property
+    def last_name(self):
+        return self.user.last_name
+
+    def set_n(self, n):
+        self.n = n
+        self.rendered = None
 
     def __str__(self):
-        s = ''
-        if self.n > 1:
-            s += '\[ {} ] '.format(self.n)
-        s += '*{}*'.format(self.first_name)
-        if self.last_name:
-            s += ' *{}.*'.format(self.last_name[0])
-        
-        return s
+        if self.rendered is None:
+            s = ''
+            if self.n > 1:
+                s += '\[ {} ] '.format(self.n)
+            s += '*{}*'.format(self.first_name)
+            if self.last_name:
+                s += ' *{}.*'.format(self.last_name[0])
+            self.rendered = s
+        return self.rendered
 
 class Cota:
+    __slots__ = ('_id', 'creator_id', 'cota_type', 'name', 'value', 'description', 'going',
+                 'closed_at', 'deadline', 'remind_every', 'next_reminder', 'heads', 'paid_heads', 'cache')
+
     def __init__(self, _id, creator_id, cota_type=VAQUINHA, name=None, value=None, description=None):
         self._id = _id
         self.creator_id = creator_id
@@ -61,68 +873,339 @@ class Cota:
         self.value = value
         self.description = description
         self.going = {}
+        self.closed_at = None
+        # Closed automatically at deadline. Unpaid participants are reminded
+        # every remind_every seconds, next at next_reminder.
+        self.deadline = None
+        self.remind_every = None
+        self.next_reminder = None
+        # Running totals over going, kept up to date by every mutation
+        self.heads = 0
+        self.paid_heads = 0
+        # Rendered fragments, cleared on every change
+        self.cache = {}
+
+    def __setstate__(self, state):
+        # Only needed to read cotas pickled before the JSON format
+        state = state if isinstance(state, dict) else state[1]
+        for slot in ('_id', 'creator_id', 'cota_type', 'name', 'value', 'description', 'going'):
+            setattr(self, slot, state[slot])
+        self.closed_at = state.get('closed_at')
+        self.deadline = self.remind_every = self.next_reminder = None
+        self.cache = {}
+        self.heads, self.paid_heads = self.recount()
+
+    def to_dict(self):
+        return {'id': self._id, 'creator_id': self.creator_id, 'type': self.cota_type,
+                'name': self.name, 'value': self.value, 'description': self.description,
+                'closed_at': self.closed_at, 'deadline': self.deadline,
+                'remind_every': self.remind_every, 'next_reminder': self.next_reminder,
+                'going': [[p._id, p.n, p.payed] for p in self.going.values()]}
+
+    @classmethod
+    def from_dict(cls, d, users):
+        cota = cls(d['id'], d['creator_id'], d['type'], d['name'], d['value'], d['description'])
+        cota.closed_at = d['closed_at']
+        cota.deadline = d.get('deadline')
+        cota.remind_every = d.get('remind_every')
+        cota.next_reminder = d.get('next_reminder')
+        for user_id, n, payed in d['going']:
+            participant = cota.going[user_id] = CotaParticipant(user_id, users[user_id])
+            participant.n = n
+            participant.payed = payed
+        cota.heads, cota.paid_heads = cota.recount()
+        return cota
+
+    def touch(self):
+        self.cache.clear()
+
+    def cached(self, key, build):
+        value = self.cache.get(key)
+        if value is None:
+            value = self.cache[key] = build()
+        return value
 
     def n_going(self):
-        return sum([participant.n for participant in self.going.values()])
+        return self.heads
+
+    def value_for_each(self):
+        if self.cota_type == COM_OBJETIVO:
+            return self.value / self.heads if (self.value and self.heads > 0) else None
+        return self.value
+
+    def total_value(self):
+        if self.cota_type == COM_OBJETIVO:
+            return self.value
+        return self.value * self.heads if self.value else None
+
+    def amount_collected(self):
+        each = self.value_for_each()
+        return each * self.paid_heads if each else 0.0
+
+    def amount_outstanding(self):
+        each = self.value_for_each()
+        return each * (self.heads - self.paid_heads) if each else 0.0
+
+    def recount(self):
+        heads = sum(p.n for p in self.going.values())
+        paid_heads = sum(p.n for p in self.going.values() if p.payed)
+        return heads, paid_heads
+
+    def check_aggregates(self):
+        # Full recount, for tests and benchmarks. Not an assert, -O must not skip it.
+        if (self.heads, self.paid_heads) != self.recount():
+            raise ValueError('Cota {} aggregates {} != recount {}'.format(
+                self._id, (self.heads, self.paid_heads), self.recount()))
 
     def set_value(self, value):
         try:
             self.value = float(value.replace(',', '.'))
         except:
             self.value = None
+        self.touch()
 
-    def add_participant(self, user):
-        if user.id not in self.going:
-            self.going[user.id] = CotaParticipant(user)
-        else:
-            self.going[user.id].n += 1
+    def change_seats(self, user_id, name, n):
+        # Adds n seats, removes -n or, with None, all of them. Returns how
+        # many changed, the cache is left to the caller.
+        participant = self.going.get(user_id)
+        if not participant:
+            if n is None or n <= 0:
+                return 0
+            participant = self.going[user_id] = CotaParticipant(user_id, name)
+            participant.n = 0
+        n = -participant.n if n is None else max(n, -participant.n)
+        participant.set_n(participant.n + n)
+        if not participant.n:
+            del self.going[user_id]
+        self.heads += n
+        if participant.payed:
+            self.paid_heads += n
+        return n
 
-    def remove_participant(self, user):
-        if user.id in self.going:
-            if self.going[user.id].n == 1:
-                del self.going[user.id]
-            else:
-                self.going[user.id].n -= 1
+    def add_participant(self, user, name=None, n=1):
+        self.change_seats(user.id, name or UserName.of(user), n)
+        self.touch()
+
+    def remove_participant(self, user, n=1):
+        if self.change_seats(user.id, None, -n):
+            self.touch()
+
+    def add_participants(self, seats):
+        # (user_id, name, n) for many users, touched once
+        changed = [n for n in (self.change_seats(*s) for s in seats) if n]
+        if changed:
+            self.touch()
+        return changed
+
+    def toggle_payed(self, user_id):
+        participant = self.going[user_id]
+        participant.payed = not participant.payed
+        self.paid_heads += participant.n if participant.payed else -participant.n
+        self.touch()
+        return participant.payed
 
     def btn_str(self):
-        val = '' if not self.value else ' - R$ {:.02f}'.format(self.value)
-        return '[ {} ] {}{}'.format(self.n_going(), self.name, val)
+        def build():
+            val = '' if not self.value else ' - R$ {:.02f}'.format(self.value)
+            return '[ {} ] {}{}'.format(self.n_going(), self.name, val)
+        return self.cached('btn_str', build)
 
     def __str__(self):
-        val = '' if not self.value else ' - R$ {:.02f}'.format(self.value)
-        return '\[ {} ] *{}*{}'.format(self.n_going(), self.name, val)
+        def build():
+            val = '' if not self.value else ' - R$ {:.02f}'.format(self.value)
+            return '\[ {} ] *{}*{}'.format(self.n_going(), self.name, val)
+        return self.cached('str', build)
         
 class CotaButtonView:
     def __init__(self, cota):
         self.cota = cota
         
     def btn(self):
-        return InlineKeyboardButton(self.cota.btn_str(), callback_data='show_cota {}'.format(self.cota._id))
+        return self.cota.cached('btn', lambda: InlineKeyboardButton(
+            self.cota.btn_str(), callback_data=callback_data(open_cota_view, self.cota._id)))
+
+
+# Keyboards that only depend on their arguments are built once
+
+@lru_cache(maxsize=None)
+def main_list_footer():
+    new_cota_btn = InlineKeyboardButton('Nova Cota', callback_data=callback_data(new_cota))
+    history_btn = InlineKeyboardButton('Histórico', callback_data=callback_data(open_history))
+    close_ibox_btn = InlineKeyboardButton('Fechar', callback_data=callback_data(close_ibox))
+    return (close_ibox_btn, history_btn, new_cota_btn)
+
+@lru_cache(maxsize=None)
+def main_list_nav(order):
+    prev_btn = InlineKeyboardButton('<', callback_data=callback_data(main_list_prev_page))
+    order_btn = InlineKeyboardButton(MAIN_LIST_ORDERS[order][0], callback_data=callback_data(main_list_next_order))
+    next_btn = InlineKeyboardButton('>', callback_data=callback_data(main_list_next_page))
+    return (prev_btn, order_btn, next_btn)
+
+@lru_cache(maxsize=None)
+def cota_creation_keyboard(state):
+    cancel_button = InlineKeyboardButton('Cancelar', callback_data=callback_data(cancel_new_cota))
+    skip_button = InlineKeyboardButton('Pular >>', callback_data=callback_data(skip_cota_creation_step))
+    if state == 0:
+        return ((InlineKeyboardButton('Vaquinha', callback_data=callback_data(create_vaquinha)),
+                 InlineKeyboardButton('C/ Objetivo', callback_data=callback_data(create_cota_with_objective))),
+                (cancel_button,))
+    elif state == 1:
+        return ((cancel_button,),)
+    return ((cancel_button, skip_button),)
+
+@lru_cache(maxsize=1024)
+def cota_view_keyboard(cota_id):
+    not_going_btn = InlineKeyboardButton('Não vou mais / -1', callback_data=callback_data(remove_participant, cota_id))
+    going_btn = InlineKeyboardButton('Eu vou! / +1', callback_data=callback_data(new_participant, cota_id))
+    bulk_btn = InlineKeyboardButton('+{}'.format(BULK_STEP), callback_data=callback_data(new_participants, cota_id))
+    payed_btn = InlineKeyboardButton('Paguei / Não Paguei', callback_data=callback_data(payed_or_not, cota_id))
+    edit_value_btn = InlineKeyboardButton('Edt. Valor', callback_data=callback_data(edit_cota_value, cota_id))
+    close_cota_btn = InlineKeyboardButton('Fin. Cota', callback_data=callback_data(close_cota, cota_id))
+    back_btn = InlineKeyboardButton('<< Voltar', callback_data=callback_data(back_to_main_list))
+
+    return ((not_going_btn, going_btn, bulk_btn),
+            (payed_btn,),
+            (back_btn, edit_value_btn, close_cota_btn))
+
+@lru_cache(maxsize=None)
+def close_cota_confirmation_keyboard():
+    cancel_btn = InlineKeyboardButton('Cancelar', callback_data=callback_data(cancel_closing_cota))
+    confirm_btn = InlineKeyboardButton('Sim!', callback_data=callback_data(confirm_closing_cota))
+    return ((cancel_btn, confirm_btn),)
+
+@lru_cache(maxsize=None)
+def history_keyboard(history_filter):
+    next_btn = InlineKeyboardButton('>', callback_data=callback_data(history_next_page))
+    prev_btn = InlineKeyboardButton('<', callback_data=callback_data(history_prev_page))
+    filter_btn = InlineKeyboardButton(HISTORY_FILTERS[history_filter], callback_data=callback_data(history_next_filter))
+    exit_history_btn = InlineKeyboardButton('Sair', callback_data=callback_data(back_to_main_list))
+    return ((prev_btn, filter_btn, next_btn), (exit_history_btn,))
 
 
 # All possible Interactive Boxes States
 
+# Label and sort key of each order of the main list, the id breaks ties
+MAIN_LIST_ORDERS = {
+    'n': ('Mais novas', lambda c: (-c._id,)),
+    'p': ('Mais pessoas', lambda c: (-c.heads, -c._id)),
+    'u': ('Não pagas', lambda c: (c.paid_heads - c.heads, -c._id)),
+}
+
+class CotaOrder:
+    """Keys of the active cotas in one of the MAIN_LIST_ORDERS, kept sorted.
+
+    Every key ends with the negated cota id, so keys are unique and lead
+    back to their cota.
+    """
+
+    def __init__(self, key, cotas):
+        self.key = key
+        self.keys = {c._id: key(c) for c in cotas}
+        self.sorted = sorted(self.keys.values())
+
+    def update(self, cota):
+        self.remove(cota._id)
+        key = self.keys[cota._id] = self.key(cota)
+        insort(self.sorted, key)
+
+    def remove(self, cota_id):
+        key = self.keys.pop(cota_id, None)
+        if key is not None:
+            del self.sorted[bisect_left(self.sorted, key)]
+
+    def position(self, start):
+        # How many keys sort up to start
+        return 0 if start is None else bisect_right(self.sorted, start)
+
+    def page(self, start, n):
+        i = self.position(start)
+        return [-key[-1] for key in self.sorted[i:i + n]]
+
 class MainListState:
-    def __init__(self, iBox):
+    """Active cotas, MAIN_LIST_PAGE_SIZE at a time.
+
+    A page is whatever sorts after the key of the last cota of the previous
+    one, so pages stay put while cotas are created and closed, and only a
+    page worth of buttons is ever built.
+    """
+
+    def __init__(self, iBox, order='n'):
         self.iBox = iBox
-        
-    def update(self, bot):
+        self.order = order
+        # Key the current page starts after, None for the first page, and those of the pages before
+        self.start = None
+        self.cursors = []
+        # Cotas on the last render, and the key of its last one if more came after
+        self.shown = ()
+        self.last_key = None
+
+    def depends_on(self, cota):
+        if cota is None or cota._id in self.shown:
+            return True
+        # Sorting by something that changed, a cota may move into the page or
+        # before it. The newest first order never moves.
+        if self.order == 'n':
+            return False
+        return self.last_key is None or MAIN_LIST_ORDERS[self.order][1](cota) <= self.last_key
+
+    def page(self):
+        cota_chat = self.iBox.cota_chat
+        # One more than fits tells if there is a next page
+        ids = cota_chat.list_order(self.order).page(self.start, MAIN_LIST_PAGE_SIZE + 1)
+        return [cota_chat.active_cotas[cota_id] for cota_id in ids]
+
+    def next(self):
+        page = self.page()
+        if len(page) <= MAIN_LIST_PAGE_SIZE:
+            return False
+        self.cursors.append(self.start)
+        self.start = MAIN_LIST_ORDERS[self.order][1](page[MAIN_LIST_PAGE_SIZE - 1])
+        return True
+
+    def prev(self):
+        if not self.cursors:
+            return False
+        self.start = self.cursors.pop()
+        return True
+
+    def next_order(self):
+        orders = list(MAIN_LIST_ORDERS)
+        self.order = orders[(orders.index(self.order) + 1) % len(orders)]
+        self.start = None
+        self.cursors = []
+
+    def render(self):
+        cota_chat = self.iBox.cota_chat
+        n = len(cota_chat.active_cotas)
+        if n <= MAIN_LIST_PAGE_SIZE:
+            self.start = None
+            self.cursors = []
+        page = self.page()
+        # Everything after the cursor was closed
+        while not page and self.cursors:
+            self.prev()
+            page = self.page()
+        shown = page[:MAIN_LIST_PAGE_SIZE]
+        self.shown = set(c._id for c in shown)
+        self.last_key = MAIN_LIST_ORDERS[self.order][1](shown[-1]) if len(page) > len(shown) else None
         header = 'Lista de Cotas:'
-        if not self.iBox.cota_chat.active_cotas:
+        if not n:
             header = '*Não tem nenhuma cota!*'
-        cota_views = [CotaButtonView(cota) for cota in self.iBox.cota_chat.active_cotas.values()]
-        button_list = [cota_view.btn() for cota_view in cota_views]
-        new_cota_btn = InlineKeyboardButton('Nova Cota', callback_data='new_cota')
-        history_btn = InlineKeyboardButton('Histórico', callback_data='open_history')
-        close_ibox_btn = InlineKeyboardButton('Fechar', callback_data='close_ibox')
-        
-        menu = [[b] for b in button_list] + [[close_ibox_btn, history_btn, new_cota_btn]]
-        
-        bot.edit_message_text(header, 
-                              reply_markup=InlineKeyboardMarkup(menu),
-                              chat_id=self.iBox.cota_chat._id, 
-                              message_id=self.iBox.message_id, 
-                              parse_mode=ParseMode.MARKDOWN)
+        elif n > MAIN_LIST_PAGE_SIZE:
+            # Pages before this one may have shrunk since they were shown, so
+            # the numbers come from what sorts before and after this page
+            before = cota_chat.list_order(self.order).position(self.start)
+            after = n - before - len(shown)
+            current = -(-before // MAIN_LIST_PAGE_SIZE) + 1
+            header = 'Lista de Cotas: {} / {}'.format(current, current + -(-after // MAIN_LIST_PAGE_SIZE))
+        button_list = [CotaButtonView(cota).btn() for cota in shown]
+
+        menu = [[b] for b in button_list]
+        if n > MAIN_LIST_PAGE_SIZE:
+            menu.append(main_list_nav(self.order))
+        menu.append(main_list_footer())
+
+        return header, menu
 
 class CotaCreationState:
     def __init__(self, iBox):
@@ -132,53 +1215,46 @@ class CotaCreationState:
     def next_state(self):
         self.state += 1
 
-    def update(self, bot):
-        cancel_button = InlineKeyboardButton('Cancelar', callback_data='cancel_new_cota')
+    def depends_on(self, cota):
+        return False
+
+    def render(self):
         if self.state == 0:
             header = 'É uma vaquinha ou cota com objetivo?'
-            button_list = [[InlineKeyboardButton('Vaquinha', callback_data='create_vaquinha'),
-                            InlineKeyboardButton('C/ Objetivo', callback_data='create_cota_with_objective')], 
-                            [cancel_button]]
         elif self.state == 1:
             header = 'Qual o nome da cota?'
-            button_list = [[cancel_button]]
         elif self.state == 2:
             header = 'Quanto custa a cota?'
-            button_list = [[cancel_button, InlineKeyboardButton('Pular >>', callback_data='skip_cota_creation_step')]]
         elif self.state == 3:
             header = 'Alguma descrição para a cota?'
-            button_list = [[cancel_button, InlineKeyboardButton('Pular >>', callback_data='skip_cota_creation_step')]]
         else:
-            return
+            return None
 
-        bot.edit_message_text(header, 
-                              reply_markup=InlineKeyboardMarkup(button_list),
-                              chat_id=self.iBox.cota_chat._id, 
-                              message_id=self.iBox.message_id, 
-                              parse_mode=ParseMode.MARKDOWN)
+        return header, cota_creation_keyboard(self.state)
 
 class CotaViewState:
     def __init__(self, iBox, cota):
         self.iBox = iBox
         self.cota = cota
 
-    
+    def depends_on(self, cota):
+        return cota is None or cota is self.cota
 
-    def update(self, bot):
-        n = self.cota.n_going()
-        name, value = self.cota.name, self.cota.value
-        description, cota_type = self.cota.description, self.cota.cota_type
+    def render(self):
+        text = self.cota.cached('view', self.render_text)
+        return text, cota_view_keyboard(self.cota._id)
 
-        if cota_type == COM_OBJETIVO:
-            total_value = value
-            val_for_each = value / n if (value and n > 0) else None
-       	else:
-            total_value = value * n if value else None
-            val_for_each = value
+    def render_text(self):
+        n = self.cota.n_going()
+        name, description = self.cota.name, self.cota.description
+        total_value = self.cota.total_value()
+        val_for_each = self.cota.value_for_each()
 
         header = '\[ {} ] *{}* {}\n'.format(n, name, '- R$ {:.02f}'.format(total_value) if total_value else '')
         sub_header = '_R$ {:.02f} p/ cada_\n\n'.format(val_for_each) if val_for_each else '\n'
         description_header = '{}\n\n'.format(description) if description else ''
+        if self.cota.deadline:
+            description_header += '_Prazo: {}_\n\n'.format(time.strftime('%d/%m %H:%M', time.localtime(self.cota.deadline)))
         participants_header = '--------------------------------\n*Participantes*:\n\n'
         text = '\n'.join([
             '_{} -_ {}{}{}'.format(
@@ -191,23 +1267,11 @@ class CotaViewState:
         ])
         if n == 0:
             text = 'Por enquanto ninguém!'
+        elif val_for_each:
+            text += '\n\n_Pago: R$ {:.02f} - Falta: R$ {:.02f}_'.format(
+                self.cota.amount_collected(), self.cota.amount_outstanding())
 
-        not_going_btn = InlineKeyboardButton('Não vou mais / -1', callback_data='remove_participant {}'.format(self.cota._id))
-        going_btn = InlineKeyboardButton('Eu vou! / +1', callback_data='new_participant {}'.format(self.cota._id))
-        payed_btn = InlineKeyboardButton('Paguei / Não Paguei', callback_data='payed {}'.format(self.cota._id))
-        edit_value_btn = InlineKeyboardButton('Edt. Valor', callback_data='edit_value {}'.format(self.cota._id))
-        close_cota_btn = InlineKeyboardButton('Fin. Cota', callback_data='close_cota {}'.format(self.cota._id))
-        back_btn = InlineKeyboardButton('<< Voltar', callback_data='back_to_main_list')
-        
-        menu = [[not_going_btn, going_btn],
-                [payed_btn],
-                [back_btn, edit_value_btn, close_cota_btn]]
-        
-        bot.edit_message_text(header + sub_header + description_header + participants_header + text + '\n', 
-                              reply_markup=InlineKeyboardMarkup(menu),
-                              chat_id=self.iBox.cota_chat._id, 
-                              message_id=self.iBox.message_id, 
-                              parse_mode=ParseMode.MARKDOWN)
+        return header + sub_header + description_header + participants_header + text + '\n'
 
 
 class CloseCotaConfirmationState:
@@ -215,31 +1279,43 @@ class CloseCotaConfirmationState:
         self.iBox = iBox
         self.cota = cota
 
-    def update(self, bot):
+    def depends_on(self, cota):
+        return False
+
+    def render(self):
         header = 'Tem certeza que quer finalizar a cota?'
 
-        cancel_btn = InlineKeyboardButton('Cancelar', callback_data='cancel_closing_cota')
-        confirm_btn = InlineKeyboardButton('Sim!', callback_data='confirm_closing_cota')
-        
-        menu = [[cancel_btn, confirm_btn]]
-        
-        bot.edit_message_text(header,
-                              reply_markup=InlineKeyboardMarkup(menu),
-                              chat_id=self.iBox.cota_chat._id, 
-                              message_id=self.iBox.message_id, 
-                              parse_mode=ParseMode.MARKDOWN)
+        return header, close_cota_confirmation_keyboard()
+
+# Label of each filter of the history: all cotas, the ones closed by who
+# pressed the button and the ones closed in the last HISTORY_RECENT_DAYS
+HISTORY_FILTERS = {
+    'a': 'Todas',
+    'm': 'Minhas',
+    'r': 'Recentes',
+}
 
 class HistoryViewState:
 
-    def __init__(self, iBox):
+    def __init__(self, iBox, creator_id=None, since=None, until=None):
         self.iBox = iBox
         self.page = 1
+        self.filter = 'a'
+        self.filters = {'creator_id': creator_id, 'since': since, 'until': until}
         self.update_pages()
 
+    def next_filter(self, user_id):
+        filters = list(HISTORY_FILTERS)
+        self.filter = filters[(filters.index(self.filter) + 1) % len(filters)]
+        self.filters = {'creator_id': user_id if self.filter == 'm' else None,
+                        'since': time.time() - HISTORY_RECENT_DAYS * 86400 if self.filter == 'r' else None,
+                        'until': None}
+        self.page = 1
+
     def update_pages(self):
-        h = self.iBox.cota_chat.cota_history
-        self.cota_history = [h[i:i+5] for i in range(0, len(h), 5)]
-        self.total_pages = len(self.cota_history)
+        size = store.history_count(self.iBox.cota_chat._id, **self.filters)
+        self.total_pages = -(-size // HISTORY_PAGE_SIZE)
+        self.page = max(1, min(self.page, self.total_pages))
 
     def prev(self):
         if self.page > 1:
@@ -253,28 +1329,45 @@ class HistoryViewState:
             return True
         return False
 
-    def update(self, bot):
+    def depends_on(self, cota):
+        # Only closing a cota changes the history, and that is a whole-chat update
+        return cota is None
+
+    def render(self):
         self.update_pages()
         if self.total_pages == 0:
             header = '*Não existem cotas no histórico!*'
             text = ''
         else:
             header = 'Histórico: {} / {}\n\n'.format(self.page, self.total_pages)
-            text = '\n'.join([str(c) for c in self.cota_history[self.page - 1]])
+            cotas = store.history_page(self.iBox.cota_chat._id, (self.page - 1) * HISTORY_PAGE_SIZE,
+                                       HISTORY_PAGE_SIZE, **self.filters)
+            text = '\n'.join([str(c) for c in cotas])
 
-        next_btn = InlineKeyboardButton('>', callback_data='history_next_page')
-        prev_btn = InlineKeyboardButton('<', callback_data='history_prev_page')
-        exit_history_btn = InlineKeyboardButton('Sair', callback_data='back_to_main_list')
-        
-        menu = [[prev_btn, exit_history_btn, next_btn]]
-        
-        bot.edit_message_text(header + text,
-                              reply_markup=InlineKeyboardMarkup(menu),
-                              chat_id=self.iBox.cota_chat._id, 
-                              message_id=self.iBox.message_id, 
-                              parse_mode=ParseMode.MARKDOWN)
+        return header + text, history_keyboard(self.filter)
 
 
+# Counts how many edits the render cache saved
+render_stats = {'edits': 0, 'skipped': 0}
+
+# Boxes a chat keeps, older ones are deleted when a new one is sent
+MAX_IBOXES = 5
+# Messages older than 48h can't be deleted and tend to stop working, boxes are forgotten then
+IBOX_TTL = 48 * 3600
+# Telegram's answers to edits of messages that are gone for good
+UNEDITABLE_ERRORS = ('message to edit not found', "message can't be edited")
+# Boxes dropped by the cap, by age and after failed edits. edits_saved counts
+# each dropped box once, for the edit it was spared at the next update.
+ibox_stats = {'capped': 0, 'expired': 0, 'pruned': 0, 'edits_saved': 0}
+
+@metrics.collector
+def render_metrics():
+    return [('cotabot_renders_total', 'counter', {'result': k}, v) for k, v in render_stats.items()] + \
+           [('cotabot_iboxes_dropped_total', 'counter', {'reason': k}, v) for k, v in ibox_stats.items()
+            if k != 'edits_saved'] + \
+           [('cotabot_ibox_edits_saved_total', 'counter', {}, ibox_stats['edits_saved'])] + \
+           [('cotabot_middleware_total', 'counter', {'event': k}, v) for k, v in middleware_stats.items()]
+
 class InteractiveBox:
     def __init__(self, cota_chat, initial_state = None):
         if not initial_state:
@@ -283,6 +1376,14 @@ class InteractiveBox:
         self.cota_chat = cota_chat
         
         self.current_state = initial_state
+        self.last_render = None
+        self.created_at = None
+
+    def __setstate__(self, state):
+        # Only needed to read boxes pickled before the JSON format
+        self.__dict__.update(state)
+        self.__dict__.setdefault('last_render', None)
+        self.__dict__.setdefault('created_at', None)
 
     def reset(self, bot):
         self.load_state(bot, MainListState(self))
@@ -291,14 +1392,182 @@ class InteractiveBox:
         self.current_state = state
         self.update(bot)
 
+    def invalidate(self):
+        # The message was changed outside of update(), so the next render must be sent
+        self.last_render = None
+
     def update(self, bot):
         if not self.message_id:
             message = bot.send_message(self.cota_chat._id, "_..._", parse_mode=ParseMode.MARKDOWN)
             self.message_id = message.message_id
+            self.created_at = time.time()
+            self.last_render = None
         try:
-            self.current_state.update(bot)
-        except:
-            logger.warning('iBox %d could not be updated', self.message_id)
+            rendered = self.current_state.render()
+            if rendered is None:
+                return
+            text, menu = rendered
+            key = (text, tuple(tuple((b.text, b.callback_data) for b in row) for row in menu))
+            if key == self.last_render:
+                render_stats['skipped'] += 1
+                return
+            bot.edit_message_text(text,
+                                  reply_markup=InlineKeyboardMarkup(menu),
+                                  chat_id=self.cota_chat._id,
+                                  message_id=self.message_id,
+                                  parse_mode=ParseMode.MARKDOWN).add_done_callback(partial(self.on_edit_done, key))
+            render_stats['edits'] += 1
+        except Exception:
+            metrics.inc('cotabot_render_failures_total')
+            logger.exception('iBox %s of chat %d could not be updated', self.message_id, self.cota_chat._id)
+
+    def on_edit_done(self, key, future):
+        # Only what reached the message counts as rendered
+        if not future.exception():
+            if future.result() is not SUPERSEDED:
+                self.last_render = key
+            return
+        # Edits that can never succeed (message deleted, too old...) come back
+        # as these BadRequests, others (bad Markdown...) may work next time.
+        # Dropped from the scheduler thread, the outbox worker must not wait
+        # for the chat lock.
+        e = future.exception()
+        if isinstance(e, BadRequest) and any(m in e.message.lower() for m in UNEDITABLE_ERRORS):
+            scheduler.call_later(0, self.cota_chat.prune_ibox, self)
+
+    def expired(self, now):
+        return self.created_at is not None and now - self.created_at > IBOX_TTL
+
+def search_tokens(text):
+    # Lower case words without accents
+    text = unicodedata.normalize('NFKD', text or '').encode('ascii', 'ignore').decode('ascii')
+    return re.findall(r'\w+', text.lower())
+
+class CotaIndex:
+    """Prefix index over the words in the names and descriptions of a chat's cotas.
+
+    Active and closed cotas share it, by id. tokens is kept sorted so every
+    word starting with a prefix is one bisect away.
+    """
+
+    def __init__(self):
+        self.cotas = {}
+        self.postings = {}
+        self.tokens = []
+
+    def add(self, cota):
+        self.remove(cota._id)
+        self.cotas[cota._id] = cota
+        for token in set(search_tokens(cota.name) + search_tokens(cota.description)):
+            keys = self.postings.get(token)
+            if keys is None:
+                keys = self.postings[token] = set()
+                insort(self.tokens, token)
+            keys.add(cota._id)
+
+    def remove(self, cota_id):
+        cota = self.cotas.pop(cota_id, None)
+        if cota is None:
+            return
+        for token in set(search_tokens(cota.name) + search_tokens(cota.description)):
+            keys = self.postings[token]
+            keys.discard(cota_id)
+            if not keys:
+                del self.postings[token]
+                del self.tokens[bisect_left(self.tokens, token)]
+
+    def prefixed(self, prefix):
+        found = set()
+        for i in range(bisect_left(self.tokens, prefix), len(self.tokens)):
+            if not self.tokens[i].startswith(prefix):
+                break
+            found |= self.postings[self.tokens[i]]
+        return found
+
+    def search(self, query, limit):
+        # Every word of the query must start some word of the cota
+        found = None
+        for prefix in search_tokens(query):
+            keys = self.prefixed(prefix)
+            found = keys if found is None else found & keys
+            if not found:
+                return []
+        cotas = self.cotas.values() if found is None else [self.cotas[k] for k in found]
+        # Active ones first, newest first
+        return sorted(cotas, key=lambda c: (c.closed_at is not None, -c._id))[:limit]
+
+def cota_balances(cota):
+    # Cents each user is owed (positive) or owes (negative) because of this
+    # cota: whoever has not paid owes their share to the creator
+    each = cota.value_for_each()
+    balances = Counter()
+    if not each:
+        return balances
+    for participant in cota.going.values():
+        if participant._id != cota.creator_id and not participant.payed:
+            cents = round(each * participant.n * 100)
+            balances[participant._id] -= cents
+            balances[cota.creator_id] += cents
+    return balances
+
+def settle_up(balances):
+    """Greedy minimum cash flow: the biggest debtor pays the biggest creditor until everyone is even.
+
+    Returns (from, to, cents) transfers, at most one less than the users
+    with a balance.
+    """
+    creditors = [(-cents, user_id) for user_id, cents in balances.items() if cents > 0]
+    debtors = [(cents, user_id) for user_id, cents in balances.items() if cents < 0]
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+    transfers = []
+    while creditors and debtors:
+        credit, creditor = heapq.heappop(creditors)
+        debt, debtor = heapq.heappop(debtors)
+        cents = min(-credit, -debt)
+        transfers.append((debtor, creditor, cents))
+        if -credit > cents:
+            heapq.heappush(creditors, (credit + cents, creditor))
+        if -debt > cents:
+            heapq.heappush(debtors, (debt + cents, debtor))
+    return transfers
+
+class Ledger:
+    """Balances of a chat, kept up to date one cota at a time.
+
+    Closed cotas are summed into the chat's history_balances when they
+    close, active ones are tracked per cota so a change only redoes that
+    cota. Transfers are worked out again only after something changed.
+    """
+
+    def __init__(self, history_balances):
+        self.balances = Counter(history_balances)
+        self.by_cota = {}
+        self.transfers = None
+
+    def apply(self, balances, sign):
+        for user_id, cents in balances.items():
+            self.balances[user_id] += sign * cents
+            if not self.balances[user_id]:
+                del self.balances[user_id]
+        self.transfers = None
+
+    def refresh(self, cota):
+        self.apply(self.by_cota.pop(cota._id, {}), -1)
+        balances = self.by_cota[cota._id] = cota_balances(cota)
+        self.apply(balances, 1)
+
+    def close(self, cota):
+        # Its share stays in the balances, now as part of the history
+        self.by_cota.pop(cota._id, None)
+
+    def pay(self, debtor, creditor, cents):
+        self.apply({debtor: cents, creditor: -cents}, 1)
+
+    def settlement(self):
+        if self.transfers is None:
+            self.transfers = settle_up(self.balances)
+        return self.transfers
 
 class CotaChat:
     def __init__(self, _id):
@@ -307,31 +1576,170 @@ class CotaChat:
         
         self.next_cota_id = 0
         self.active_cotas = {}
-        self.cota_history = []
         
         self.new_cota_ibox = None
         self.tmp_new_cota = None
 
         self.iBox_used_to_edit_cota = None
         self.cota_being_edited = None
+
+        # Names of everyone who took part in a cota, shared by their participations
+        self.users = {}
+        # Cents owed to (positive) or by each user because of closed cotas.
+        # None for chats from before it was kept, summed from the history when needed.
+        self.history_balances = {}
+
+        self.init_transient()
+
+    def init_transient(self):
+        # Never persisted
+        self.lock = RLock()
+        self.pending_renders = {}
+        self.render_timer = None
+        # Boxes dropped since the last update
+        self.dropped_iboxes = 0
+        # Set once the registry dropped this chat from memory
+        self.evicted = False
+        # Store revision this chat was loaded or last written at, 0 if never stored
+        self.revision = 0
+        # Built by the first inline query reaching this chat
+        self.search_index = None
+        # Users already recorded as members by this process
+        self.members = set()
+        # Built by the first /saldo
+        self.ledger = None
+        # Built by the first main list sorted each way
+        self.list_orders = {}
+
+    def __setstate__(self, state):
+        # Only needed to read chats pickled before the JSON format
+        self.__dict__.update(state)
+        self.__dict__.setdefault('users', {})
+        self.__dict__.setdefault('history_balances', None)
+        self.init_transient()
+
+    def to_dict(self):
+        # Only what must survive a restart. Wizards and edits in progress are
+        # dropped and boxes come back showing their cota or the main list.
+        users = dict(self.users)
+        for cota in self.active_cotas.values():
+            for participant in cota.going.values():
+                users.setdefault(participant._id, participant.user)
+        return {'format': CHAT_FORMAT, 'id': self._id, 'next_cota_id': self.next_cota_id,
+                'users': [[user_id, u.first_name, u.last_name, u.username] for user_id, u in users.items()],
+                'cotas': [cota.to_dict() for cota in self.active_cotas.values()],
+                'history_balances': None if self.history_balances is None else
+                                    [[user_id, cents] for user_id, cents in self.history_balances.items()],
+                'iboxes': [[message_id, getattr(iBox.current_state, 'cota', None) and iBox.current_state.cota._id,
+                            iBox.created_at]
+                           for message_id, iBox in self.iBoxes.items()]}
+
+    @classmethod
+    def from_dict(cls, d):
+        if d['format'] > CHAT_FORMAT:
+            raise ValueError('Chat {} was saved in a newer format ({})'.format(d['id'], d['format']))
+        cota_chat = cls(d['id'])
+        cota_chat.next_cota_id = d['next_cota_id']
+        cota_chat.users = {user_id: UserName(first_name, last_name, username)
+                           for user_id, first_name, last_name, username in d['users']}
+        for c in d['cotas']:
+            cota_chat.active_cotas[c['id']] = Cota.from_dict(c, cota_chat.users)
+        balances = d.get('history_balances', None)
+        cota_chat.history_balances = None if balances is None else dict(balances)
+        for message_id, cota_id, *rest in d['iboxes']:
+            iBox = InteractiveBox(cota_chat)
+            iBox.message_id = message_id
+            # Boxes saved without their age get a full edit window
+            iBox.created_at = rest[0] if rest and rest[0] else time.time()
+            if cota_id in cota_chat.active_cotas:
+                iBox.current_state = CotaViewState(iBox, cota_chat.active_cotas[cota_id])
+            cota_chat.iBoxes[message_id] = iBox
+        return cota_chat
+
+    def snapshot(self):
+        # Together with the revision it must be written over, a write made
+        # in between (archive_cota) already holds everything in it
+        with self.lock:
+            return json.dumps(self.to_dict(), separators=(',', ':')).encode('utf-8'), self.revision
+
+    def user_name(self, user):
+        name = self.users.get(user.id)
+        if name is None:
+            name = self.users[user.id] = UserName.of(user)
+        elif not name.matches(user):
+            name.__init__(user.first_name, user.last_name, getattr(user, 'username', None))
+            for cota in self.active_cotas.values():
+                if user.id in cota.going:
+                    cota.going[user.id].rendered = None
+                    cota.touch()
+        return name
         
     def new_ibox(self, bot):
         iBox = InteractiveBox(self)
         iBox.update(bot)
         self.iBoxes[iBox.message_id] = iBox
-        save_state()
+        self.cap_iboxes(bot)
+        save_state(self)
 
-    def remove_ibox(self, bot, message_id):
-        try:
+    def cap_iboxes(self, bot):
+        # iBoxes is in the order the messages were sent, oldest first
+        excess = len(self.iBoxes) - MAX_IBOXES
+        for message_id, iBox in list(self.iBoxes.items()):
+            if excess <= 0:
+                break
+            if iBox is self.new_cota_ibox or iBox is self.iBox_used_to_edit_cota:
+                continue
+            self.drop_ibox(iBox)
             bot.delete_message(self._id, message_id)
-            del self.iBoxes[message_id]
-        except:
-            logger.info('Tried to delete message and failed')
-            self.show_quick_message(bot, 'Mensagens com mais de 48h tendem a não funcionar corretamente.\nTente dar um novo /cotas')
-        save_state()
+            ibox_stats['capped'] += 1
+            excess -= 1
 
-    def bring_iBox_to_front(self, bot, message_id, reset=False, state=None):
-        iBox = self.iBoxes[message_id]
+    def drop_ibox(self, iBox):
+        self.iBoxes.pop(iBox.message_id, None)
+        self.pending_renders.pop(id(iBox), None)
+        if iBox is self.new_cota_ibox:
+            self.new_cota_ibox = None
+            self.tmp_new_cota = None
+        if iBox is self.iBox_used_to_edit_cota:
+            self.iBox_used_to_edit_cota = None
+            self.cota_being_edited = None
+        self.dropped_iboxes += 1
+
+    def expire_iboxes(self):
+        now = time.time()
+        for iBox in list(self.iBoxes.values()):
+            if iBox.expired(now):
+                self.drop_ibox(iBox)
+                ibox_stats['expired'] += 1
+
+    def prune_ibox(self, iBox):
+        # Also on the scheduler thread
+        if not self.lock.acquire(blocking=False):
+            scheduler.call_later(RENDER_RETRY, self.prune_ibox, iBox)
+            return
+        try:
+            if self.evicted or self.iBoxes.get(iBox.message_id) is not iBox:
+                return
+            logger.info('Dropping iBox %d of chat %d, it can no longer be edited', iBox.message_id, self._id)
+            self.drop_ibox(iBox)
+            ibox_stats['pruned'] += 1
+            save_state(self)
+        finally:
+            self.lock.release()
+
+    def remove_ibox(self, bot, message_id):
+        self.iBoxes.pop(message_id, None)
+        bot.delete_message(self._id, message_id).add_done_callback(
+            lambda f: self.on_ibox_delete_done(bot, f))
+        save_state(self)
+
+    def on_ibox_delete_done(self, bot, future):
+        if future.exception():
+            logger.info('Tried to delete message and failed')
+            self.show_quick_message(bot, 'Mensagens com mais de 48h tendem a não funcionar corretamente.\nTente dar um novo /cotas')
+
+    def bring_iBox_to_front(self, bot, message_id, reset=False, state=None):
+        iBox = self.iBoxes[message_id]
         self.remove_ibox(bot, message_id)
         iBox.message_id = None
         if reset:
@@ -341,18 +1749,109 @@ class CotaChat:
         else:
             iBox.update(bot)
         self.iBoxes[iBox.message_id] = iBox
-        save_state()
+        save_state(self)
 
-    def update(self, bot):
+    def update(self, bot, cota=None):
+        # Only boxes showing something that changed are re-rendered. The first
+        # update renders right away; updates arriving within RENDER_DEBOUNCE
+        # after it are merged into a single render per box.
+        self.expire_iboxes()
+        ibox_stats['edits_saved'] += self.dropped_iboxes
+        self.dropped_iboxes = 0
         for icb in self.iBoxes.values():
-            icb.update(bot)
+            if icb.current_state.depends_on(cota):
+                self.pending_renders[id(icb)] = icb
+        if cota is not None:
+            self.resort(cota)
+            if self.ledger is not None:
+                self.ledger.refresh(cota)
+
+        if not self.render_timer:
+            self.flush_renders(bot)
+            self.render_timer = scheduler.call_later(RENDER_DEBOUNCE, self.end_render_window, bot)
+
+        save_state(self)
+
+    def flush_renders(self, bot):
+        boxes = list(self.pending_renders.values())
+        self.pending_renders.clear()
+        for icb in boxes:
+            # The box may have been closed while waiting
+            if self.iBoxes.get(icb.message_id) is icb:
+                icb.update(bot)
+
+    def end_render_window(self, bot):
+        # On the scheduler thread, which must not wait for a busy chat. The
+        # window stays open until the lock is free, updates keep merging.
+        if not self.lock.acquire(blocking=False):
+            self.render_timer = scheduler.call_later(RENDER_RETRY, self.end_render_window, bot)
+            return
+        try:
+            self.render_timer = None
+            self.flush_renders(bot)
+        finally:
+            self.lock.release()
+
+    def note_member(self, user):
+        if user.id not in self.members:
+            self.members.add(user.id)
+            known = user.id in self.users
+            # Known by name for /saldo and /cota even before joining a cota
+            self.user_name(user)
+            flusher.add_member(user.id, self._id)
+            if not known:
+                save_state(self)
+
+    def index(self):
+        if self.search_index is None:
+            self.search_index = CotaIndex()
+            for cota in store.history_page(self._id, 0, INLINE_HISTORY):
+                self.search_index.add(cota)
+            for cota in self.active_cotas.values():
+                self.search_index.add(cota)
+        return self.search_index
+
+    def reindex(self, cota):
+        # Nothing to keep up to date until someone searches
+        if self.search_index is not None:
+            self.search_index.add(cota)
+        self.resort(cota)
 
-        save_state()
+    def list_order(self, order):
+        if order not in self.list_orders:
+            self.list_orders[order] = CotaOrder(MAIN_LIST_ORDERS[order][1], self.active_cotas.values())
+        return self.list_orders[order]
+
+    def resort(self, cota):
+        for order in self.list_orders.values():
+            if cota._id in self.active_cotas:
+                order.update(cota)
+            else:
+                order.remove(cota._id)
+
+    def search(self, query, limit):
+        return self.index().search(query, limit)
 
     def close_cota(self, cota_id):
-        self.cota_history = [self.active_cotas[cota_id]] + self.cota_history
-        del self.active_cotas[cota_id]
-        save_state()
+        cota = self.active_cotas.pop(cota_id)
+        cota.closed_at = time.time()
+        if cota is self.cota_being_edited:
+            # A value typed afterwards must not reach a cota in the history
+            self.cota_being_edited = None
+            self.iBox_used_to_edit_cota = None
+        self.reindex(cota)
+        if self.history_balances is not None:
+            for user_id, cents in cota_balances(cota).items():
+                self.history_balances[user_id] = self.history_balances.get(user_id, 0) + cents
+        if self.ledger is not None:
+            self.ledger.close(cota)
+        # Written right away, together with the chat, so a cota is never both active and in the history
+        try:
+            store.archive_cota(self, cota)
+        except VersionConflict:
+            # Closed elsewhere in the meantime, this copy is stale
+            cota_chats.discard(self)
+            raise
 
     def start_cota_creation(self, bot, message_id, creator_id):
         if self.new_cota_ibox:
@@ -363,7 +1862,7 @@ class CotaChat:
         self.bring_iBox_to_front(bot, message_id, state=CotaCreationState(iBox))
         self.new_cota_ibox = iBox
         self.tmp_new_cota = Cota(self.next_cota_id, creator_id)
-        save_state()
+        save_state(self)
 
     def cota_creation_update(self, bot, message):
         cota_state = self.new_cota_ibox.current_state
@@ -388,42 +1887,90 @@ class CotaChat:
         self.tmp_new_cota = None
         self.bring_iBox_to_front(bot, self.new_cota_ibox.message_id, reset=True)
         self.new_cota_ibox = None
-        save_state()
+        save_state(self)
             
     def submit_tmp_new_cota(self, bot):
         self.active_cotas[self.tmp_new_cota._id] = self.tmp_new_cota
+        self.reindex(self.tmp_new_cota)
         logger.info('Cota "%s" created', self.tmp_new_cota.name)
         self.tmp_new_cota = None
         self.next_cota_id += 1
         self.bring_iBox_to_front(bot, self.new_cota_ibox.message_id, reset=True)
         self.new_cota_ibox = None
-        save_state()
+        save_state(self)
 
     def open_cota_view(self, bot, ibox_id, cota_id):
         iBox = self.iBoxes[ibox_id]
         cota = self.active_cotas[cota_id]
         iBox.current_state = CotaViewState(iBox, cota)
         iBox.update(bot)
-        save_state()
+        save_state(self)
 
-    def add_cota_participant(self, bot, cota_id, user):
+    def add_cota_participant(self, bot, cota_id, user, n=1):
         cota = self.active_cotas[cota_id]
-        cota.add_participant(user)
-        self.update(bot)
-        logger.info('User "%s" added a participant to cota "%s"', user.first_name, cota.name)
+        cota.add_participant(user, self.user_name(user), n)
+        self.update(bot, cota)
+        logger.info('User "%s" added %d participants to cota "%s"', user.first_name, n, cota.name)
+
+    def find_cota(self, name):
+        # By name, ignoring case, or by the start of a single one
+        name = name.strip().lower()
+        cotas = list(self.active_cotas.values())
+        if not name:
+            return cotas[0] if len(cotas) == 1 else None
+        exact = [c for c in cotas if (c.name or '').lower() == name]
+        if exact:
+            return exact[-1]
+        prefixed = [c for c in cotas if (c.name or '').lower().startswith(name)]
+        return prefixed[0] if len(prefixed) == 1 else None
+
+    def find_user(self, username):
+        username = username.lower()
+        for user_id, name in self.users.items():
+            if name.username and name.username.lower() == username:
+                return user_id, name
+        return None
+
+    def bulk_participants(self, bot, user, cota_name, mentions):
+        cota = self.find_cota(cota_name)
+        if cota is None:
+            self.show_quick_message(bot, 'Não achei essa cota.\nUse /cota <nome da cota> @fulano 2 -@ciclano')
+            return
+        if cota.creator_id != user.id:
+            self.show_not_creator_of_cota_error(bot)
+            return
+        seats, unknown = [], []
+        for target, n in mentions:
+            if isinstance(target, str):
+                found = self.find_user(target)
+                if found is None:
+                    unknown.append('@' + target)
+                    continue
+                seats.append(found + (n,))
+            else:
+                seats.append((target.id, self.user_name(target), n))
+        changed = cota.add_participants(seats)
+        if changed:
+            # One render per box and one write for the whole list
+            self.update(bot, cota)
+            logger.info('User "%s" changed %d participants of cota "%s"', user.first_name, len(changed), cota.name)
+        message = '*{}*: +{} / -{}'.format(cota.name, sum(n for n in changed if n > 0), -sum(n for n in changed if n < 0))
+        if unknown:
+            message += '\nNão conheço {}, a pessoa precisa usar o bot no grupo antes'.format(', '.join(unknown))
+        self.show_quick_message(bot, message)
 
     def remove_cota_participant(self, bot, cota_id, user):
         cota = self.active_cotas[cota_id]
         cota.remove_participant(user)
-        self.update(bot)
+        self.update(bot, cota)
         logger.info('User "%s" removed a participant from cota "%s"', user.first_name, cota.name)
 
     def payed_or_not(self, bot, cota_id, user):
         cota = self.active_cotas[cota_id]
         if user.id in cota.going:
-	        cota.going[user.id].payed = not cota.going[user.id].payed
-	        self.update(bot)
-	        logger.info('User "%s" on cota "%s" set payed status to "%s"', user.first_name, cota.name, cota.going[user.id].payed)
+	        payed = cota.toggle_payed(user.id)
+	        self.update(bot, cota)
+	        logger.info('User "%s" on cota "%s" set payed status to "%s"', user.first_name, cota.name, payed)
 
     def try_to_edit_cota_value(self, bot, message_id, cota_id, user_id):
         cota = self.active_cotas[cota_id]
@@ -432,12 +1979,16 @@ class CotaChat:
             self.cota_being_edited = cota
             self.bring_iBox_to_front(bot, message_id)
             bot.edit_message_text('Qual o valor da cota?', self._id, self.iBox_used_to_edit_cota.message_id)
+            self.iBox_used_to_edit_cota.invalidate()
         else:
             self.show_not_creator_of_cota_error(bot)
 
     def edit_cota_value(self, bot, user_id, value):
         if self.cota_being_edited.creator_id == user_id:
             self.cota_being_edited.set_value(value)
+            self.reindex(self.cota_being_edited)
+            if self.ledger is not None:
+                self.ledger.refresh(self.cota_being_edited)
             self.bring_iBox_to_front(bot, self.iBox_used_to_edit_cota.message_id,
                 state=CotaViewState(self.iBox_used_to_edit_cota, self.cota_being_edited))
             self.iBox_used_to_edit_cota = None
@@ -466,14 +2017,186 @@ class CotaChat:
         cota = iBox.current_state.cota
         if cota.creator_id == user_id:
             self.close_cota(cota._id)
-            iBox.reset(bot)
+            for icb in list(self.iBoxes.values()):
+                if getattr(icb.current_state, 'cota', None) is cota:
+                    icb.reset(bot)
+            # Everything else listing the cota must drop it
+            self.update(bot)
         else:
             self.show_not_creator_of_cota_error(bot)
         
+    def get_ledger(self):
+        if self.ledger is None:
+            if self.history_balances is None:
+                # Chats from before history_balances, the history is read once
+                self.history_balances = {}
+                total = store.history_count(self._id)
+                for offset in range(0, total, 500):
+                    for cota in store.history_page(self._id, offset, 500):
+                        for user_id, cents in cota_balances(cota).items():
+                            self.history_balances[user_id] = self.history_balances.get(user_id, 0) + cents
+                save_state(self)
+            self.ledger = Ledger(self.history_balances)
+            for cota in self.active_cotas.values():
+                self.ledger.refresh(cota)
+        return self.ledger
+
+    def show_settlement(self, bot):
+        transfers = self.get_ledger().settlement()
+        if not transfers:
+            bot.post_message(self._id, '*Ninguém deve nada!*', parse_mode=ParseMode.MARKDOWN)
+            return
+
+        def name(user_id):
+            user = self.users.get(user_id)
+            return user.first_name if user else '#{}'.format(user_id)
+
+        lines = ['*{}* → *{}*: R$ {:.02f}'.format(name(debtor), name(creditor), cents / 100)
+                 for debtor, creditor, cents in transfers[:SETTLEMENT_LINES]]
+        if len(transfers) > SETTLEMENT_LINES:
+            lines.append('_... e mais {}_'.format(len(transfers) - SETTLEMENT_LINES))
+        bot.post_message(self._id, 'Para ficar tudo certo:\n\n' + '\n'.join(lines),
+                         parse_mode=ParseMode.MARKDOWN)
+
+    def confirm_payments(self, bot, user, mentions):
+        # Who received confirms, for the whole amount /saldo tells each one to pay.
+        # Recorded with the history, so debts of closed cotas can be settled too.
+        ledger = self.get_ledger()
+        owed = {debtor: cents for debtor, creditor, cents in ledger.settlement() if creditor == user.id}
+        lines, unknown, paid = [], [], False
+        for target, n in mentions:
+            if isinstance(target, str):
+                found = self.find_user(target)
+                if found is None:
+                    unknown.append('@' + target)
+                    continue
+                debtor, name = found
+            else:
+                debtor, name = target.id, self.user_name(target)
+            cents = owed.pop(debtor, None)
+            if not cents:
+                lines.append('{} não te deve nada'.format(name.first_name))
+                continue
+            for user_id, change in ((debtor, cents), (user.id, -cents)):
+                self.history_balances[user_id] = self.history_balances.get(user_id, 0) + change
+            ledger.pay(debtor, user.id, cents)
+            paid = True
+            lines.append('*{}* pagou R$ {:.02f}'.format(name.first_name, cents / 100))
+            logger.info('User "%s" got R$ %.02f from user %d', user.first_name, cents / 100, debtor)
+        if paid:
+            save_state(self)
+        if unknown:
+            lines.append('Não conheço {}, a pessoa precisa usar o bot no grupo antes'.format(', '.join(unknown)))
+        self.show_quick_message(bot, '\n'.join(lines))
+
+    def set_deadline(self, bot, user, cota_name, deadline):
+        cota = self.find_cota(cota_name)
+        if cota is None:
+            self.show_quick_message(bot, 'Não achei essa cota.\nUse /prazo <nome da cota> 25/12 18:00')
+            return
+        if cota.creator_id != user.id:
+            self.show_not_creator_of_cota_error(bot)
+            return
+        if deadline is not None and deadline <= time.time():
+            self.show_quick_message(bot, 'Esse prazo já passou')
+            return
+        cota.deadline = deadline
+        cota.touch()
+        if deadline is not None:
+            schedule_cota_timer(self._id, 'deadline', cota._id, deadline)
+        self.update(bot, cota)
+        self.show_quick_message(bot, 'Prazo de *{}*: {}'.format(
+            cota.name, time.strftime('%d/%m %H:%M', time.localtime(deadline)) if deadline else 'nenhum'))
+
+    def set_reminders(self, bot, user, cota_name, hours):
+        cota = self.find_cota(cota_name)
+        if cota is None:
+            self.show_quick_message(bot, 'Não achei essa cota.\nUse /lembrete <nome da cota> <horas>')
+            return
+        if cota.creator_id != user.id:
+            self.show_not_creator_of_cota_error(bot)
+            return
+        cota.remind_every = hours * 3600 if hours else None
+        cota.next_reminder = time.time() + cota.remind_every if hours else None
+        if hours:
+            schedule_cota_timer(self._id, 'reminder', cota._id, cota.next_reminder)
+        save_state(self)
+        self.show_quick_message(bot, 'Lembretes de *{}*: {}'.format(
+            cota.name, 'a cada {}h'.format(hours) if hours else 'desligados'))
+
+    def on_timers(self, bot, timers):
+        # Timers whose due time no longer matches their cota were replaced or turned off
+        now = time.time()
+        reminders, closed = [], []
+        for kind, cota_id, due in sorted(timers, key=lambda t: t[2]):
+            cota = self.active_cotas.get(cota_id)
+            if cota is None:
+                continue
+            if kind == 'deadline' and cota.deadline == due:
+                closed.append(cota)
+            elif kind == 'reminder' and cota.next_reminder == due:
+                reminders.append(cota)
+                # Reminders missed while the bot was down are not all sent
+                cota.next_reminder = due + cota.remind_every
+                while cota.next_reminder <= now:
+                    cota.next_reminder += cota.remind_every
+                if cota.deadline is None or cota.next_reminder < cota.deadline:
+                    schedule_cota_timer(self._id, 'reminder', cota._id, cota.next_reminder)
+                else:
+                    cota.next_reminder = None
+        # One message for every reminder of the chat
+        lines = [line for line in (self.unpaid_line(c) for c in reminders if c not in closed) if line]
+        if lines:
+            bot.post_message(self._id, '*Lembrete!* Ainda falta pagar:\n\n' + '\n'.join(lines),
+                             parse_mode=ParseMode.MARKDOWN)
+        for cota in closed:
+            self.auto_close_cota(bot, cota)
+        save_state(self)
+
+    def unpaid(self, cota):
+        return [p for p in cota.going.values() if not p.payed and p._id != cota.creator_id]
+
+    def unpaid_line(self, cota):
+        unpaid = self.unpaid(cota)
+        if not unpaid:
+            return None
+        each = cota.value_for_each()
+        owed = ' (R$ {:.02f})'.format(each * sum(p.n for p in unpaid)) if each else ''
+        return '*{}*{}: {}'.format(cota.name, owed, ', '.join(p.first_name for p in unpaid))
+
+    def auto_close_cota(self, bot, cota):
+        unpaid = self.unpaid(cota)
+        self.close_cota(cota._id)
+        for icb in list(self.iBoxes.values()):
+            if getattr(icb.current_state, 'cota', None) is cota:
+                icb.reset(bot)
+        self.update(bot)
+        logger.info('Cota "%s" reached its deadline', cota.name)
+        message = 'A cota *{}* chegou no prazo e foi finalizada.'.format(cota.name)
+        if unpaid:
+            message += '\n\nNão pagaram: ' + ', '.join(p.first_name for p in unpaid)
+        bot.post_message(self._id, message, parse_mode=ParseMode.MARKDOWN)
+
     def open_history(self, bot, message_id):
         iBox = self.iBoxes[message_id]
         iBox.load_state(bot, HistoryViewState(iBox))
 
+    def main_list_next_page(self, bot, message_id):
+        iBox = self.iBoxes[message_id]
+        if isinstance(iBox.current_state, MainListState) and iBox.current_state.next():
+            iBox.update(bot)
+
+    def main_list_prev_page(self, bot, message_id):
+        iBox = self.iBoxes[message_id]
+        if isinstance(iBox.current_state, MainListState) and iBox.current_state.prev():
+            iBox.update(bot)
+
+    def main_list_next_order(self, bot, message_id):
+        iBox = self.iBoxes[message_id]
+        if isinstance(iBox.current_state, MainListState):
+            iBox.current_state.next_order()
+            iBox.update(bot)
+
     def history_next_page(self, bot, message_id):
         iBox = self.iBoxes[message_id]
         if iBox.current_state.next():
@@ -484,32 +2207,140 @@ class CotaChat:
         if iBox.current_state.prev():
             iBox.update(bot)
 
+    def history_next_filter(self, bot, message_id, user_id):
+        iBox = self.iBoxes[message_id]
+        if isinstance(iBox.current_state, HistoryViewState):
+            iBox.current_state.next_filter(user_id)
+            iBox.update(bot)
+
     def show_not_creator_of_cota_error(self, bot):
         self.show_quick_message(bot, 'Apenas quem criou a cota pode editar ou finalizá-la')
 
     def show_quick_message(self, bot, message):
-        def show_message_on_thread(bot, message):
-            m = bot.send_message(self._id, message,
-                parse_mode=ParseMode.MARKDOWN)
-            time.sleep(10)
-            bot.delete_message(self._id, m.message_id)
-        Thread(target=show_message_on_thread, args=(bot, message)).start()
+        def schedule_message_deletion(future):
+            if not future.exception():
+                schedule_deletion(self._id, future.result().message_id)
+        bot.post_message(self._id, message,
+            parse_mode=ParseMode.MARKDOWN).add_done_callback(schedule_message_deletion)
 
 
+MAX_LOADED_CHATS = 10000
+
+class ChatRegistry:
+    """Thread safe, size bounded map of chat id to CotaChat.
+
+    Chats are read from the store the first time they are needed and the
+    least recently used idle ones are dropped once there are more than
+    capacity in memory.
+    """
+
+    def __init__(self, store=None, flusher=None, capacity=MAX_LOADED_CHATS):
+        self.store = store
+        self.flusher = flusher
+        self.capacity = capacity
+        self.chats = OrderedDict()
+        # chat_id -> Future of a load in progress, read outside the lock
+        self.loading = {}
+        self.broken = set()
+        self.lock = Lock()
+        self.stats = {'loads': 0, 'created': 0, 'evicted': 0, 'discarded': 0, 'load_failures': 0}
+
+    def get(self, chat_id):
+        with self.lock:
+            cota_chat = self.chats.get(chat_id)
+            if cota_chat is not None:
+                self.chats.move_to_end(chat_id)
+                return cota_chat
+            # One thread loads the chat, others asking for it wait on its future
+            loading = self.loading.get(chat_id)
+            if loading is None:
+                loading = self.loading[chat_id] = Future()
+                loader = True
+            else:
+                loader = False
+        if not loader:
+            return loading.result()
+        try:
+            cota_chat = self.load(chat_id)
+        except Exception as e:
+            with self.lock:
+                del self.loading[chat_id]
+            loading.set_exception(e)
+            raise
+        with self.lock:
+            del self.loading[chat_id]
+            self.chats[chat_id] = cota_chat
+            self.evict()
+        loading.set_result(cota_chat)
+        return cota_chat
+
+    def load(self, chat_id):
+        try:
+            cota_chat = self.store.load(chat_id) if self.store else None
+        except Exception:
+            # Only this chat is unusable, and its row is left as it is
+            self.stats['load_failures'] += 1
+            if chat_id not in self.broken:
+                self.broken.add(chat_id)
+                logger.exception('Chat %d could not be loaded', chat_id)
+            raise
+        if cota_chat is None:
+            self.stats['created'] += 1
+            return CotaChat(chat_id)
+        self.stats['loads'] += 1
+        return cota_chat
+
+    def evict(self):
+        excess = len(self.chats) - self.capacity
+        if excess <= 0:
+            return
+        # Busy chats are skipped, a few more than needed are looked at
+        for chat_id in list(islice(self.chats, excess + 16)):
+            if self.release(self.chats[chat_id]):
+                del self.chats[chat_id]
+                self.stats['evicted'] += 1
+                excess -= 1
+                if not excess:
+                    return
+
+    def release(self, cota_chat):
+        # A chat can go once nothing is using it and the store has all of it
+        if not cota_chat.lock.acquire(blocking=False):
+            return False
+        try:
+            idle = not (cota_chat.pending_renders or cota_chat.render_timer
+                        or cota_chat.new_cota_ibox or cota_chat.iBox_used_to_edit_cota
+                        or (self.flusher and self.flusher.pending(cota_chat._id)))
+            cota_chat.evicted = idle
+            return idle
+        finally:
+            cota_chat.lock.release()
+
+    def discard(self, cota_chat):
+        # Another process wrote this chat, the next get() reads its version
+        with cota_chat.lock:
+            cota_chat.evicted = True
+        with self.lock:
+            if self.chats.get(cota_chat._id) is cota_chat:
+                del self.chats[cota_chat._id]
+                self.stats['discarded'] += 1
+
+    def __len__(self):
+        return len(self.chats)
+
+    def values(self):
+        with self.lock:
+            return list(self.chats.values())
+
 def get_cota_chat(update):
-    chat_id = update.effective_chat.id
-    
-    # Add this chat if not present
-    if chat_id not in cota_chats:
-        cota_chats[chat_id] = CotaChat(chat_id)
-        
-    return cota_chats[chat_id]
+    return cota_chats.get(update.effective_chat.id)
 
-@send_typing_action
+@HandlerChain(use_outbox, timed, throttle, typing, chat_lock, members)
 def cotas(bot, update):
     cota_chat = get_cota_chat(update)
     cota_chat.new_ibox(bot)
 
+@HandlerChain(use_outbox, timed, chat_lock, members)
 def handle_message(bot, update):
     cota_chat = get_cota_chat(update)
     if cota_chat.new_cota_ibox \
@@ -520,123 +2351,308 @@ def handle_message(bot, update):
     elif cota_chat.cota_being_edited:
         cota_chat.edit_cota_value(bot, update.effective_user.id, update.message.text)
     
-def new_cota(bot, update, message_id, creator_id):
+def stale_click(bot, update, m_id):
     cota_chat = get_cota_chat(update)
-    cota_chat.start_cota_creation(bot, message_id, creator_id)
+    if m_id in cota_chat.iBoxes:
+        cota_chat.iBoxes[m_id].reset(bot)
+    else:
+        cota_chat.show_quick_message(bot, 'Essa mensagem está desatualizada.\nTente dar um novo /cotas')
 
-def cancel_new_cota(bot, update):
+@callback_router.route('n')
+def new_cota(bot, update, m_id, user):
+    cota_chat = get_cota_chat(update)
+    cota_chat.start_cota_creation(bot, m_id, user.id)
+
+@callback_router.route('x')
+def cancel_new_cota(bot, update, m_id, user):
     cota_chat = get_cota_chat(update)
     cota_chat.cancel_tmp_new_cota(bot)
 
-def set_new_cota_type(bot, update, t):
+@callback_router.route('cv')
+def create_vaquinha(bot, update, m_id, user):
+    cota_chat = get_cota_chat(update)
+    cota_chat.cota_creation_update(bot, VAQUINHA)
+
+@callback_router.route('co')
+def create_cota_with_objective(bot, update, m_id, user):
     cota_chat = get_cota_chat(update)
-    cota_chat.cota_creation_update(bot, t)
+    cota_chat.cota_creation_update(bot, COM_OBJETIVO)
 
-def skip_cota_creation_step(bot, update):
+@callback_router.route('sk')
+def skip_cota_creation_step(bot, update, m_id, user):
     cota_chat = get_cota_chat(update)
     cota_chat.cota_creation_update(bot, None)
 
-def close_ibox(bot, update, m_id):
+@callback_router.route('f')
+def close_ibox(bot, update, m_id, user):
     cota_chat = get_cota_chat(update)
     cota_chat.remove_ibox(bot, m_id)
 
-def open_cota_view(bot, update, m_id, cota_id):
+@callback_router.route('s', cota=True)
+def open_cota_view(bot, update, m_id, user, cota_id):
     cota_chat = get_cota_chat(update)
     cota_chat.open_cota_view(bot, m_id, cota_id)
 
-def back_to_main_list(bot, update, m_id):
+@callback_router.route('b')
+def back_to_main_list(bot, update, m_id, user):
     cota_chat = get_cota_chat(update)
     cota_chat.iBoxes[m_id].reset(bot)
 
-def new_participant(bot, update, cota_id, user):
+@callback_router.route('p', cota=True)
+def new_participant(bot, update, m_id, user, cota_id):
     cota_chat = get_cota_chat(update)
     cota_chat.add_cota_participant(bot, cota_id, user)
 
-def remove_participant(bot, update, cota_id, user):
+@callback_router.route('p+', cota=True)
+def new_participants(bot, update, m_id, user, cota_id):
+    cota_chat = get_cota_chat(update)
+    cota_chat.add_cota_participant(bot, cota_id, user, BULK_STEP)
+
+@callback_router.route('m', cota=True)
+def remove_participant(bot, update, m_id, user, cota_id):
     cota_chat = get_cota_chat(update)
     cota_chat.remove_cota_participant(bot, cota_id, user)
 
-def payed_or_not(bot, update, cota_id, user):
+@callback_router.route('$', cota=True)
+def payed_or_not(bot, update, m_id, user, cota_id):
     cota_chat = get_cota_chat(update)
     cota_chat.payed_or_not(bot, cota_id, user)
 
-def edit_cota_value(bot, update, m_id, cota_id, user_id):
+@callback_router.route('e', cota=True)
+def edit_cota_value(bot, update, m_id, user, cota_id):
     cota_chat = get_cota_chat(update)
-    cota_chat.try_to_edit_cota_value(bot, m_id, cota_id, user_id)
+    cota_chat.try_to_edit_cota_value(bot, m_id, cota_id, user.id)
 
-def close_cota(bot, update, m_id, cota_id, user_id):
+@callback_router.route('c', cota=True)
+def close_cota(bot, update, m_id, user, cota_id):
     cota_chat = get_cota_chat(update)
-    cota_chat.try_to_close_cota(bot, m_id, cota_id, user_id)
+    cota_chat.try_to_close_cota(bot, m_id, cota_id, user.id)
 
-def cancel_closing_cota(bot, update, m_id, user_id):
+def confirming_close(cota_chat, m_id):
+    # A second tap on yes or no comes after the box left the confirmation
+    return isinstance(cota_chat.iBoxes[m_id].current_state, CloseCotaConfirmationState)
+
+@callback_router.route('cx')
+def cancel_closing_cota(bot, update, m_id, user):
+    cota_chat = get_cota_chat(update)
+    if not confirming_close(cota_chat, m_id):
+        stale_click(bot, update, m_id)
+        return
+    cota_chat.cancel_closing_cota(bot, m_id, user.id)
+
+@callback_router.route('cy')
+def confirm_closing_cota(bot, update, m_id, user):
+    cota_chat = get_cota_chat(update)
+    if not confirming_close(cota_chat, m_id):
+        stale_click(bot, update, m_id)
+        return
+    cota_chat.confirm_closing_cota(bot, m_id, user.id)
+
+@callback_router.route('l>')
+def main_list_next_page(bot, update, m_id, user):
+    cota_chat = get_cota_chat(update)
+    cota_chat.main_list_next_page(bot, m_id)
+
+@callback_router.route('l<')
+def main_list_prev_page(bot, update, m_id, user):
     cota_chat = get_cota_chat(update)
-    cota_chat.cancel_closing_cota(bot, m_id, user_id)
+    cota_chat.main_list_prev_page(bot, m_id)
 
-def confirm_closing_cota(bot, update, m_id, user_id):
+@callback_router.route('lo')
+def main_list_next_order(bot, update, m_id, user):
     cota_chat = get_cota_chat(update)
-    cota_chat.confirm_closing_cota(bot, m_id, user_id)
+    cota_chat.main_list_next_order(bot, m_id)
 
-def open_history(bot, update, m_id):
+@callback_router.route('h')
+def open_history(bot, update, m_id, user):
     cota_chat = get_cota_chat(update)
     cota_chat.open_history(bot, m_id)
 
-def history_next_page(bot, update, m_id):
+@callback_router.route('h>')
+def history_next_page(bot, update, m_id, user):
     cota_chat = get_cota_chat(update)
     cota_chat.history_next_page(bot, m_id)
 
-def history_prev_page(bot, update, m_id):
+@callback_router.route('h<')
+def history_prev_page(bot, update, m_id, user):
     cota_chat = get_cota_chat(update)
     cota_chat.history_prev_page(bot, m_id)
+
+@callback_router.route('hf')
+def history_next_filter(bot, update, m_id, user):
+    cota_chat = get_cota_chat(update)
+    cota_chat.history_next_filter(bot, m_id, user.id)
     
+@HandlerChain(use_outbox, timed, chat_lock, members)
 def callback_handler(bot, update):
-    query = update.callback_query
-    splt = query.data.split()
-    m_id = query.message.message_id
-    user = update.effective_user
+    callback_router.dispatch(bot, update)
 
-    request = splt[0]
-    
-    if request == 'show_cota':
-        open_cota_view(bot, update, m_id, int(splt[1]))
-    elif request == 'new_cota':
-        new_cota(bot, update, m_id, user.id)
-    elif request == 'cancel_new_cota':
-        cancel_new_cota(bot, update)
-    elif request == 'create_vaquinha':
-    	set_new_cota_type(bot, update, VAQUINHA)
-    elif request == 'create_cota_with_objective':
-    	set_new_cota_type(bot, update, COM_OBJETIVO)
-    elif request == 'skip_cota_creation_step':
-        skip_cota_creation_step(bot, update)
-    elif request == 'close_ibox':
-        close_ibox(bot, update, m_id)
-    elif request == 'back_to_main_list':
-        back_to_main_list(bot, update, m_id)
-    elif request == 'new_participant':
-        new_participant(bot, update, int(splt[1]), user)
-    elif request == 'remove_participant':
-        remove_participant(bot, update, int(splt[1]), user)
-    elif request == 'payed':
-        payed_or_not(bot, update, int(splt[1]), user)
-    elif request == 'edit_value':
-        edit_cota_value(bot, update, m_id, int(splt[1]), user.id)
-    elif request == 'close_cota':
-        close_cota(bot, update, m_id, int(splt[1]), user.id)
-    elif request == 'cancel_closing_cota':
-        cancel_closing_cota(bot, update, m_id, user.id)
-    elif request == 'confirm_closing_cota':
-        confirm_closing_cota(bot, update, m_id, user.id)
-    elif request == 'open_history':
-        open_history(bot, update, m_id)
-    elif request == 'history_next_page':
-        history_next_page(bot, update, m_id)
-    elif request == 'history_prev_page':
-        history_prev_page(bot, update, m_id)
+BULK_COUNT = re.compile(r'\s*[x×]?\s*(\d+)')
+
+def parse_mentions(message):
+    """Reads '/cota Churras @ana @bruno 3 -@carla' into the cota name and (user, seats) pairs.
+
+    A mention adds one seat or the number after it. With a '-' in front it
+    removes that many, or all of them (None). Users are '@username' strings, or
+    User objects for people without one, which Telegram sends as text mentions.
+    """
+    # Entity offsets count UTF-16 code units
+    data = message.text.encode('utf-16-le')
+
+    def piece(start, end=None):
+        return data[start * 2:None if end is None else end * 2].decode('utf-16-le')
 
+    entities = sorted((e for e in message.entities or ()
+                       if e.type in (MessageEntity.MENTION, MessageEntity.TEXT_MENTION)), key=lambda e: e.offset)
+    ends = [e.offset for e in entities[1:]] + [None]
+    head = piece(0, entities[0].offset if entities else None).split(None, 1)
+    cota_name = head[1] if len(head) > 1 else ''
+    before = cota_name
+    mentions = []
+    for entity, end in zip(entities, ends):
+        remove = before.rstrip().endswith('-')
+        after = piece(entity.offset + entity.length, end)
+        count = BULK_COUNT.match(after)
+        n = min(int(count.group(1)), BULK_MAX_SEATS) if count else 1
+        if entity.type == MessageEntity.MENTION:
+            target = piece(entity.offset + 1, entity.offset + entity.length)
+        else:
+            target = entity.user
+        if remove:
+            n = -n if count else None
+        mentions.append((target, n))
+        before = after
+    return cota_name.strip().rstrip('-').strip(), mentions
+
+@HandlerChain(use_outbox, timed, throttle, chat_lock, members)
+def bulk_participants(bot, update):
+    cota_chat = get_cota_chat(update)
+    cota_name, mentions = parse_mentions(update.message)
+    cota_chat.bulk_participants(bot, update.effective_user, cota_name, mentions)
+
+def inline_result(chat_id, cota):
+    def build():
+        title = cota.btn_str() if cota.closed_at is None else '(finalizada) ' + cota.btn_str()
+        text = cota.cached('view', CotaViewState(None, cota).render_text)
+        return InlineQueryResultArticle('{}.{}'.format(chat_id, cota._id), title,
+                                        InputTextMessageContent(text, parse_mode=ParseMode.MARKDOWN),
+                                        description=cota.description)
+    return cota.cached(('inline', chat_id), build)
+
+def locked_chat(chat_id, blocking=True):
+    # Like ChatLock, for chats other than the one of the update. Without
+    # blocking, None when another thread holds the chat.
+    while True:
+        cota_chat = cota_chats.get(chat_id)
+        if not cota_chat.lock.acquire(blocking=blocking):
+            return None
+        if not cota_chat.evicted:
+            return cota_chat
+        cota_chat.lock.release()
+
+def search_chat(chat_id, query):
+    if not owns_chat(chat_id):
+        # Kept by another shard, which may change it at any time: searched in
+        # a fresh copy that this process does not keep
+        try:
+            cota_chat = store.load(chat_id)
+        except Exception:
+            logger.exception('Chat %d could not be loaded', chat_id)
+            raise
+        return cota_chat.search(query, INLINE_RESULTS) if cota_chat else []
+    cota_chat = locked_chat(chat_id)
+    try:
+        return cota_chat.search(query, INLINE_RESULTS)
+    finally:
+        cota_chat.lock.release()
+
+@HandlerChain(use_outbox, timed, throttle)
+def inline_search(bot, update):
+    query = update.inline_query
+    found = []
+    for chat_id in store.member_chats(query.from_user.id):
+        try:
+            found += [(cota, inline_result(chat_id, cota)) for cota in search_chat(chat_id, query.query)]
+        except Exception:
+            # Unreadable chat, already logged by the registry
+            continue
+    found.sort(key=lambda r: (r[0].closed_at is not None, -(r[0].closed_at or 0)))
+    bot.answer_inline_query(query.id, [result for _, result in found[:INLINE_RESULTS]], query.from_user.id,
+                            cache_time=INLINE_CACHE_TIME, is_personal=True)
+
+@HandlerChain(use_outbox, timed, throttle, chat_lock, members)
+def settlement(bot, update):
+    cota_chat = get_cota_chat(update)
+    cota_chat.show_settlement(bot)
+
+DEADLINE = re.compile(r'(\d{1,2})/(\d{1,2})(?:/(\d{2,4}))?(?:\s+(\d{1,2})(?:[:h](\d{2}))?h?)?\s*$')
+
+def parse_deadline(text):
+    """Splits '/prazo Churras 25/12 18:00' into the cota name and the deadline.
+
+    The year defaults to the next 25/12 to come and the time to the end of
+    the day, in the server's time zone. 'sem' removes the deadline (None).
+    Returns None when the date can't be read.
+    """
+    parts = text.split(None, 1)
+    args = parts[1] if len(parts) > 1 else ''
+    words = args.split()
+    if words and words[-1].lower() == 'sem':
+        return ' '.join(words[:-1]), None
+    match = DEADLINE.search(args)
+    if not match:
+        return None
+    day, month, year, hour, minute = [int(g) if g else None for g in match.groups()]
+    if hour is None:
+        hour, minute = 23, 59
+    now = datetime.now()
+    try:
+        when = datetime(year + 2000 if year and year < 100 else year or now.year, month, day, hour, minute or 0)
+        if year is None and when <= now:
+            when = when.replace(year=now.year + 1)
+    except ValueError:
+        return None
+    return args[:match.start()], when.timestamp()
+
+@HandlerChain(use_outbox, timed, throttle, chat_lock, members)
+def payments(bot, update):
+    cota_chat = get_cota_chat(update)
+    _, mentions = parse_mentions(update.message)
+    if not mentions:
+        cota_chat.show_quick_message(bot, 'Use /quitar @fulano quando fulano te pagar o que o /saldo mostra')
+        return
+    cota_chat.confirm_payments(bot, update.effective_user, mentions)
+
+@HandlerChain(use_outbox, timed, throttle, chat_lock, members)
+def deadline(bot, update):
+    cota_chat = get_cota_chat(update)
+    parsed = parse_deadline(update.message.text)
+    if parsed is None:
+        cota_chat.show_quick_message(bot, 'Use /prazo <nome da cota> 25/12 18:00, ou /prazo <nome da cota> sem')
+        return
+    cota_chat.set_deadline(bot, update.effective_user, *parsed)
+
+@HandlerChain(use_outbox, timed, throttle, chat_lock, members)
+def reminders(bot, update):
+    cota_chat = get_cota_chat(update)
+    args = update.message.text.split()[1:]
+    if not args or not args[-1].rstrip('h').isdigit():
+        cota_chat.show_quick_message(bot, 'Use /lembrete <nome da cota> <horas>, 0 desliga')
+        return
+    cota_chat.set_reminders(bot, update.effective_user, ' '.join(args[:-1]), int(args[-1].rstrip('h')))
+
+@HandlerChain(use_outbox, timed, throttle)
 def cota_help(bot, update):
     cota_chat = get_cota_chat(update)
-    bot.send_message(cota_chat._id, "/cotas - Inicia o bot\n/cotaversion - Versão do CotaBot")
+    bot.send_message(cota_chat._id, "/cotas - Inicia o bot\n"
+                                    "/cota <nome> @fulano 2 -@ciclano - Adiciona ou remove várias pessoas de uma vez\n"
+                                    "/saldo - Quem deve pagar quem, somando todas as cotas\n"
+                                    "/quitar @fulano - Confirma que fulano te pagou o que o /saldo mostra\n"
+                                    "/prazo <nome> 25/12 18:00 - Finaliza a cota sozinha no prazo\n"
+                                    "/lembrete <nome> 24 - Lembra quem não pagou a cada 24h\n"
+                                    "/cotaversion - Versão do CotaBot")
 
+@HandlerChain(use_outbox, timed, throttle)
 def cota_version(bot, update):
     cota_chat = get_cota_chat(update)
     bot.send_message(cota_chat._id, 'CotaBot - v{}'.format(VERSION))
@@ -645,54 +2661,1679 @@ def error(bot, update, error):
     """Log Errors caused by Updates."""
     logger.warning('%s', error)
 
-cota_chats = {}
+CHAT_FORMAT = 1
+
+def encode_cota(cota):
+    # A history entry carries the names it needs, it outlives the chat's users table
+    users = [[p._id, p.first_name, p.last_name, p.user.username] for p in cota.going.values()]
+    return json.dumps({'format': CHAT_FORMAT, 'cota': cota.to_dict(), 'users': users},
+                      separators=(',', ':')).encode('utf-8')
+
+def decode_cota(data):
+    if data[:1] != b'{':
+        # Pickled before the JSON format
+        return pickle.loads(data)
+    d = json.loads(data.decode('utf-8'))
+    users = {user_id: UserName(first_name, last_name, username)
+             for user_id, first_name, last_name, username in d['users']}
+    return Cota.from_dict(d['cota'], users)
+
+DB_FILE = 'cotas_db.sqlite'
+LEGACY_DB_FILE = 'cotas_db.pickle'
+COMPACT_EVERY = 1000
+
+# Backend used by load_state: 'sqlite', 'file' (a directory next to DB_FILE)
+# or 'redis' (any server speaking RESP, see fake_redis.py)
+STORE = 'sqlite'
+REDIS_URL = 'redis://127.0.0.1:6379'
+REDIS_PREFIX = 'cotabot'
+REDIS_POOL_SIZE = 8
+REDIS_TIMEOUT = 5.0
+
+# Closed cotas older than this leave the history, into history_archive
+# when HISTORY_ARCHIVE is set. None keeps them forever.
+HISTORY_RETENTION_DAYS = None
+HISTORY_ARCHIVE = True
+
+# Write-behind: dirty chats are written at most this often, or sooner once
+# this many mutations pile up
+FLUSH_INTERVAL = 0.2
+FLUSH_MAX_PENDING = 50
+# Failed writes are retried after FLUSH_RETRY seconds, doubling up to
+# FLUSH_RETRY_MAX. On shutdown the flusher gives up after this many attempts.
+FLUSH_RETRY = 0.5
+FLUSH_RETRY_MAX = 30
+FLUSH_SHUTDOWN_ATTEMPTS = 3
+
+class VersionConflict(Exception):
+    """The chat was written by another process since it was loaded."""
+
+def history_entry(chat_id, cota):
+    return {'chat_id': chat_id, 'creator_id': cota.creator_id, 'closed_at': cota.closed_at,
+            'data': encode_cota(cota).decode('utf-8')}
+
+def history_matches(entry, creator_id, since, until):
+    closed_at = entry['closed_at']
+    return (creator_id is None or entry['creator_id'] == creator_id) \
+        and (since is None or (closed_at is not None and closed_at >= since)) \
+        and (until is None or (closed_at is not None and closed_at < until))
+
+class Store:
+    """Storage of chats, their history and timers.
+
+    Every chat remembers the revision it was loaded or last written at, and
+    a backend refuses to write it over a newer one. save_many() returns the
+    chats refused that way, archive_cota() raises VersionConflict. This way
+    two processes serving the same chat never silently drop each other's
+    changes.
+    """
+
+    writes = 0
+
+    def decode_chat(self, data, revision=0):
+        if data[:1] != b'{':
+            return self.upgrade_legacy(pickle.loads(data), revision)
+        cota_chat = CotaChat.from_dict(json.loads(data.decode('utf-8')))
+        cota_chat.revision = revision
+        return cota_chat
+
+    def upgrade_legacy(self, cota_chat, revision=0):
+        # Chats pickled before the JSON format
+        history = cota_chat.__dict__.pop('cota_history', None)
+        cota_chat = CotaChat.from_dict(cota_chat.to_dict())
+        cota_chat.revision = revision
+        if history:
+            self.migrate_history(cota_chat, history)
+        return cota_chat
+
+    def migrate_history(self, cota_chat, history):
+        # Chats saved before the history table kept it as a newest first list.
+        # Their cotas have no closed_at, retention counts from the migration.
+        now = time.time()
+        for cota in history:
+            if cota.closed_at is None:
+                cota.closed_at = now
+        self.write_with_history(cota_chat, [history_entry(cota_chat._id, c) for c in reversed(history)])
+
+    def archive_cota(self, cota_chat, cota):
+        # Together with the chat, so a cota is never both active and in the history
+        self.write_with_history(cota_chat, [history_entry(cota_chat._id, cota)])
+
+    def snapshot(self, cota_chat):
+        # Every backend writes what this returns, so all of them are measured
+        data, revision = cota_chat.snapshot()
+        metrics.observe('cotabot_snapshot_bytes', len(data), SIZE_BUCKETS)
+        return data, revision
+
+    def save(self, cota_chat):
+        if self.save_many([cota_chat]):
+            raise VersionConflict(cota_chat._id)
+
+    def wrote_chats(self, rows, written):
+        # Called with the store lock held, like every other revision change.
+        # Returns the chats refused because another process wrote them: a
+        # snapshot refused because this process wrote the chat again since
+        # is not a conflict, that later write already had all of it.
+        for cota_chat, _, revision in written:
+            cota_chat.revision = max(cota_chat.revision, revision + 1)
+        self.wrote(len(written))
+        written = set(id(c) for c, _, _ in written)
+        return [c for c, _, revision in rows if id(c) not in written and c.revision == revision]
+
+    def claim_timers(self, kind, timers):
+        # The timers this process is to handle. Stores read by one process
+        # hand all of them, they are removed once handled.
+        return timers
+
+    def pop_due_timers(self, kind, now):
+        timers = self.claim_timers(kind, self.due_timers(kind, now))
+        self.remove_timers(kind, timers)
+        return [(chat_id, payload) for _, chat_id, payload in timers]
+
+    def wrote(self, n):
+        self.writes += n
+        if self.writes >= COMPACT_EVERY:
+            self.writes = 0
+            self.compact()
+
+    def compact(self):
+        if HISTORY_RETENTION_DAYS:
+            self.expire_history(time.time() - HISTORY_RETENTION_DAYS * 86400)
+
+    def migrate_legacy(self, legacy_path):
+        if not os.path.exists(legacy_path) or not self.is_empty():
+            return
+        try:
+            with open(legacy_path, 'rb') as f:
+                chats = pickle.load(f)
+        except Exception:
+            logger.exception('Could not read legacy database %s', legacy_path)
+            return
+        self.save_many([self.upgrade_legacy(c) for c in chats.values()])
+        os.rename(legacy_path, legacy_path + '.migrated')
+        logger.info('Migrated %d chats from %s', len(chats), legacy_path)
+
+class ChatStore(Store):
+    """Stores each CotaChat as its own SQLite row, so a mutation only rewrites that chat."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        # Must be set before the first table is created to take effect
+        self.conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS chats ('
+                              'chat_id INTEGER PRIMARY KEY, data BLOB NOT NULL, '
+                              'revision INTEGER NOT NULL DEFAULT 1)')
+            if 'revision' not in [c[1] for c in self.conn.execute('PRAGMA table_info(chats)')]:
+                # Databases from before optimistic versioning
+                self.conn.execute('ALTER TABLE chats ADD COLUMN revision INTEGER NOT NULL DEFAULT 1')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS timers ('
+                              'timer_id INTEGER PRIMARY KEY, due REAL NOT NULL, chat_id INTEGER NOT NULL, '
+                              'kind TEXT NOT NULL, payload TEXT)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS timers_due ON timers (kind, due)')
+            for table in ('history', 'history_archive'):
+                self.conn.execute('CREATE TABLE IF NOT EXISTS {} ('
+                                  'history_id INTEGER PRIMARY KEY, chat_id INTEGER NOT NULL, '
+                                  'creator_id INTEGER, closed_at REAL, data BLOB NOT NULL)'.format(table))
+            self.conn.execute('CREATE INDEX IF NOT EXISTS history_chat ON history (chat_id, history_id)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS history_creator ON history (chat_id, creator_id, history_id)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS history_closed_at ON history (closed_at)')
+            # Cotas migrated from before closed_at age from the day they were found
+            self.conn.execute('UPDATE history SET closed_at = ? WHERE closed_at IS NULL', (time.time(),))
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS members ('
+                              'user_id INTEGER NOT NULL, chat_id INTEGER NOT NULL, '
+                              'PRIMARY KEY (user_id, chat_id)) WITHOUT ROWID')
+
+    def claim_shard(self, index, shards):
+        # A partition only serves the layout it was written for
+        layout = '{}/{}'.format(index, shards)
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'shard'").fetchone()
+            if row is None:
+                self.set_shard(index, shards)
+            elif row[0] != layout:
+                raise ValueError('{} holds shard {}, not {}. Run with --rebalance first'.format(
+                    self.path, row[0], layout))
+
+    def set_shard(self, index, shards):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('shard', ?)",
+                              ('{}/{}'.format(index, shards),))
+
+    def is_empty(self):
+        with self.lock:
+            return self.conn.execute('SELECT 1 FROM chats LIMIT 1').fetchone() is None
+
+    def load(self, chat_id):
+        with self.lock:
+            row = self.conn.execute('SELECT data, revision FROM chats WHERE chat_id = ?', (chat_id,)).fetchone()
+        return self.decode_chat(*row) if row else None
+
+    def write_chat(self, cota_chat, data, revision):
+        # Only over the revision the snapshot was taken at, 0 if never stored
+        if revision:
+            return self.conn.execute('UPDATE chats SET data = ?, revision = revision + 1 '
+                                     'WHERE chat_id = ? AND revision = ?',
+                                     (data, cota_chat._id, revision)).rowcount == 1
+        return self.conn.execute('INSERT OR IGNORE INTO chats (chat_id, data, revision) VALUES (?, ?, 1)',
+                                 (cota_chat._id, data)).rowcount == 1
+
+    def save_many(self, chats):
+        rows = [(c,) + self.snapshot(c) for c in chats]
+        with self.lock:
+            # One transaction for all of them
+            with self.conn:
+                written = [row for row in rows if self.write_chat(*row)]
+            return self.wrote_chats(rows, written)
+
+    def compact(self):
+        super().compact()
+        self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.conn.execute('PRAGMA incremental_vacuum')
+
+    def write_with_history(self, cota_chat, entries):
+        data, revision = self.snapshot(cota_chat)
+        with self.lock:
+            with self.conn:
+                if not self.write_chat(cota_chat, data, revision):
+                    raise VersionConflict(cota_chat._id)
+                self.conn.executemany('INSERT INTO history (chat_id, creator_id, closed_at, data) VALUES (?, ?, ?, ?)',
+                                      [(e['chat_id'], e['creator_id'], e['closed_at'], e['data'].encode('utf-8'))
+                                       for e in entries])
+            cota_chat.revision = revision + 1
+
+    def history_where(self, chat_id, creator_id, since, until):
+        clauses, params = ['chat_id = ?'], [chat_id]
+        if creator_id is not None:
+            clauses.append('creator_id = ?')
+            params.append(creator_id)
+        if since is not None:
+            clauses.append('closed_at >= ?')
+            params.append(since)
+        if until is not None:
+            clauses.append('closed_at < ?')
+            params.append(until)
+        return ' AND '.join(clauses), params
+
+    def history_count(self, chat_id, creator_id=None, since=None, until=None):
+        where, params = self.history_where(chat_id, creator_id, since, until)
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM history WHERE ' + where, params).fetchone()[0]
+
+    def history_page(self, chat_id, offset, limit, creator_id=None, since=None, until=None):
+        # Newest first
+        where, params = self.history_where(chat_id, creator_id, since, until)
+        with self.lock:
+            rows = self.conn.execute('SELECT data FROM history WHERE ' + where +
+                                     ' ORDER BY history_id DESC LIMIT ? OFFSET ?',
+                                     params + [limit, offset]).fetchall()
+        return [decode_cota(data) for data, in rows]
+
+    def expire_history(self, before):
+        with self.conn:
+            if HISTORY_ARCHIVE:
+                self.conn.execute('INSERT INTO history_archive SELECT * FROM history WHERE closed_at < ?', (before,))
+            self.conn.execute('DELETE FROM history WHERE closed_at < ?', (before,))
+
+    def add_members(self, members):
+        with self.lock:
+            with self.conn:
+                self.conn.executemany('INSERT OR IGNORE INTO members (user_id, chat_id) VALUES (?, ?)', members)
+
+    def member_chats(self, user_id):
+        with self.lock:
+            return [r[0] for r in self.conn.execute('SELECT chat_id FROM members WHERE user_id = ?', (user_id,))]
+
+    def add_timer(self, due, chat_id, kind, payload):
+        with self.lock:
+            with self.conn:
+                return self.conn.execute('INSERT INTO timers (due, chat_id, kind, payload) VALUES (?, ?, ?, ?)',
+                                         (due, chat_id, kind, payload)).lastrowid
+
+    def due_timers(self, kind, now):
+        with self.lock:
+            return self.conn.execute('SELECT timer_id, chat_id, payload FROM timers '
+                                     'WHERE kind = ? AND due <= ? ORDER BY due', (kind, now)).fetchall()
+
+    def remove_timers(self, kind, timers):
+        with self.lock:
+            with self.conn:
+                self.conn.executemany('DELETE FROM timers WHERE timer_id = ?', [(t[0],) for t in timers])
+
+    def next_timer_due(self, kind):
+        with self.lock:
+            return self.conn.execute('SELECT MIN(due) FROM timers WHERE kind = ?', (kind,)).fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+class FileStore(Store):
+    """Plain files under a directory, for a single process without SQLite.
+
+    chats/<id>.json holds the chat's revision on the first line and its
+    snapshot after it, history/<id>.jsonl one closed cota per line. There is
+    no index: every history query reads the chat's whole file and filters it
+    in Python.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = RLock()
+        for directory in ('chats', 'history', 'history_archive'):
+            os.makedirs(os.path.join(root, directory), exist_ok=True)
+        self.timers_path = os.path.join(root, 'timers.json')
+        self.meta_path = os.path.join(root, 'meta.json')
+        self.members_path = os.path.join(root, 'members.json')
+        self.members = self.read_json(self.members_path, {})
+        self.timers = self.read_json(self.timers_path, [])
+        self.next_timer_id = max([t[0] for t in self.timers], default=0) + 1
+
+    def read_json(self, path, default):
+        try:
+            with open(path, 'rb') as f:
+                return json.loads(f.read().decode('utf-8'))
+        except FileNotFoundError:
+            return default
+
+    def replace(self, path, data):
+        # Readers see the old file or the new one, never half of it
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+
+    def chat_path(self, chat_id):
+        return os.path.join(self.root, 'chats', '{}.json'.format(chat_id))
+
+    def history_path(self, chat_id, table='history'):
+        return os.path.join(self.root, table, '{}.jsonl'.format(chat_id))
+
+    def claim_shard(self, index, shards):
+        layout = '{}/{}'.format(index, shards)
+        with self.lock:
+            meta = self.read_json(self.meta_path, {})
+            if 'shard' not in meta:
+                self.replace(self.meta_path, json.dumps({'shard': layout}).encode('utf-8'))
+            elif meta['shard'] != layout:
+                raise ValueError('{} holds shard {}, not {}'.format(self.root, meta['shard'], layout))
+
+    def is_empty(self):
+        return not os.listdir(os.path.join(self.root, 'chats'))
+
+    def read_chat(self, chat_id):
+        try:
+            with open(self.chat_path(chat_id), 'rb') as f:
+                revision, data = f.read().split(b'\n', 1)
+        except FileNotFoundError:
+            return None, 0
+        return data, int(revision)
+
+    def load(self, chat_id):
+        with self.lock:
+            data, revision = self.read_chat(chat_id)
+        return self.decode_chat(data, revision) if data else None
+
+    def write_chat(self, cota_chat, data, revision):
+        if self.read_chat(cota_chat._id)[1] != revision:
+            return False
+        self.replace(self.chat_path(cota_chat._id), str(revision + 1).encode('ascii') + b'\n' + data)
+        return True
 
-def load_state():
+    def save_many(self, chats):
+        rows = [(c,) + self.snapshot(c) for c in chats]
+        with self.lock:
+            return self.wrote_chats(rows, [row for row in rows if self.write_chat(*row)])
+
+    def write_with_history(self, cota_chat, entries):
+        data, revision = self.snapshot(cota_chat)
+        with self.lock:
+            if self.read_chat(cota_chat._id)[1] != revision:
+                raise VersionConflict(cota_chat._id)
+            # History first: after a crash in between a cota shows up twice rather than not at all
+            with open(self.history_path(cota_chat._id), 'a', encoding='utf-8') as f:
+                f.writelines(json.dumps(e, separators=(',', ':')) + '\n' for e in entries)
+            self.write_chat(cota_chat, data, revision)
+            cota_chat.revision = revision + 1
+
+    def history_entries(self, chat_id, table='history'):
+        try:
+            with open(self.history_path(chat_id, table), encoding='utf-8') as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def history_count(self, chat_id, creator_id=None, since=None, until=None):
+        with self.lock:
+            entries = self.history_entries(chat_id)
+        return sum(1 for e in entries if history_matches(e, creator_id, since, until))
+
+    def history_page(self, chat_id, offset, limit, creator_id=None, since=None, until=None):
+        with self.lock:
+            entries = self.history_entries(chat_id)
+        entries = [e for e in reversed(entries) if history_matches(e, creator_id, since, until)]
+        return [decode_cota(e['data'].encode('utf-8')) for e in entries[offset:offset + limit]]
+
+    def expire_history(self, before):
+        with self.lock:
+            for name in os.listdir(os.path.join(self.root, 'history')):
+                chat_id = int(name.split('.')[0])
+                entries = self.history_entries(chat_id)
+                expired = [e for e in entries if e['closed_at'] is not None and e['closed_at'] < before]
+                if not expired:
+                    continue
+                if HISTORY_ARCHIVE:
+                    with open(self.history_path(chat_id, 'history_archive'), 'a', encoding='utf-8') as f:
+                        f.writelines(json.dumps(e, separators=(',', ':')) + '\n' for e in expired)
+                kept = [e for e in entries if e not in expired]
+                self.replace(self.history_path(chat_id),
+                             ''.join(json.dumps(e, separators=(',', ':')) + '\n' for e in kept).encode('utf-8'))
+
+    def add_members(self, members):
+        with self.lock:
+            added = False
+            for user_id, chat_id in members:
+                chats = self.members.setdefault(str(user_id), [])
+                if chat_id not in chats:
+                    chats.append(chat_id)
+                    added = True
+            if added:
+                self.replace(self.members_path, json.dumps(self.members).encode('utf-8'))
+
+    def member_chats(self, user_id):
+        with self.lock:
+            return list(self.members.get(str(user_id), ()))
+
+    def write_timers(self):
+        self.replace(self.timers_path, json.dumps(self.timers).encode('utf-8'))
+
+    def add_timer(self, due, chat_id, kind, payload):
+        with self.lock:
+            timer_id = self.next_timer_id
+            self.next_timer_id += 1
+            self.timers.append([timer_id, due, chat_id, kind, payload])
+            self.write_timers()
+            return timer_id
+
+    def due_timers(self, kind, now):
+        with self.lock:
+            due = sorted((t for t in self.timers if t[3] == kind and t[1] <= now), key=lambda t: t[1])
+        return [(t[0], t[2], t[4]) for t in due]
+
+    def remove_timers(self, kind, timers):
+        timer_ids = {t[0] for t in timers}
+        with self.lock:
+            if timer_ids:
+                self.timers = [t for t in self.timers if t[0] not in timer_ids]
+                self.write_timers()
+
+    def next_timer_due(self, kind):
+        with self.lock:
+            return min((t[1] for t in self.timers if t[3] == kind), default=None)
+
+    def close(self):
+        pass
+
+class RespError(Exception):
+    pass
+
+def encode_command(args):
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode('utf-8')
+        parts += [b'$%d\r\n' % len(arg), arg, b'\r\n']
+    return b''.join(parts)
+
+class RespConnection:
+    def __init__(self, host, port, timeout=REDIS_TIMEOUT):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile('rb')
+
+    def execute(self, *commands):
+        # Pipelined: every command is sent before the first reply is read.
+        # Errors are returned in place so the remaining replies are still read.
+        self.sock.sendall(b''.join(encode_command(c) for c in commands))
+        return [self.read_reply() for _ in commands]
+
+    def read_reply(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError('Connection closed by the server')
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest.decode('utf-8')
+        if kind == b'-':
+            return RespError(rest.decode('utf-8'))
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            n = int(rest)
+            if n < 0:
+                return None
+            data = self.reader.read(n + 2)
+            return data[:-2]
+        if kind == b'*':
+            n = int(rest)
+            return None if n < 0 else [self.read_reply() for _ in range(n)]
+        raise RespError('Unexpected reply {!r}'.format(line))
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+class RespPool:
+    """Keeps up to size idle connections. Busy ones beyond that are opened on demand."""
+
+    def __init__(self, host, port, size=REDIS_POOL_SIZE):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.idle = []
+        self.lock = Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return RespConnection(self.host, self.port)
+
+    def release(self, conn):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def execute(self, *commands, conn=None):
+        own = conn is None
+        if own:
+            conn = self.acquire()
+        try:
+            replies = conn.execute(*commands)
+        except OSError:
+            # Whatever was half read makes this connection unusable
+            conn.close()
+            raise
+        if own:
+            self.release(conn)
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise reply
+        return replies
+
+    def close(self):
+        with self.lock:
+            for conn in self.idle:
+                conn.close()
+            self.idle = []
+
+class RedisStore(Store):
+    """Keeps everything on a Redis compatible server, shared by every process.
+
+    Chats are hashes with their data and revision. Writes go through
+    WATCH/MULTI/EXEC, so a chat is only written over the revision it was
+    loaded at even with several bot processes on the same keyspace.
+
+    History is a list per chat, so unfiltered pages are read by range but a
+    query by creator or date fetches the chat's whole list and filters it in
+    Python.
+    """
+
+    def __init__(self, url, prefix=REDIS_PREFIX):
+        parts = urlsplit(url)
+        self.pool = RespPool(parts.hostname or '127.0.0.1', parts.port or 6379)
+        self.prefix = prefix
+        self.shards = 1
+        # Only for the revisions of chats in memory, writes themselves are WATCHed
+        self.lock = Lock()
+
+    def key(self, *parts):
+        return ':'.join((self.prefix,) + tuple(str(p) for p in parts))
+
+    def timers_key(self, kind, chat_id=None, shards=None):
+        # Chats are shared, but timers are kept per shard so that a shard
+        # only ever fires the timers of its own chats
+        shards = shards or self.shards
+        if shards == 1:
+            return self.key('timers', kind)
+        index = self.shard if chat_id is None else shard_of(chat_id, shards)
+        return self.key('timers', kind, index)
+
+    def claim_shard(self, index, shards):
+        self.shard, self.shards = index, shards
+        meta = self.key('meta')
+
+        def build(revisions):
+            old = int(self.pool.execute(('HGET', meta, 'shards'))[0] or 1)
+            if old == shards:
+                return None
+            # The first shard to start after --shards changed moves every timer
+            commands = []
+            for kind in TIMER_KINDS:
+                keys = [self.timers_key(kind, i, old) for i in range(old)]
+                moved = defaultdict(list)
+                for key in keys:
+                    members = self.pool.execute(('ZRANGE', key, 0, -1, 'WITHSCORES'))[0]
+                    for member, score in zip(members[::2], members[1::2]):
+                        chat_id = json.loads(member)[1]
+                        moved[self.timers_key(kind, chat_id)] += [score, member]
+                commands.append(('DEL',) + tuple(keys))
+                commands += [('ZADD', key) + tuple(pairs) for key, pairs in moved.items()]
+            return commands + [('HSET', meta, 'shards', shards)]
+
+        self.transaction([meta], build)
+
+    def is_empty(self):
+        return self.pool.execute(('SCARD', self.key('chats')))[0] == 0
+
+    def load(self, chat_id):
+        data, revision = self.pool.execute(('HMGET', self.key('chat', chat_id), 'data', 'revision'))[0]
+        return self.decode_chat(data, int(revision)) if data else None
+
+    def transaction(self, keys, build, watch=()):
+        """Runs build(current revisions) inside MULTI/EXEC while keys are watched.
+
+        keys are chat hashes, whose revisions build gets. Other keys build
+        reads go in watch. build returns the commands to queue, or None to
+        give up. The whole thing is tried again when a watched key changed in
+        between.
+        """
+        conn = self.pool.acquire()
+        clean = False
+        try:
+            while True:
+                replies = self.pool.execute(('WATCH',) + tuple(keys) + tuple(watch),
+                                            *[('HGET', key, 'revision') for key in keys], conn=conn)
+                commands = build([int(r) if r else 0 for r in replies[1:]])
+                if not commands:
+                    self.pool.execute(('UNWATCH',), conn=conn)
+                    clean = True
+                    return False
+                replies = self.pool.execute(('MULTI',), *commands, ('EXEC',), conn=conn)
+                if replies[-1] is not None:
+                    clean = True
+                    return True
+        finally:
+            # After an error the connection may still be watching or inside
+            # MULTI, or be closed already. It is not worth finding out which.
+            if clean:
+                self.pool.release(conn)
+            else:
+                conn.close()
+
+    def chat_commands(self, cota_chat, data, revision):
+        return [('HSET', self.key('chat', cota_chat._id), 'data', data, 'revision', revision + 1),
+                ('SADD', self.key('chats'), cota_chat._id)]
+
+    def save_many(self, chats):
+        rows = [(c,) + self.snapshot(c) for c in chats]
+        written = []
+
+        def build(revisions):
+            written[:] = [row for row, stored in zip(rows, revisions) if stored == row[2]]
+            return [command for row in written for command in self.chat_commands(*row)]
+
+        with self.lock:
+            self.transaction([self.key('chat', c._id) for c, _, _ in rows], build)
+            return self.wrote_chats(rows, written)
+
+    def write_with_history(self, cota_chat, entries):
+        data, revision = self.snapshot(cota_chat)
+
+        def build(revisions):
+            if revisions[0] != revision:
+                return None
+            return self.chat_commands(cota_chat, data, revision) + [
+                ('RPUSH', self.key('history', cota_chat._id)) + tuple(json.dumps(e, separators=(',', ':'))
+                                                                      for e in entries),
+                ('SADD', self.key('history_chats'), cota_chat._id)]
+
+        with self.lock:
+            if not self.transaction([self.key('chat', cota_chat._id)], build):
+                raise VersionConflict(cota_chat._id)
+            cota_chat.revision = revision + 1
+
+    def history_entries(self, chat_id):
+        return [json.loads(e) for e in self.pool.execute(('LRANGE', self.key('history', chat_id), 0, -1))[0]]
+
+    def history_count(self, chat_id, creator_id=None, since=None, until=None):
+        if creator_id is None and since is None and until is None:
+            return self.pool.execute(('LLEN', self.key('history', chat_id)))[0]
+        return sum(1 for e in self.history_entries(chat_id) if history_matches(e, creator_id, since, until))
+
+    def history_page(self, chat_id, offset, limit, creator_id=None, since=None, until=None):
+        if creator_id is None and since is None and until is None:
+            # Newest are at the end of the list
+            rows = self.pool.execute(('LRANGE', self.key('history', chat_id), -(offset + limit), -(offset + 1)))[0]
+            entries = [json.loads(e) for e in reversed(rows)]
+        else:
+            entries = [e for e in reversed(self.history_entries(chat_id))
+                       if history_matches(e, creator_id, since, until)][offset:offset + limit]
+        return [decode_cota(e['data'].encode('utf-8')) for e in entries]
+
+    def expire_history(self, before):
+        for chat_id in self.pool.execute(('SMEMBERS', self.key('history_chats')))[0]:
+            self.expire_chat_history(int(chat_id), before)
+
+    def expire_chat_history(self, chat_id, before):
+        key = self.key('history', chat_id)
+
+        def build(revisions):
+            # The list is rewritten, so what other processes append meanwhile
+            # makes this try again
+            entries = self.history_entries(chat_id)
+            expired = [json.dumps(e, separators=(',', ':')) for e in entries
+                       if e['closed_at'] is not None and e['closed_at'] < before]
+            if not expired:
+                return None
+            kept = [json.dumps(e, separators=(',', ':')) for e in entries
+                    if e['closed_at'] is None or e['closed_at'] >= before]
+            commands = [('DEL', key)]
+            if kept:
+                commands.append(('RPUSH', key) + tuple(kept))
+            if HISTORY_ARCHIVE:
+                commands.append(('RPUSH', self.key('history_archive', chat_id)) + tuple(expired))
+            return commands
+
+        self.transaction([], build, watch=[key])
+
+    def add_members(self, members):
+        self.pool.execute(*[('SADD', self.key('members', user_id), chat_id) for user_id, chat_id in members])
+
+    def member_chats(self, user_id):
+        return [int(c) for c in self.pool.execute(('SMEMBERS', self.key('members', user_id)))[0]]
+
+    def add_timer(self, due, chat_id, kind, payload):
+        timer_id = self.pool.execute(('INCR', self.key('timer_id')))[0]
+        self.pool.execute(('ZADD', self.timers_key(kind, chat_id), repr(due),
+                           json.dumps([timer_id, chat_id, payload])))
+        return timer_id
+
+    def due_timers(self, kind, now):
+        members = self.pool.execute(('ZRANGEBYSCORE', self.timers_key(kind), '-inf', repr(now)))[0]
+        return [tuple(json.loads(member)) for member in members]
+
+    def claim_timers(self, kind, timers):
+        # Processes sharing the timers race for them: only the one whose ZREM
+        # removed the timer handles it
+        if not timers:
+            return []
+        key = self.timers_key(kind)
+        won = self.pool.execute(*[('ZREM', key, json.dumps(list(t))) for t in timers])
+        return [t for t, removed in zip(timers, won) if removed == 1]
+
+    def remove_timers(self, kind, timers):
+        if timers:
+            self.pool.execute(('ZREM', self.timers_key(kind)) + tuple(json.dumps(list(t)) for t in timers))
+
+    def next_timer_due(self, kind):
+        first = self.pool.execute(('ZRANGE', self.timers_key(kind), 0, 0, 'WITHSCORES'))[0]
+        return float(first[1]) if first else None
+
+    def close(self):
+        self.pool.close()
+
+def open_store(shard=None):
+    if STORE == 'redis':
+        return RedisStore(REDIS_URL)
+    path = shard_db_file(*shard) if shard else DB_FILE
+    if STORE == 'file':
+        return FileStore(os.path.splitext(path)[0] + '.files')
+    return ChatStore(path)
+
+class StateFlusher:
+    """Coalesces save_state() calls and writes dirty chats from a background thread.
+
+    Chats the store refuses because another process wrote them first are
+    handed to on_conflict.
+    """
+
+    def __init__(self, store, interval=FLUSH_INTERVAL, max_pending=FLUSH_MAX_PENDING, on_conflict=None):
+        self.store = store
+        self.on_conflict = on_conflict
+        self.interval = interval
+        self.max_pending = max_pending
+        self.dirty = {}
+        self.writing = set()
+        # (user_id, chat_id) seen since the last flush, written along with the chats
+        self.members = set()
+        self.mutations = 0
+        self.failed = 0
+        self.running = True
+        self.cond = Condition()
+        self.stats = {'flushes': 0, 'chats_written': 0, 'failures': 0, 'conflicts': 0,
+                      'last_flush_seconds': 0.0, 'max_flush_seconds': 0.0}
+        self.thread = Thread(target=self.run, name='state-flusher', daemon=True)
+        self.thread.start()
+
+    def mark_dirty(self, cota_chat):
+        with self.cond:
+            self.dirty[cota_chat._id] = cota_chat
+            self.mutations += 1
+            self.cond.notify()
+
+    def add_member(self, user_id, chat_id):
+        with self.cond:
+            self.members.add((user_id, chat_id))
+            self.cond.notify()
+
+    def pending(self, chat_id):
+        # Changes not in the store yet
+        with self.cond:
+            return chat_id in self.dirty or chat_id in self.writing
+
+    def backlog(self):
+        with self.cond:
+            return len(self.dirty)
+
+    def metrics(self):
+        return dict(self.stats, backlog=self.backlog())
+
+    def run(self):
+        shutdown_failures = 0
+        while True:
+            with self.cond:
+                while self.running and not self.dirty and not self.members:
+                    self.cond.wait()
+                if not self.dirty and not self.members:
+                    return
+                deadline = time.monotonic() + self.interval
+                while self.running and self.mutations < self.max_pending:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                chats = list(self.dirty.values())
+                self.writing = set(self.dirty)
+                self.dirty.clear()
+                members, self.members = self.members, set()
+                self.mutations = 0
+            saved = True
+            if members:
+                saved = self.write_members(members)
+            if chats:
+                saved = self.write(chats) and saved
+            with self.cond:
+                self.writing = set()
+                if saved:
+                    self.failed = 0
+                    continue
+                self.failed += 1
+                if not self.running:
+                    shutdown_failures += 1
+                    if shutdown_failures >= FLUSH_SHUTDOWN_ATTEMPTS:
+                        logger.error('Giving up on %d chats and %d members that could not be saved',
+                                     len(self.dirty), len(self.members))
+                        self.dirty.clear()
+                        self.members.clear()
+                        return
+                    delay = FLUSH_RETRY
+                else:
+                    delay = min(FLUSH_RETRY * 2 ** (self.failed - 1), FLUSH_RETRY_MAX)
+                # Shutting down cuts a long back-off short
+                deadline = time.monotonic() + delay
+                running = self.running
+                while self.running == running:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+
+    def write_members(self, members):
+        try:
+            self.store.add_members(list(members))
+        except Exception:
+            logger.exception('Could not save %d members', len(members))
+            self.stats['failures'] += 1
+            with self.cond:
+                self.members |= members
+            return False
+        return True
+
+    def write(self, chats):
+        start = time.monotonic()
+        try:
+            conflicts = self.store.save_many(chats)
+        except Exception:
+            logger.exception('Could not save %d chats', len(chats))
+            self.stats['failures'] += 1
+            with self.cond:
+                for cota_chat in chats:
+                    self.dirty.setdefault(cota_chat._id, cota_chat)
+            return False
+        for cota_chat in conflicts:
+            logger.warning('Chat %d was changed by another process, dropping this copy', cota_chat._id)
+            self.stats['conflicts'] += 1
+            with self.cond:
+                if self.dirty.get(cota_chat._id) is cota_chat:
+                    del self.dirty[cota_chat._id]
+            if self.on_conflict:
+                self.on_conflict(cota_chat)
+        elapsed = time.monotonic() - start
+        metrics.observe('cotabot_flush_seconds', elapsed)
+        self.stats['flushes'] += 1
+        self.stats['chats_written'] += len(chats) - len(conflicts)
+        self.stats['last_flush_seconds'] = elapsed
+        self.stats['max_flush_seconds'] = max(self.stats['max_flush_seconds'], elapsed)
+        return True
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join()
+
+store = None
+flusher = None
+cota_chats = ChatRegistry()
+
+@metrics.collector
+def state_metrics():
+    chats = cota_chats.values()
+    samples = [('cotabot_chats_loaded', 'gauge', {}, len(chats)),
+               ('cotabot_iboxes', 'gauge', {}, sum(len(c.iBoxes) for c in chats))] + \
+              [('cotabot_registry_total', 'counter', {'event': k}, v) for k, v in cota_chats.stats.items()]
+    if flusher:
+        samples += [('cotabot_flush_backlog', 'gauge', {}, flusher.backlog()),
+                    ('cotabot_flush_failures_total', 'counter', {}, flusher.stats['failures']),
+                    ('cotabot_flush_conflicts_total', 'counter', {}, flusher.stats['conflicts'])]
+    return samples
+
+# (index, shards) of this process
+own_shard = (0, 1)
+
+def owns_chat(chat_id):
+    return shard_of(chat_id, own_shard[1]) == own_shard[0]
+
+def load_state(shard=None):
+    global store, flusher, cota_chats, own_shard
+    own_shard = shard or (0, 1)
+    # Only SQLite keeps one database per shard
+    partitioned = STORE == 'sqlite'
+    if shard:
+        if partitioned and holds_chats(DB_FILE):
+            raise ValueError('{} still holds chats. Run with --rebalance --shards {} first'.format(DB_FILE, shard[1]))
+        store = open_store(shard)
+        store.claim_shard(*shard)
+    else:
+        if partitioned and any(holds_chats(path) for path in shard_db_files()):
+            raise ValueError('Chats are split in shard databases. Run with --rebalance --shards 1 first')
+        store = open_store()
+        store.claim_shard(0, 1)
+        store.migrate_legacy(LEGACY_DB_FILE)
+    cota_chats = ChatRegistry(store)
+    flusher = cota_chats.flusher = StateFlusher(store, on_conflict=chat_conflict)
+
+CONFLICT_MESSAGE = ('Não deu para salvar as últimas alterações, o chat foi alterado ao mesmo tempo '
+                    'em outro lugar. Confira e tente de novo.')
+
+def chat_conflict(cota_chat):
+    # Another process wrote this chat first. What changed here since is lost,
+    # the chat hears about it and its boxes show what was kept.
+    cota_chats.discard(cota_chat)
+    if outbox is None:
+        return
+    outbox.post_message(cota_chat._id, CONFLICT_MESSAGE)
     try:
-        with open('cotas_db.pickle', 'rb') as f:
-            global cota_chats
-            cota_chats = pickle.load(f)
-    except:
-        cota_chats = {}
+        fresh = cota_chats.get(cota_chat._id)
+        with fresh.lock:
+            fresh.update(outbox)
+    except Exception:
+        logger.exception('Chat %d could not be shown again after a conflict', cota_chat._id)
 
-def save_state():
-    with open('cotas_db.pickle', 'wb') as f:
-        pickle.dump(cota_chats, f)
+def save_state(cota_chat):
+    flusher.mark_dirty(cota_chat)
 
-def main():
+def close_state():
+    flusher.stop()
+    store.close()
 
-    load_state()
+def start_services(bot):
+    global outbox, scheduler
+    outbox = Outbox(bot)
+    scheduler = Scheduler()
+    wakeups.clear()
+    # Quick messages whose deletion was due while the bot was down
+    due = store.next_timer_due('delete_message')
+    if due:
+        wake_at(due, delete_expired_messages)
+    # And deadlines and reminders, also those missed meanwhile
+    due = [d for d in (store.next_timer_due(kind) for kind in COTA_TIMERS) if d]
+    if due:
+        wake_cota_timers(min(due))
+
+def stop_services():
+    scheduler.stop()
+    outbox.stop()
+
+ASYNC_WORKERS = 8
+CHAT_QUEUE_IDLE = 60
+
+class ChatTaskRunner:
+    """Runs handlers from an asyncio loop, with one serial queue per chat.
+
+    Updates of the same chat are handled in arrival order, while different
+    chats are handled concurrently on the loop's executor.
+    """
+
+    def __init__(self, workers=ASYNC_WORKERS):
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(ThreadPoolExecutor(workers, thread_name_prefix='chat-task'))
+        self.queues = {}
+        self.tasks = {}
+        self.thread = Thread(target=self.loop.run_forever, name='chat-tasks', daemon=True)
+        self.thread.start()
+
+    def wrap(self, handler):
+
+        @wraps(handler)
+        def submit(bot, update, *args, **kwargs):
+            call = partial(handler, bot, update, *args, **kwargs)
+            self.loop.call_soon_threadsafe(self.enqueue, route_key(update), call)
+
+        return submit
+
+    def enqueue(self, chat_id, call):
+        queue = self.queues.get(chat_id)
+        if queue is None:
+            queue = self.queues[chat_id] = asyncio.Queue()
+            self.tasks[chat_id] = self.loop.create_task(self.consume(chat_id, queue))
+        queue.put_nowait(call)
 
+    async def consume(self, chat_id, queue):
+        while True:
+            try:
+                call = await asyncio.wait_for(queue.get(), CHAT_QUEUE_IDLE)
+            except asyncio.TimeoutError:
+                if queue.empty():
+                    del self.queues[chat_id]
+                    del self.tasks[chat_id]
+                    return
+                continue
+            try:
+                await self.loop.run_in_executor(None, call)
+            except Exception:
+                logger.exception('Handler for chat %s failed', chat_id)
+            finally:
+                queue.task_done()
+
+    def depth(self):
+        return sum(queue.qsize() for queue in list(self.queues.values()))
+
+    async def shutdown(self):
+        await asyncio.gather(*[queue.join() for queue in self.queues.values()])
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self, timeout=30):
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result(timeout)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+class ChatThreadRunner:
+    """Runs handlers on a thread pool, with one serial queue per chat.
+
+    PTB's dispatcher handles one update at a time, so in threaded mode it
+    only hands updates over. The updates of a chat are handled in arrival
+    order, those of different chats concurrently.
+    """
+
+    def __init__(self, workers):
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='chat-worker')
+        self.cond = Condition()
+        # Chats with a worker draining their queue, which may be empty while the last call runs
+        self.queues = {}
+
+    def wrap(self, handler):
+
+        @wraps(handler)
+        def submit(bot, update, *args, **kwargs):
+            self.submit(route_key(update), partial(handler, bot, update, *args, **kwargs))
+
+        return submit
+
+    def submit(self, key, call):
+        with self.cond:
+            queue = self.queues.get(key)
+            if queue is not None:
+                queue.append(call)
+                return
+            self.queues[key] = deque([call])
+        self.executor.submit(self.drain, key)
+
+    def drain(self, key):
+        while True:
+            with self.cond:
+                queue = self.queues[key]
+                if not queue:
+                    del self.queues[key]
+                    self.cond.notify_all()
+                    return
+                call = queue.popleft()
+            try:
+                call()
+            except Exception:
+                logger.exception('Handler for chat %s failed', key)
+
+    def depth(self):
+        with self.cond:
+            return sum(len(queue) for queue in self.queues.values())
+
+    def stop(self, timeout=30):
+        with self.cond:
+            self.cond.wait_for(lambda: not self.queues, timeout)
+        self.executor.shutdown()
+
+WEBHOOK_MAX_PENDING = 100
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        server = self.server
+        # Compared in constant time, so the secret can't be guessed a byte at a time
+        token = self.headers.get('X-Telegram-Bot-Api-Secret-Token') or ''
+        if not (hmac.compare_digest(self.path.encode('utf-8'), server.url_path.encode('utf-8'))
+                & hmac.compare_digest(token.encode('utf-8'), server.secret.encode('utf-8'))):
+            self.send_error(403)
+            return
+        if server.pending() >= server.max_pending:
+            # Telegram keeps the update and delivers it again later
+            self.send_response(503)
+            self.send_header('Retry-After', '1')
+            self.end_headers()
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            update = Update.de_json(json.loads(self.rfile.read(length).decode('utf-8')), server.bot)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            # Not JSON, or JSON that is not an update
+            update = None
+        if update is None:
+            self.send_error(400)
+            return
+        server.update_queue.put(update)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+class WebhookServer(ThreadingHTTPServer):
+    """Receives updates from Telegram and puts them on the dispatcher's queue.
+
+    Requests must come to /<secret> and carry the same secret in the
+    X-Telegram-Bot-Api-Secret-Token header. While more than max_pending
+    updates wait to be handled, new ones are refused with 503 so Telegram
+    backs off instead of the queue growing without bound.
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, bot, update_queue, secret, pending, max_pending=WEBHOOK_MAX_PENDING):
+        super().__init__(address, WebhookRequestHandler)
+        self.bot = bot
+        self.update_queue = update_queue
+        self.secret = secret
+        self.url_path = '/' + secret
+        self.pending = pending
+        self.max_pending = max_pending
+
+def set_webhook(bot, url, secret):
+    # python-telegram-bot 11 does not know about secret_token yet
+    bot._request.post('{}/setWebhook'.format(bot.base_url),
+                      {'url': url, 'secret_token': secret})
+
+def start_webhook(updater, listen, port, secret, pending, webhook_url=None):
+    server = WebhookServer((listen, port), updater.bot, updater.update_queue, secret, pending)
+    # Same as Updater.start_webhook, so that idle() and stop() work as usual
+    updater.running = True
+    updater.httpd = server
+    updater._init_thread(updater.dispatcher.start, 'dispatcher')
+    updater._init_thread(server.serve_forever, 'webhook')
+    if webhook_url:
+        set_webhook(updater.bot, webhook_url.rstrip('/') + server.url_path, secret)
+    logger.info('Listening for updates on %s:%d', listen, port)
+
+PROFILE_INTERVAL = 0.005
+PROFILE_DEPTH = 30
+
+class SamplingProfiler:
+    """Samples the stacks of every thread while running.
+
+    Samples are kept as collapsed stacks ("outer;inner count" lines), ready
+    for flamegraph tools. Threads parked on a lock or in select are skipped.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL, depth=PROFILE_DEPTH):
+        self.interval = interval
+        self.depth = depth
+        self.samples = Counter()
+        self.running = False
+        self.thread = None
+        self.lock = Lock()
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return False
+            self.running = True
+            self.samples = Counter()
+            self.thread = Thread(target=self.run, name='profiler', daemon=True)
+            self.thread.start()
+            return True
+
+    def stop(self):
+        with self.lock:
+            if not self.running:
+                return False
+            self.running = False
+        self.thread.join()
+        return True
+
+    def run(self):
+        me = get_ident()
+        while self.running:
+            for ident, frame in sys._current_frames().items():
+                if ident == me or frame.f_code.co_filename.endswith(('threading.py', 'selectors.py')):
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.depth:
+                    stack.append('{}:{}'.format(frame.f_code.co_name, frame.f_lineno))
+                    frame = frame.f_back
+                self.samples[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def report(self):
+        return ''.join('{} {}\n'.format(stack, n) for stack, n in self.samples.most_common())
+
+profiler = SamplingProfiler()
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    # GET /metrics, and /profile/start, /profile/stop, /profile to toggle and read the profiler
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.reply(metrics.render(), 'text/plain; version=0.0.4')
+        elif self.path == '/profile/start':
+            self.reply('started\n' if profiler.start() else 'already running\n')
+        elif self.path == '/profile/stop':
+            profiler.stop()
+            self.reply(profiler.report())
+        elif self.path == '/profile':
+            self.reply(profiler.report())
+        else:
+            self.send_error(404)
+
+    def reply(self, text, content_type='text/plain'):
+        payload = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+def start_metrics_server(listen, port):
+    server = ThreadingHTTPServer((listen, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info('Serving metrics on http://%s:%d/metrics', listen, port)
+    return server
+
+# Sharding ----
+
+def shard_of(chat_id, shards):
+    return chat_id % shards
+
+def shard_db_file(index, shards):
+    if shards == 1:
+        return DB_FILE
+    root, ext = os.path.splitext(DB_FILE)
+    return '{}.shard{}{}'.format(root, index, ext)
+
+def shard_db_files():
+    root, ext = os.path.splitext(DB_FILE)
+    return sorted(glob.glob('{}.shard*{}'.format(root, ext)))
+
+def holds_chats(path):
+    if not os.path.exists(path):
+        return False
+    store = ChatStore(path)
+    try:
+        return not store.is_empty()
+    finally:
+        store.close()
+
+def rebalance(shards):
+    """Moves every chat, with its history and timers, to the database of the shard owning it.
+
+    The bot must be stopped. Each move between two databases is one
+    transaction, so an interrupted rebalance can simply be run again.
+    """
+    if STORE != 'sqlite':
+        raise ValueError('Only the sqlite store is partitioned, {} has nothing to rebalance'.format(STORE))
+    legacy = ChatStore(DB_FILE)
+    legacy.migrate_legacy(LEGACY_DB_FILE)
+    legacy.close()
+
+    targets = [shard_db_file(i, shards) for i in range(shards)]
+    for index, target in enumerate(targets):
+        store = ChatStore(target)
+        store.set_shard(index, shards)
+        store.close()
+
+    moved = 0
+    for source in [DB_FILE] + shard_db_files():
+        conn = ChatStore(source).conn
+        conn.create_function('shard_of', 2, shard_of, deterministic=True)
+        for index, target in enumerate(targets):
+            if os.path.abspath(target) == os.path.abspath(source):
+                continue
+            where = 'WHERE shard_of(chat_id, {}) = {}'.format(shards, index)
+            conn.execute('ATTACH DATABASE ? AS target', (target,))
+            try:
+                with conn:
+                    moved += conn.execute('INSERT OR REPLACE INTO target.chats SELECT * FROM chats ' + where).rowcount
+                    for table in ('history', 'history_archive'):
+                        conn.execute('INSERT INTO target.{0} (chat_id, creator_id, closed_at, data) '
+                                     'SELECT chat_id, creator_id, closed_at, data FROM {0} {1} '
+                                     'ORDER BY history_id'.format(table, where))
+                    conn.execute('INSERT INTO target.timers (due, chat_id, kind, payload) '
+                                 'SELECT due, chat_id, kind, payload FROM timers ' + where)
+                    conn.execute('INSERT OR IGNORE INTO target.members SELECT * FROM members ' + where)
+                    for table in ('chats', 'history', 'history_archive', 'timers', 'members'):
+                        conn.execute('DELETE FROM {} {}'.format(table, where))
+            finally:
+                conn.execute('DETACH DATABASE target')
+        conn.close()
+        if source != DB_FILE and source not in targets:
+            # A shard that no longer exists, everything in it was moved
+            for path in (source, source + '-wal', source + '-shm'):
+                if os.path.exists(path):
+                    os.remove(path)
+    logger.info('Moved %d chats, %d shards', moved, shards)
+
+def route_key(update):
+    # Updates without a chat, like inline queries, go by user
+    if update.effective_chat:
+        return update.effective_chat.id
+    return update.effective_user.id if update.effective_user else 0
+
+# Seconds between checks that every shard worker is still running
+SHARD_CHECK_INTERVAL = 5
+
+class ShardRouter:
+    """Hands each update to the worker process owning its chat.
+
+    Every worker has its own database partition and is fed by one queue, so
+    the updates of a chat keep their arrival order. A worker that dies is
+    started again, with the updates still waiting in its queue.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.context = multiprocessing.get_context('spawn')
+        self.queues = [self.context.Queue() for _ in range(args.shards)]
+        self.ready = self.context.Queue()
+        self.workers = [self.spawn(index) for index in range(args.shards)]
+        self.lock = Lock()
+        self.checked = Condition(self.lock)
+        self.stopping = False
+        self.restarts = [0] * args.shards
+        self.supervisor = Thread(target=self.supervise, name='shard-supervisor', daemon=True)
+
+    def spawn(self, index):
+        return self.context.Process(target=run_shard, args=(index, self.args, self.queues[index], self.ready),
+                                    name='shard-{}'.format(index))
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        # Every worker reports once, with the reason it could not start if it failed
+        failures = [failure for failure in (self.ready.get() for _ in self.workers) if failure]
+        if failures:
+            self.stop()
+            raise RuntimeError('Shards failed to start: ' + '; '.join(failures))
+        self.supervisor.start()
+
+    def supervise(self):
+        with self.lock:
+            while not self.stopping:
+                self.checked.wait(SHARD_CHECK_INTERVAL)
+                if self.stopping:
+                    return
+                self.report_restarts()
+                for index, worker in enumerate(self.workers):
+                    if not worker.is_alive():
+                        self.restart(index, worker)
+
+    def report_restarts(self):
+        while True:
+            try:
+                failure = self.ready.get_nowait()
+            except Empty:
+                return
+            if failure:
+                logger.error('Restart failed, %s', failure)
+
+    def restart(self, index, worker):
+        # Called with the lock held, so route() does not put into the old queue meanwhile.
+        # A worker killed while reading may leave its queue locked, so the
+        # updates waiting in it are moved to a new one.
+        logger.error('Shard %d died with exit code %s, %d updates waiting, restarting it',
+                     index, worker.exitcode, self.queues[index].qsize())
+        old, new = self.queues[index], self.context.Queue()
+        while True:
+            try:
+                new.put(old.get_nowait())
+            except Empty:
+                break
+        if old.qsize():
+            logger.error('Shard %d: %d updates could not be recovered', index, old.qsize())
+        self.queues[index] = new
+        self.workers[index] = self.spawn(index)
+        self.workers[index].start()
+        self.restarts[index] += 1
+
+    def route(self, bot, update):
+        with self.lock:
+            self.queues[shard_of(route_key(update), len(self.queues))].put(update.to_dict())
+
+    def pending(self):
+        return sum(queue.qsize() for queue in self.queues)
+
+    def stop(self):
+        with self.lock:
+            self.stopping = True
+            self.checked.notify()
+        if self.supervisor.is_alive():
+            self.supervisor.join()
+        for queue in self.queues:
+            queue.put(None)
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.join()
+
+def run_shard(index, args, updates, ready):
+    # Ctrl-C and systemd's SIGTERM reach the whole process group, the front
+    # decides when workers stop so that they go through shutdown()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    configure(args)
+    try:
+        load_state((index, args.shards))
+    except Exception as e:
+        ready.put('shard {}: {}'.format(index, e))
+        return
+    runner, handler = make_runner(args)
+    updater = make_updater(args, 1)
+    start_services(updater.bot)
+    add_handlers(updater.dispatcher, handler)
+    metrics_server = None
+    if args.metrics_port:
+        metrics_server = start_metrics_server(args.metrics_listen, args.metrics_port + 1 + index)
+    dispatcher = Thread(target=updater.dispatcher.start, name='dispatcher')
+    dispatcher.start()
+    logger.info('Shard %d/%d ready', index, args.shards)
+    ready.put(None)
+
+    front = multiprocessing.parent_process()
+    while True:
+        try:
+            data = updates.get(timeout=1)
+        except Empty:
+            # Nobody is left to stop this worker if the front was killed
+            if front.is_alive():
+                continue
+            logger.error('Shard %d lost the front process, stopping', index)
+            break
+        if data is None:
+            break
+        updater.update_queue.put(Update.de_json(data, updater.bot))
+
+    updater.dispatcher.stop()
+    dispatcher.join()
+    shutdown(runner, metrics_server)
+
+def run_sharded(args):
+    router = ShardRouter(args)
+    router.start()
+    # A single dispatcher thread routes updates in the order they arrive
+    updater = make_updater(args, 1)
+    updater.dispatcher.add_handler(TypeHandler(Update, router.route))
+    updater.dispatcher.add_error_handler(error)
+
+    @metrics.collector
+    def shard_metrics():
+        return [('cotabot_shard_queue', 'gauge', {'shard': i}, q.qsize()) for i, q in enumerate(router.queues)] + \
+               [('cotabot_shard_restarts_total', 'counter', {'shard': i}, n) for i, n in enumerate(router.restarts)]
+
+    metrics_server = None
+    if args.metrics_port:
+        metrics_server = start_metrics_server(args.metrics_listen, args.metrics_port)
+    start_ingress(updater, args, lambda: updater.update_queue.qsize() + router.pending())
+    updater.idle()
+    router.stop()
+    if metrics_server:
+        metrics_server.shutdown()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='CotaBot')
+    parser.add_argument('--mode', choices=('threaded', 'async'), default='threaded',
+                        help='run handlers from per-chat queues on a thread pool (default) or an asyncio loop')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of threads handling updates of different chats at once (default: 4)')
+    parser.add_argument('--ingress', choices=('polling', 'webhook'), default='polling',
+                        help='how updates are received (default: polling)')
+    parser.add_argument('--listen', default='127.0.0.1',
+                        help='webhook listen address (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8443,
+                        help='webhook listen port (default: 8443)')
+    parser.add_argument('--secret', default=os.environ.get('COTABOT_WEBHOOK_SECRET'),
+                        help='webhook secret token (default: $COTABOT_WEBHOOK_SECRET, or random '
+                             'with --webhook-url)')
+    parser.add_argument('--webhook-url',
+                        help='public base URL to register with Telegram, e.g. https://example.com')
+    parser.add_argument('--base-url', default=None,
+                        help='Bot API base URL, e.g. a local fake_telegram.py server')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve /metrics and the profiler toggle on this port (default: off)')
+    parser.add_argument('--metrics-listen', default='127.0.0.1',
+                        help='metrics listen address (default: 127.0.0.1)')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='worker processes, each owning the chats with chat id %% shards == its index '
+                             'and its own database (default: 1, everything in this process)')
+    parser.add_argument('--rebalance', action='store_true',
+                        help='move chats between shard databases for --shards and exit, with the bot stopped')
+    parser.add_argument('--store', choices=('sqlite', 'file', 'redis'), default=STORE,
+                        help='where chats are kept (default: {})'.format(STORE))
+    parser.add_argument('--redis-url', default=os.environ.get('COTABOT_REDIS_URL', REDIS_URL),
+                        help='server for --store redis (default: $COTABOT_REDIS_URL or {})'.format(REDIS_URL))
+    parser.add_argument('--user-rate', type=float, default=USER_RATE,
+                        help='commands per second a user may send before they are dropped (default: no limit)')
+    args = parser.parse_args()
+    if args.ingress == 'webhook' and not args.secret and not args.webhook_url:
+        # A random secret would only be known to this process
+        parser.error('--ingress webhook needs --secret (or $COTABOT_WEBHOOK_SECRET) '
+                     'unless --webhook-url registers the webhook')
+    return args
+
+def configure(args):
+    # Shard workers are spawned, they do not see the parent's module globals
+    global STORE, REDIS_URL
+    STORE = args.store
+    REDIS_URL = args.redis_url
+    throttle.rate = args.user_rate
+
+def make_runner(args):
+    # The dispatcher only hands updates over to the runner
+    if args.mode == 'async':
+        runner = ChatTaskRunner(args.workers)
+    else:
+        runner = ChatThreadRunner(args.workers)
+    return runner, runner.wrap
+
+def make_updater(args, workers):
     # Create the Updater and pass it your bot's token.
     # Make sure to set use_context=True to use the new context based callbacks
     # Post version 12 this will no longer be necessary
-    updater = Updater("692336058:AAGFMBpvydprPwlYgQjwMM1QK66oH41qXfA")
+    return Updater("692336058:AAGFMBpvydprPwlYgQjwMM1QK66oH41qXfA",
+                   base_url=args.base_url,
+                   workers=workers,
+                   request_kwargs={'con_pool_size': OUTBOX_WORKERS + args.workers + 4})
 
-    # Get the dispatcher to register handlers
-    dp = updater.dispatcher
+def add_handlers(dp, handler):
+    dp.add_handler(CommandHandler('help', handler(cota_help)))
 
-    # add handlers
-    dp.add_handler(CommandHandler('help', cota_help))
+    dp.add_handler(CommandHandler('cotas', handler(cotas)))
+
+    dp.add_handler(CommandHandler('cota', handler(bulk_participants)))
+
+    dp.add_handler(CommandHandler('saldo', handler(settlement)))
+
+    dp.add_handler(CommandHandler('quitar', handler(payments)))
+
+    dp.add_handler(CommandHandler('prazo', handler(deadline)))
 
-    dp.add_handler(CommandHandler('cotas', cotas))
+    dp.add_handler(CommandHandler('lembrete', handler(reminders)))
 
-    dp.add_handler(CommandHandler('cotaversion', cota_version))
+    dp.add_handler(CommandHandler('cotaversion', handler(cota_version)))
 
-    dp.add_handler(MessageHandler(Filters.text, handle_message))
+    dp.add_handler(InlineQueryHandler(handler(inline_search)))
+
+    dp.add_handler(MessageHandler(Filters.text, handler(handle_message)))
     
-    dp.add_handler(CallbackQueryHandler(callback_handler))
+    dp.add_handler(CallbackQueryHandler(handler(callback_handler)))
 
     # log all errors
     dp.add_error_handler(error)
 
+def start_ingress(updater, args, pending):
+    if args.ingress == 'webhook':
+        secret = args.secret or secrets.token_urlsafe(32)
+        start_webhook(updater, args.listen, args.port, secret, pending, args.webhook_url)
+    else:
+        updater.start_polling()
+
+def shutdown(runner, metrics_server):
+    # Send and write whatever is still pending before exiting
+    runner.stop()
+    stop_services()
+    close_state()
+    profiler.stop()
+    if metrics_server:
+        metrics_server.shutdown()
+
+def run_bot(args):
+    load_state()
+    runner, handler = make_runner(args)
+    updater = make_updater(args, 1)
+    start_services(updater.bot)
+
+    @metrics.collector
+    def update_metrics():
+        return [('cotabot_update_queue', 'gauge', {}, updater.update_queue.qsize()),
+                ('cotabot_chat_task_queue', 'gauge', {}, runner.depth())]
+
+    metrics_server = None
+    if args.metrics_port:
+        metrics_server = start_metrics_server(args.metrics_listen, args.metrics_port)
+
+    # add handlers
+    add_handlers(updater.dispatcher, handler)
+
     # Start the Bot
-    updater.start_polling()
+    start_ingress(updater, args, lambda: updater.update_queue.qsize() + runner.depth())
 
     # Run the bot until you press Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT. This should be used most of the time, since
     # start_polling() is non-blocking and will stop the bot gracefully.
     updater.idle()
 
+    shutdown(runner, metrics_server)
+
+def main():
+    args = parse_args()
+    configure(args)
+    if args.rebalance:
+        rebalance(args.shards)
+    elif args.shards > 1:
+        run_sharded(args)
+    else:
+        run_bot(args)
+
 
 if __name__ == '__main__':
     main()
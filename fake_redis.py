@@ -0,0 +1,280 @@
+import argparse
+import bisect
+import socketserver
+import threading
+from collections import defaultdict
+
+# Offline stand-in for a Redis server, with just the commands the redis
+# store of cotabot uses. Run it and point one or more bots at it:
+#
+#   python fake_redis.py --port 6379
+#   python cotabot.py --store redis --redis-url redis://127.0.0.1:6379
+
+class RespError(Exception):
+    pass
+
+class FakeRedis:
+    """The keyspace. Every write bumps the key's revision, which is what WATCH looks at."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = {}
+        self.revisions = defaultdict(int)
+
+    def revision(self, key):
+        return self.revisions[key]
+
+    def touch(self, key):
+        self.revisions[key] += 1
+
+    def get(self, key, kind, create=False):
+        value = self.data.get(key)
+        if value is None:
+            if not create:
+                return kind()
+            value = self.data[key] = kind()
+        elif not isinstance(value, kind):
+            raise RespError('WRONGTYPE Operation against a key holding the wrong kind of value')
+        return value
+
+    def execute(self, name, args):
+        method = getattr(self, 'cmd_' + name.lower(), None)
+        if method is None:
+            raise RespError("ERR unknown command '{}'".format(name))
+        return method(*args)
+
+    def cmd_ping(self, *args):
+        return args[0] if args else 'PONG'
+
+    def cmd_flushall(self):
+        for key in self.data:
+            self.touch(key)
+        self.data.clear()
+        return 'OK'
+
+    def cmd_del(self, *keys):
+        removed = 0
+        for key in keys:
+            if self.data.pop(key, None) is not None:
+                self.touch(key)
+                removed += 1
+        return removed
+
+    def cmd_incr(self, key):
+        value = int(self.data.get(key, b'0')) + 1
+        self.data[key] = str(value).encode('ascii')
+        self.touch(key)
+        return value
+
+    def cmd_hget(self, key, field):
+        return self.get(key, dict).get(field)
+
+    def cmd_hmget(self, key, *fields):
+        values = self.get(key, dict)
+        return [values.get(f) for f in fields]
+
+    def cmd_hset(self, key, *pairs):
+        values = self.get(key, dict, create=True)
+        added = 0
+        for field, value in zip(pairs[::2], pairs[1::2]):
+            added += field not in values
+            values[field] = value
+        self.touch(key)
+        return added
+
+    def cmd_sadd(self, key, *members):
+        values = self.get(key, set, create=True)
+        added = len(set(members) - values)
+        values.update(members)
+        self.touch(key)
+        return added
+
+    def cmd_scard(self, key):
+        return len(self.get(key, set))
+
+    def cmd_smembers(self, key):
+        return sorted(self.get(key, set))
+
+    def cmd_rpush(self, key, *values):
+        items = self.get(key, list, create=True)
+        items.extend(values)
+        self.touch(key)
+        return len(items)
+
+    def cmd_llen(self, key):
+        return len(self.get(key, list))
+
+    def cmd_lrange(self, key, start, stop):
+        items = self.get(key, list)
+        start, stop = int(start), int(stop)
+        if start < 0:
+            start = max(0, len(items) + start)
+        if stop < 0:
+            stop += len(items)
+            if stop < 0:
+                return []
+        return items[start:stop + 1]
+
+    def sorted_set(self, key, create=False):
+        return self.get(key, ZSet, create)
+
+    def cmd_zadd(self, key, *pairs):
+        zset = self.sorted_set(key, create=True)
+        added = 0
+        for score, member in zip(pairs[::2], pairs[1::2]):
+            added += zset.add(float(score), member)
+        self.touch(key)
+        return added
+
+    def cmd_zrem(self, key, *members):
+        zset = self.sorted_set(key)
+        removed = [item for item in zset.items if item[1] in members]
+        for item in removed:
+            zset.items.remove(item)
+        if removed:
+            self.touch(key)
+        return len(removed)
+
+    def cmd_zrange(self, key, start, stop, *options):
+        items = self.sorted_set(key).items
+        start, stop = int(start), int(stop)
+        if stop < 0:
+            stop += len(items)
+            if stop < 0:
+                return []
+        items = items[start:stop + 1]
+        if options and options[0].upper() == b'WITHSCORES':
+            return [v for score, member in items for v in (member, repr(score).encode('ascii'))]
+        return [member for _, member in items]
+
+    def cmd_zrangebyscore(self, key, low, high):
+        return [member for _, member in self.sorted_set(key).between(low, high)]
+
+    def cmd_zremrangebyscore(self, key, low, high):
+        zset = self.sorted_set(key)
+        removed = zset.between(low, high)
+        for item in removed:
+            zset.items.remove(item)
+        if removed:
+            self.touch(key)
+        return len(removed)
+
+def score(value):
+    value = value.decode('ascii')
+    return {'-inf': float('-inf'), '+inf': float('inf'), 'inf': float('inf')}.get(value) or float(value)
+
+class ZSet:
+    def __init__(self):
+        self.items = []
+
+    def add(self, score, member):
+        existing = [item for item in self.items if item[1] == member]
+        for item in existing:
+            self.items.remove(item)
+        bisect.insort(self.items, (score, member))
+        return not existing
+
+    def between(self, low, high):
+        low, high = score(low), score(high)
+        return [item for item in self.items if low <= item[0] <= high]
+
+class RespHandler(socketserver.StreamRequestHandler):
+    """One client connection, with its own WATCH and MULTI state."""
+
+    def handle(self):
+        self.watched = None
+        self.queued = None
+        while True:
+            command = self.read_command()
+            if command is None:
+                return
+            self.wfile.write(self.encode(self.dispatch(command)))
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if line[:1] != b'*':
+            # Inline command, as typed in telnet
+            return line.split()
+        args = []
+        for _ in range(int(line[1:-2])):
+            n = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(n + 2)[:-2])
+        return args
+
+    def dispatch(self, command):
+        name, args = command[0].decode('ascii').upper(), command[1:]
+        db = self.server.db
+        if name == 'MULTI':
+            self.queued = []
+            return 'OK'
+        if name == 'DISCARD':
+            self.queued = self.watched = None
+            return 'OK'
+        if name == 'WATCH':
+            with db.lock:
+                self.watched = self.watched or {}
+                self.watched.update((k, db.revision(k)) for k in args)
+            return 'OK'
+        if name == 'UNWATCH':
+            self.watched = None
+            return 'OK'
+        if name == 'EXEC':
+            return self.exec()
+        if self.queued is not None:
+            self.queued.append((name, args))
+            return 'QUEUED'
+        with db.lock:
+            try:
+                return db.execute(name, args)
+            except RespError as e:
+                return e
+
+    def exec(self):
+        db = self.server.db
+        queued, watched = self.queued, self.watched
+        self.queued = self.watched = None
+        if queued is None:
+            return RespError('ERR EXEC without MULTI')
+        with db.lock:
+            if watched and any(db.revision(k) != r for k, r in watched.items()):
+                return None
+            results = []
+            for name, args in queued:
+                try:
+                    results.append(db.execute(name, args))
+                except RespError as e:
+                    results.append(e)
+            return results
+
+    def encode(self, reply):
+        if reply is None:
+            return b'$-1\r\n'
+        if isinstance(reply, RespError):
+            return b'-' + str(reply).encode('utf-8') + b'\r\n'
+        if isinstance(reply, bool) or isinstance(reply, int):
+            return b':%d\r\n' % reply
+        if isinstance(reply, str):
+            return b'+' + reply.encode('utf-8') + b'\r\n'
+        if isinstance(reply, bytes):
+            return b'$%d\r\n' % len(reply) + reply + b'\r\n'
+        return b'*%d\r\n' % len(reply) + b''.join(self.encode(r) for r in reply)
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, RespHandler)
+        self.db = FakeRedis()
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Redis server for offline runs of cotabot')
+    parser.add_argument('--listen', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6379)
+    args = parser.parse_args()
+    FakeRedisServer((args.listen, args.port)).serve_forever()
+
+if __name__ == '__main__':
+    main()
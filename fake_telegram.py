@@ -0,0 +1,261 @@
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.request
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+# Offline stand-in for the Telegram Bot API, plus a load generator that
+# drives cotabot through its webhook. Start the fake API and the bot:
+#
+#   python fake_telegram.py serve --port 8081
+#   python cotabot.py --ingress webhook --port 8443 --secret s3cr3t \
+#                     --base-url http://127.0.0.1:8081/bot
+#
+# or let `load` start the fake API itself and then drive the bot:
+#
+#   python fake_telegram.py load --webhook http://127.0.0.1:8443 --secret s3cr3t
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'CotaBot', 'username': 'cotabot'}
+
+def user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': 'User{}'.format(user_id)}
+
+def chat(chat_id):
+    return {'id': chat_id, 'type': 'group', 'title': 'Chat {}'.format(chat_id)}
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode('utf-8')
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            data = json.loads(body) if body else {}
+        else:
+            data = {k: v[0] for k, v in parse_qs(body).items()}
+        method = self.path.rsplit('/', 1)[-1]
+        result = self.server.call(method, data)
+
+        payload = json.dumps({'ok': True, 'result': result}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeTelegram(ThreadingHTTPServer):
+    """Answers Bot API calls and remembers the messages the bot has live in each chat."""
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, latency=0.0):
+        super().__init__(address, FakeTelegramHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.next_message_id = 1
+        self.messages = defaultdict(dict)
+        self.calls = defaultdict(int)
+        self.changed = threading.Condition(self.lock)
+
+    def call(self, method, data):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.calls[method] += 1
+            result = self.apply(method, data)
+            self.changed.notify_all()
+        return result
+
+    def apply(self, method, data):
+        if method == 'getMe':
+            return BOT_USER
+        chat_id = int(data.get('chat_id', 0))
+        markup = data.get('reply_markup')
+        if isinstance(markup, str):
+            markup = json.loads(markup)
+        if method == 'sendMessage':
+            message_id = self.next_message_id
+            self.next_message_id += 1
+            self.messages[chat_id][message_id] = {'text': data.get('text'), 'markup': markup}
+            return {'message_id': message_id, 'date': int(time.time()), 'chat': chat(chat_id),
+                    'from': BOT_USER, 'text': data.get('text')}
+        if method == 'editMessageText':
+            message_id = int(data['message_id'])
+            self.messages[chat_id][message_id] = {'text': data.get('text'), 'markup': markup}
+            return {'message_id': message_id, 'date': int(time.time()), 'chat': chat(chat_id),
+                    'from': BOT_USER, 'text': data.get('text')}
+        if method == 'deleteMessage':
+            self.messages[chat_id].pop(int(data['message_id']), None)
+        return True
+
+    def find_button(self, chat_id, match):
+        with self.lock:
+            return self.button(chat_id, match)
+
+    def button(self, chat_id, match):
+        # Newest live message of the chat with a button whose text satisfies match
+        for message_id in sorted(self.messages[chat_id], reverse=True):
+            markup = self.messages[chat_id][message_id]['markup'] or {}
+            for row in markup.get('inline_keyboard', []):
+                for button in row:
+                    if match(button['text']):
+                        return message_id, button['callback_data']
+        return None
+
+    def wait_for(self, predicate, timeout=30):
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while not predicate():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.changed.wait(remaining)
+        return True
+
+    def texts(self, chat_id):
+        return [m['text'] or '' for m in self.messages[chat_id].values()]
+
+class LoadGenerator:
+    """Posts synthetic updates to the bot's webhook and times how it keeps up."""
+
+    def __init__(self, api, webhook, secret):
+        self.api = api
+        self.url = webhook.rstrip('/') + '/' + secret
+        self.secret = secret
+        self.next_update_id = 1
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.refused = 0
+
+    def post(self, update):
+        with self.lock:
+            update['update_id'] = self.next_update_id
+            self.next_update_id += 1
+        request = urllib.request.Request(self.url, json.dumps(update).encode('utf-8'), {
+            'Content-Type': 'application/json',
+            'X-Telegram-Bot-Api-Secret-Token': self.secret})
+        start = time.perf_counter()
+        while True:
+            try:
+                urllib.request.urlopen(request).close()
+                break
+            except urllib.error.HTTPError as e:
+                if e.code != 503:
+                    raise
+                # Backpressure, try again like Telegram would
+                self.refused += 1
+                time.sleep(0.05)
+        with self.lock:
+            self.latencies.append(time.perf_counter() - start)
+
+    def message(self, chat_id, user_id, text):
+        message = {'message_id': 0, 'date': int(time.time()), 'chat': chat(chat_id),
+                   'from': user(user_id), 'text': text}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        self.post({'message': message})
+
+    def press(self, chat_id, user_id, match, timeout=30):
+        found = [None]
+
+        def ready():
+            found[0] = self.api.button(chat_id, match)
+            return found[0]
+
+        if not self.api.wait_for(ready, timeout):
+            raise RuntimeError('No matching button in chat {}'.format(chat_id))
+        message_id, data = found[0]
+        self.post({'callback_query': {
+            'id': str(random.getrandbits(32)), 'from': user(user_id), 'chat_instance': str(chat_id),
+            'data': data, 'message': {'message_id': message_id, 'date': int(time.time()),
+                                      'chat': chat(chat_id), 'from': BOT_USER, 'text': '...'}}})
+
+    def create_cota(self, chat_id):
+        creator = chat_id * 1000
+        self.message(chat_id, creator, '/cotas')
+        self.press(chat_id, creator, lambda t: t == 'Nova Cota')
+        self.press(chat_id, creator, lambda t: t == 'Vaquinha')
+        self.api.wait_for(lambda: any('nome' in t for t in self.api.texts(chat_id)))
+        self.message(chat_id, creator, 'Churrasco')
+        self.api.wait_for(lambda: any('Quanto' in t for t in self.api.texts(chat_id)))
+        self.message(chat_id, creator, '10')
+        self.press(chat_id, creator, lambda t: t == 'Pular >>'
+                   and any('descrição' in t for t in self.api.texts(chat_id)))
+        self.press(chat_id, creator, lambda t: 'Churrasco' in t)
+        self.press(chat_id, creator, lambda t: t.startswith('Eu vou'))
+
+    def taps(self, chat_id, n):
+        found = self.api.find_button(chat_id, lambda t: t.startswith('Eu vou'))
+        for i in range(n):
+            message_id, data = found
+            self.post({'callback_query': {
+                'id': str(random.getrandbits(32)), 'from': user(chat_id * 1000 + 1 + i % 50),
+                'chat_instance': str(chat_id), 'data': data,
+                'message': {'message_id': message_id, 'date': int(time.time()),
+                            'chat': chat(chat_id), 'from': BOT_USER, 'text': '...'}}})
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+def run_load(args):
+    api = FakeTelegram(('127.0.0.1', args.port), args.latency)
+    threading.Thread(target=api.serve_forever, daemon=True).start()
+    generator = LoadGenerator(api, args.webhook, args.secret)
+
+    chats = range(1, args.chats + 1)
+    threads = [threading.Thread(target=generator.create_cota, args=(c,)) for c in chats]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    generator.latencies.clear()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=generator.taps, args=(c, args.taps)) for c in chats]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    accepted = time.perf_counter() - start
+
+    # +1 from create_cota plus every tap
+    expected = '[ {} ]'.format(args.taps + 1)
+    settled = api.wait_for(lambda: all(any(expected in t for t in api.texts(c)) for c in chats), 120)
+    total = time.perf_counter() - start
+
+    n = args.chats * args.taps
+    print('updates:            {}'.format(n))
+    print('accepted:           {:.0f} updates/s'.format(n / accepted))
+    print('webhook p50 / p99:  {:.1f} / {:.1f} ms'.format(percentile(generator.latencies, 0.5) * 1000,
+                                                          percentile(generator.latencies, 0.99) * 1000))
+    print('refused (503):      {}'.format(generator.refused))
+    print('settled:            {} in {:.2f} s'.format('yes' if settled else 'NO', total))
+    print('api calls:          {}'.format(dict(api.calls)))
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Telegram Bot API for offline benchmarks')
+    sub = parser.add_subparsers(dest='command', required=True)
+    serve = sub.add_parser('serve', help='only run the fake Bot API')
+    load = sub.add_parser('load', help='run the fake Bot API and drive the bot through its webhook')
+    for p in (serve, load):
+        p.add_argument('--port', type=int, default=8081)
+        p.add_argument('--latency', type=float, default=0.0, help='seconds added to every API call')
+    load.add_argument('--webhook', default='http://127.0.0.1:8443')
+    load.add_argument('--secret', required=True)
+    load.add_argument('--chats', type=int, default=20)
+    load.add_argument('--taps', type=int, default=50, help='+1 taps per chat')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        FakeTelegram(('127.0.0.1', args.port), args.latency).serve_forever()
+    else:
+        run_load(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+import os
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cotabot
+
+# Fakes shared by the tests. Helpers are imported with "from conftest import ...".
+
+def fake_user(user_id, username=None):
+    return SimpleNamespace(id=user_id, first_name='User{}'.format(user_id),
+                           last_name=None, username=username)
+
+def fake_update(chat_id, user_id, text=None, data=None, message_id=None):
+    user = fake_user(user_id)
+    chat = SimpleNamespace(id=chat_id)
+    message = SimpleNamespace(chat_id=chat_id, message_id=message_id, text=text, entities=[])
+    query = SimpleNamespace(data=data, message=message, from_user=user, id='q') if data else None
+    return SimpleNamespace(effective_chat=chat, effective_user=user, effective_message=message,
+                           message=None if data else message, callback_query=query, inline_query=None)
+
+def make_chat(chat_id, n_participants=0, n_cotas=1):
+    cota_chat = cotabot.CotaChat(chat_id)
+    for cota_id in range(n_cotas):
+        cota = cotabot.Cota(cota_id, 0, name='Cota {}'.format(cota_id), value=10.0)
+        for user_id in range(n_participants):
+            user = fake_user(user_id)
+            cota.add_participant(user, cota_chat.user_name(user))
+        cota_chat.active_cotas[cota_id] = cota
+    cota_chat.next_cota_id = n_cotas
+    return cota_chat
+
+def press(chat_id, user_id, message_id, handler, *ids):
+    data = cotabot.callback_data(handler, *ids)
+    cotabot.callback_handler(None, fake_update(chat_id, user_id, data=data, message_id=message_id))
+
+def newest_box(chat_id):
+    return list(cotabot.cota_chats.get(chat_id).iBoxes)[-1]
+
+def settle():
+    # Wait for debounced renders, queued API calls and pending writes
+    while True:
+        time.sleep(cotabot.RENDER_DEBOUNCE + 0.1)
+        if not cotabot.outbox.depth() and not cotabot.outbox.busy and not cotabot.flusher.backlog() \
+                and not any(c.render_timer for c in cotabot.cota_chats.values()):
+            return
+
+class RecordingBot:
+    """Keeps the last text of every message, as a chat would show it."""
+
+    username = 'cotabot'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.texts = {}
+        self.calls = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        with self.lock:
+            message_id = self.next_id
+            self.next_id += 1
+            self.texts[chat_id, message_id] = text
+            self.calls.append(('send_message', chat_id, message_id))
+        return SimpleNamespace(message_id=message_id, chat_id=chat_id, text=text)
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        with self.lock:
+            self.texts[chat_id, message_id] = text
+            self.calls.append(('edit_message_text', chat_id, message_id))
+        return True
+
+    def delete_message(self, chat_id, message_id, **kwargs):
+        with self.lock:
+            self.texts.pop((chat_id, message_id), None)
+            self.calls.append(('delete_message', chat_id, message_id))
+        return True
+
+    def send_chat_action(self, chat_id, action, **kwargs):
+        return True
+
+    def answer_callback_query(self, *args, **kwargs):
+        return True
+
+    def answer_inline_query(self, inline_query_id, results, **kwargs):
+        with self.lock:
+            self.calls.append(('answer_inline_query', inline_query_id, results))
+        return True
+
+@pytest.fixture
+def sqlite_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(cotabot, 'STORE', 'sqlite')
+    monkeypatch.setattr(cotabot, 'DB_FILE', str(tmp_path / 'cotabot.sqlite'))
+    monkeypatch.setattr(cotabot, 'LEGACY_DB_FILE', str(tmp_path / 'none.pickle'))
+    return tmp_path
+
+@pytest.fixture
+def bot(sqlite_files, monkeypatch):
+    # Only the bot is under test, not Telegram's limits
+    for name in ('CHAT_RATE', 'CHAT_BURST', 'GLOBAL_RATE'):
+        monkeypatch.setattr(cotabot, name, 1e9)
+    bot = RecordingBot()
+    cotabot.load_state()
+    cotabot.start_services(bot)
+    yield bot
+    cotabot.stop_services()
+    cotabot.close_state()
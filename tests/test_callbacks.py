@@ -0,0 +1,53 @@
+import cotabot
+from conftest import fake_update, make_chat, newest_box, press, settle
+
+def confirmation_box(chat_id):
+    cotabot.store.save(make_chat(chat_id))
+    cotabot.cotas(None, fake_update(chat_id, 0, text='/cotas'))
+    box = newest_box(chat_id)
+    press(chat_id, 0, box, cotabot.open_cota_view, 0)
+    press(chat_id, 0, box, cotabot.close_cota, 0)
+    iBox = cotabot.cota_chats.get(chat_id).iBoxes[box]
+    assert isinstance(iBox.current_state, cotabot.CloseCotaConfirmationState)
+    return box, iBox
+
+def test_double_tap_on_confirm_close(bot):
+    box, iBox = confirmation_box(1)
+    press(1, 0, box, cotabot.confirm_closing_cota)
+    press(1, 0, box, cotabot.confirm_closing_cota)
+    press(1, 0, box, cotabot.cancel_closing_cota)
+    settle()
+    assert not cotabot.cota_chats.get(1).active_cotas
+    assert isinstance(iBox.current_state, cotabot.MainListState)
+    assert cotabot.store.history_count(1) == 1
+
+def test_double_tap_on_cancel_close(bot):
+    box, iBox = confirmation_box(1)
+    press(1, 0, box, cotabot.cancel_closing_cota)
+    assert isinstance(iBox.current_state, cotabot.CotaViewState)
+    # Neither tap may close the cota from the cota's own view
+    press(1, 0, box, cotabot.cancel_closing_cota)
+    press(1, 0, box, cotabot.confirm_closing_cota)
+    settle()
+    assert list(cotabot.cota_chats.get(1).active_cotas) == [0]
+
+def test_history_filter_shows_own_cotas(bot):
+    cota_chat = make_chat(1, n_cotas=2)
+    cota_chat.active_cotas[1].creator_id = 5
+    cotabot.store.save(cota_chat)
+    cotabot.cotas(None, fake_update(1, 0, text='/cotas'))
+    box = newest_box(1)
+    for cota_id, creator_id in ((0, 0), (1, 5)):
+        press(1, creator_id, box, cotabot.open_cota_view, cota_id)
+        press(1, creator_id, box, cotabot.close_cota, cota_id)
+        press(1, creator_id, box, cotabot.confirm_closing_cota)
+    press(1, 5, box, cotabot.open_history)
+    settle()
+    assert 'Cota 0' in bot.texts[1, box] and 'Cota 1' in bot.texts[1, box]
+    press(1, 5, box, cotabot.history_next_filter)
+    settle()
+    assert 'Cota 0' not in bot.texts[1, box] and 'Cota 1' in bot.texts[1, box]
+    # The next filter only keeps the recent ones, which are both
+    press(1, 5, box, cotabot.history_next_filter)
+    settle()
+    assert 'Cota 0' in bot.texts[1, box] and 'Cota 1' in bot.texts[1, box]
@@ -0,0 +1,50 @@
+import random
+from types import SimpleNamespace
+
+import pytest
+
+import cotabot
+
+def user(user_id):
+    return SimpleNamespace(id=user_id, first_name='User{}'.format(user_id), last_name=None, username=None)
+
+@pytest.mark.parametrize('seed', range(20))
+def test_aggregates_match_recount(seed):
+    rnd = random.Random(seed)
+    cota = cotabot.Cota(0, 0, name='Churras', value=10.0)
+    users = [user(user_id) for user_id in range(1, 9)]
+    for _ in range(500):
+        target = rnd.choice(users)
+        op = rnd.choice(('add', 'remove', 'pay', 'bulk'))
+        if op == 'add':
+            cota.add_participant(target, n=rnd.randint(1, 3))
+        elif op == 'remove':
+            cota.remove_participant(target, n=rnd.randint(1, 3))
+        elif op == 'pay':
+            if target.id in cota.going:
+                cota.toggle_payed(target.id)
+        else:
+            # None removes every seat of the user
+            seats = [(u.id, cotabot.UserName.of(u), rnd.choice((None, -2, -1, 1, 2, 5)))
+                     for u in rnd.sample(users, 3)]
+            cota.add_participants(seats)
+        assert (cota.heads, cota.paid_heads) == cota.recount()
+        assert all(p.n > 0 for p in cota.going.values())
+    cota.check_aggregates()
+
+def test_check_aggregates_raises_on_drift():
+    cota = cotabot.Cota(0, 0, name='Churras', value=10.0)
+    cota.add_participant(user(1), n=2)
+    cota.heads += 1
+    with pytest.raises(ValueError):
+        cota.check_aggregates()
+
+def test_view_shows_collected_and_outstanding():
+    cota = cotabot.Cota(0, 0, name='Churras', value=10.0)
+    cota.add_participant(user(1), n=2)
+    cota.add_participant(user(2))
+    cota.toggle_payed(1)
+    view = cotabot.CotaViewState(None, cota)
+    assert '_Pago: R$ 20.00 - Falta: R$ 10.00_' in view.render()[0]
+    cota.toggle_payed(2)
+    assert '_Pago: R$ 30.00 - Falta: R$ 0.00_' in view.render()[0]
@@ -0,0 +1,57 @@
+import random
+from collections import Counter
+from types import SimpleNamespace
+
+import pytest
+from telegram import MessageEntity
+
+import cotabot
+from conftest import fake_update, fake_user, make_chat, newest_box, press, settle
+
+def test_settle_up_pays_biggest_creditor_first():
+    transfers = cotabot.settle_up({1: 500, 2: -300, 3: -200, 4: 0})
+    assert transfers == [(2, 1, 300), (3, 1, 200)]
+
+def test_settle_up_nothing_owed():
+    assert cotabot.settle_up({}) == []
+    assert cotabot.settle_up({1: 0, 2: 0}) == []
+
+@pytest.mark.parametrize('seed', range(20))
+def test_settle_up_evens_everyone(seed):
+    rnd = random.Random(seed)
+    balances = {user_id: rnd.randint(-5000, 5000) for user_id in range(1, rnd.randint(2, 12))}
+    # Whatever is owed is owed to someone
+    balances[0] = -sum(balances.values())
+    transfers = cotabot.settle_up(balances)
+    left = Counter(balances)
+    for debtor, creditor, cents in transfers:
+        assert cents > 0 and balances[debtor] < 0 < balances[creditor]
+        left[debtor] += cents
+        left[creditor] -= cents
+    assert not any(left.values())
+    assert len(transfers) <= max(0, sum(1 for cents in balances.values() if cents) - 1)
+
+def test_debts_of_closed_cotas_can_be_settled(bot):
+    cotabot.store.save(make_chat(1, n_participants=3))
+    cotabot.cotas(None, fake_update(1, 0, text='/cotas'))
+    box = newest_box(1)
+    press(1, 0, box, cotabot.open_cota_view, 0)
+    press(1, 0, box, cotabot.close_cota, 0)
+    press(1, 0, box, cotabot.confirm_closing_cota)
+    cota_chat = cotabot.cota_chats.get(1)
+    assert not cota_chat.active_cotas
+    assert cota_chat.get_ledger().settlement() == [(1, 0, 1000), (2, 0, 1000)]
+
+    text = '/quitar @User1'
+    update = fake_update(1, 0, text=text)
+    update.message.entities = [SimpleNamespace(type=MessageEntity.TEXT_MENTION, offset=8, length=6,
+                                               user=fake_user(1))]
+    cotabot.payments(None, update)
+    assert cota_chat.get_ledger().settlement() == [(2, 0, 1000)]
+    assert cota_chat.history_balances == {0: 1000, 1: 0, 2: -1000}
+    # Only the one who is owed can confirm
+    update.effective_user = fake_user(2)
+    cotabot.payments(None, update)
+    assert cota_chat.get_ledger().settlement() == [(2, 0, 1000)]
+    settle()
+    assert any('*User1* pagou R$ 10.00' in text for text in bot.texts.values())
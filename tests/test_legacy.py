@@ -0,0 +1,28 @@
+import os
+import shutil
+
+import cotabot
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+def test_migrate_baseline_pickle(tmp_path):
+    # Written by the first version of the bot, which pickled every chat into one file
+    legacy = str(tmp_path / 'cotas_db.pickle')
+    shutil.copy(os.path.join(DATA, 'baseline_chats.pickle'), legacy)
+    store = cotabot.ChatStore(str(tmp_path / 'cotas_db.sqlite'))
+    try:
+        store.migrate_legacy(legacy)
+        assert os.path.exists(legacy + '.migrated')
+        cota_chat = store.load(-100123)
+        assert cota_chat.next_cota_id == 3
+        churras, pizza = cota_chat.active_cotas[0], cota_chat.active_cotas[1]
+        assert (churras.name, churras.value, churras.description) == ('Churras', 25.5, 'Sábado')
+        assert churras.heads == 3 and churras.paid_heads == 1
+        assert pizza.value is None and list(pizza.going) == [3]
+        assert sorted(cota_chat.iBoxes) == [10, 11]
+        assert cota_chat.iBoxes[11].current_state.cota is churras
+        assert all(iBox.created_at for iBox in cota_chat.iBoxes.values())
+        history = store.history_page(-100123, 0, 10)
+        assert [cota.name for cota in history] == ['Cinema']
+    finally:
+        store.close()
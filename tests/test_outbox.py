@@ -0,0 +1,89 @@
+import threading
+import time
+
+import pytest
+
+import cotabot
+
+class SlowBot:
+    """Records calls with their time. Calls wait while the gate is closed."""
+
+    def __init__(self):
+        self.gate = threading.Event()
+        self.gate.set()
+        self.calls = []
+
+    def record(self, *call):
+        self.gate.wait(5)
+        self.calls.append(call + (time.monotonic(),))
+        return True
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self.record('send_message', chat_id, text)
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        return self.record('edit_message_text', chat_id, message_id, text)
+
+    def delete_message(self, chat_id, message_id, **kwargs):
+        return self.record('delete_message', chat_id, message_id)
+
+@pytest.fixture
+def outbox(monkeypatch):
+    monkeypatch.setattr(cotabot, 'CHAT_RATE', 20.0)
+    monkeypatch.setattr(cotabot, 'CHAT_BURST', 1)
+    bot = SlowBot()
+    outbox = cotabot.Outbox(bot, workers=2)
+    yield outbox, bot
+    outbox.stop()
+
+def test_queued_edits_of_a_message_merge(outbox):
+    outbox, bot = outbox
+    bot.gate.clear()
+    # The chat is busy with this one while the edits queue up
+    outbox.post_message(1, 'first')
+    time.sleep(0.1)
+    futures = [outbox.edit_message_text('v{}'.format(i), 1, 9) for i in range(5)]
+    # Only the newest edit is sent, the others resolve without reaching the chat
+    assert all(f.result(0) is cotabot.SUPERSEDED for f in futures[:-1])
+    assert outbox.stats['merged'] == 4
+    bot.gate.set()
+    assert futures[-1].result(5) is True
+    assert [c[:-1] for c in bot.calls] == [('send_message', 1, 'first'), ('edit_message_text', 1, 9, 'v4')]
+
+def test_delete_drops_the_queued_edit(outbox):
+    outbox, bot = outbox
+    bot.gate.clear()
+    outbox.post_message(1, 'first')
+    time.sleep(0.1)
+    edit = outbox.edit_message_text('never shown', 1, 9)
+    deleted = outbox.delete_message(1, 9)
+    bot.gate.set()
+    deleted.result(5)
+    assert edit.result(0) is cotabot.SUPERSEDED
+    assert [c[0] for c in bot.calls] == ['send_message', 'delete_message']
+
+def test_one_chat_is_held_to_its_rate(outbox):
+    outbox, bot = outbox
+    futures = [outbox.post_message(1, str(i)) for i in range(5)]
+    for f in futures:
+        f.result(5)
+    stamps = [c[-1] for c in bot.calls]
+    # Sent in order, one burst token and then 20 per second
+    assert [c[2] for c in bot.calls] == ['0', '1', '2', '3', '4']
+    assert stamps[-1] - stamps[0] >= 4 / 20.0 * 0.9
+
+def test_other_chats_are_not_held_back(outbox):
+    outbox, bot = outbox
+    start = time.monotonic()
+    futures = [outbox.post_message(chat_id, 'hi') for chat_id in range(1, 6)]
+    for f in futures:
+        f.result(5)
+    assert time.monotonic() - start < 4 / 20.0
+
+def test_superseded_edit_does_not_count_as_rendered():
+    box = cotabot.InteractiveBox.__new__(cotabot.InteractiveBox)
+    box.last_render = 'shown'
+    future = cotabot.Future()
+    future.set_result(cotabot.SUPERSEDED)
+    box.on_edit_done('never shown', future)
+    assert box.last_render == 'shown'
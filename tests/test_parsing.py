@@ -0,0 +1,62 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+from telegram import MessageEntity
+
+import cotabot
+
+def test_deadline_with_time():
+    name, when = cotabot.parse_deadline('/prazo Churras da firma 25/12/2030 18:00')
+    assert name.strip() == 'Churras da firma'
+    assert datetime.fromtimestamp(when) == datetime(2030, 12, 25, 18, 0)
+
+def test_deadline_defaults_to_end_of_day_and_next_year():
+    now = datetime.now()
+    _, when = cotabot.parse_deadline('/prazo Churras {}/{}'.format(now.day, now.month))
+    when = datetime.fromtimestamp(when)
+    assert (when.hour, when.minute) == (23, 59)
+    assert when > now and when.year in (now.year, now.year + 1)
+
+def test_deadline_short_year_and_hours_only():
+    _, when = cotabot.parse_deadline('/prazo x 1/2/31 9h')
+    assert datetime.fromtimestamp(when) == datetime(2031, 2, 1, 9, 0)
+
+def test_deadline_removed_or_unreadable():
+    assert cotabot.parse_deadline('/prazo Churras sem') == ('Churras', None)
+    assert cotabot.parse_deadline('/prazo Churras 31/02') is None
+    assert cotabot.parse_deadline('/prazo Churras') is None
+
+def message(text, *mentions):
+    # mentions are the substrings to mark, '@name' or a user for a text mention
+    entities = []
+    for mention in mentions:
+        if isinstance(mention, str):
+            offset = text.index(mention)
+            entities.append(MessageEntity(MessageEntity.MENTION, len(text[:offset].encode('utf-16-le')) // 2,
+                                          len(mention)))
+        else:
+            offset = text.index(mention.first_name)
+            entities.append(MessageEntity(MessageEntity.TEXT_MENTION, offset, len(mention.first_name),
+                                          user=mention))
+    return SimpleNamespace(text=text, entities=entities)
+
+def test_mentions_with_counts_and_removals():
+    text = '/cota Churras @ana @bruno 3 -@carla -@davi 2'
+    cota_name, mentions = cotabot.parse_mentions(message(text, '@ana', '@bruno', '@carla', '@davi'))
+    assert cota_name == 'Churras'
+    assert mentions == [('ana', 1), ('bruno', 3), ('carla', None), ('davi', -2)]
+
+def test_mentions_cap_seats_and_count_utf16_offsets():
+    # The emoji takes two UTF-16 code units, entity offsets count those
+    text = '/cota Bolo 🎂 @ana 999'
+    cota_name, mentions = cotabot.parse_mentions(message(text, '@ana'))
+    assert cota_name == 'Bolo 🎂'
+    assert mentions == [('ana', cotabot.BULK_MAX_SEATS)]
+
+def test_text_mentions_carry_the_user():
+    user = SimpleNamespace(id=5, first_name='Eva', last_name=None, username=None)
+    _, mentions = cotabot.parse_mentions(message('/cota Eva x2', user))
+    assert mentions == [(user, 2)]
+
+def test_no_mentions():
+    assert cotabot.parse_mentions(message('/cota Churras')) == ('Churras', [])
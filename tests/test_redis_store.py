@@ -0,0 +1,156 @@
+import threading
+
+import pytest
+
+import cotabot
+import fake_redis
+
+@pytest.fixture
+def server():
+    server = fake_redis.FakeRedisServer(('127.0.0.1', 0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def open_redis(server):
+    stores = []
+
+    def open_redis():
+        store = cotabot.RedisStore('redis://127.0.0.1:{}'.format(server.server_address[1]))
+        store.claim_shard(0, 1)
+        stores.append(store)
+        return store
+
+    yield open_redis
+    for store in stores:
+        store.close()
+
+def make_cota(cota_id, creator_id, closed_at):
+    cota = cotabot.Cota(cota_id, creator_id, cotabot.VAQUINHA, 'Cota {}'.format(cota_id), 10.0)
+    cota.closed_at = closed_at
+    return cota
+
+def test_save_over_newer_revision_is_refused(open_redis):
+    first, second = open_redis(), open_redis()
+    cota_chat = cotabot.CotaChat(1)
+    assert first.save_many([cota_chat]) == []
+    assert cota_chat.revision == 1
+
+    # Another process loads the chat and writes it first
+    other = second.load(1)
+    other.next_cota_id = 5
+    second.save(other)
+    assert other.revision == 2
+
+    assert first.save_many([cota_chat]) == [cota_chat]
+    with pytest.raises(cotabot.VersionConflict):
+        first.archive_cota(cota_chat, make_cota(0, 7, 100.0))
+    assert first.load(1).next_cota_id == 5
+    assert first.history_count(1) == 0
+
+def test_snapshot_superseded_by_own_write_is_not_a_conflict(open_redis):
+    store = open_redis()
+    cota_chat = cotabot.CotaChat(1)
+    store.save(cota_chat)
+    cota = cota_chat.active_cotas[0] = make_cota(0, 7, None)
+    stale = cota_chat.snapshot()
+    # The cota is closed and archived after the flusher took its snapshot
+    del cota_chat.active_cotas[0]
+    cota.closed_at = 100.0
+    store.archive_cota(cota_chat, cota)
+
+    snapshot = cota_chat.snapshot
+    cota_chat.snapshot = lambda: stale
+    try:
+        assert store.save_many([cota_chat]) == []
+    finally:
+        cota_chat.snapshot = snapshot
+    assert store.load(1).active_cotas == {}
+    assert cota_chat.revision == 2
+
+def test_history_paging(open_redis):
+    store = open_redis()
+    cota_chat = cotabot.CotaChat(1)
+    store.save(cota_chat)
+    for cota_id in range(12):
+        store.archive_cota(cota_chat, make_cota(cota_id, 7 if cota_id % 3 else 8, 1000.0 + cota_id))
+
+    def ids(*args, **kwargs):
+        return [cota._id for cota in store.history_page(1, *args, **kwargs)]
+
+    assert store.history_count(1) == 12
+    # Newest first, pages of 5
+    assert ids(0, 5) == [11, 10, 9, 8, 7]
+    assert ids(5, 5) == [6, 5, 4, 3, 2]
+    assert ids(10, 5) == [1, 0]
+    assert ids(12, 5) == []
+    assert ids(20, 5) == []
+
+    assert store.history_count(1, creator_id=8) == 4
+    assert ids(0, 3, creator_id=8) == [9, 6, 3]
+    assert ids(3, 3, creator_id=8) == [0]
+    assert store.history_count(1, since=1004.0, until=1008.0) == 4
+    assert ids(1, 2, since=1004.0, until=1008.0) == [6, 5]
+
+def test_failed_transaction_does_not_return_its_connection(open_redis):
+    store = open_redis()
+    cota_chat = cotabot.CotaChat(1)
+    store.save(cota_chat)
+    # The next transaction gets the most recently released connection
+    conn = store.pool.idle[-1]
+
+    def build(revisions):
+        raise RuntimeError('build failed')
+
+    with pytest.raises(RuntimeError):
+        store.transaction([store.key('chat', 1)], build)
+    # The connection was left watching the chat, it is closed rather than reused
+    assert conn not in store.pool.idle
+    cota_chat.next_cota_id = 3
+    store.save(cota_chat)
+    assert store.load(1).next_cota_id == 3
+
+def test_expire_history_keeps_what_is_appended_meanwhile(open_redis, monkeypatch):
+    store, other = open_redis(), open_redis()
+    cota_chat = cotabot.CotaChat(1)
+    store.save(cota_chat)
+    store.archive_cota(cota_chat, make_cota(0, 7, 100.0))
+    store.archive_cota(cota_chat, make_cota(1, 7, 5000.0))
+    history_entries = store.history_entries
+    appended = []
+
+    def read_then_append(chat_id):
+        entries = history_entries(chat_id)
+        if not appended:
+            # Another process closes a cota between the read and the rewrite
+            theirs = other.load(1)
+            other.archive_cota(theirs, make_cota(2, 7, 6000.0))
+            appended.append(theirs)
+        return entries
+
+    monkeypatch.setattr(store, 'history_entries', read_then_append)
+    store.expire_history(1000.0)
+    assert [cota._id for cota in store.history_page(1, 0, 10)] == [2, 1]
+
+def test_each_due_timer_is_claimed_by_one_process(open_redis):
+    first, second = open_redis(), open_redis()
+    first.add_timer(10.0, 1, 'reminder', '0:10.0')
+    first.add_timer(20.0, 2, 'reminder', '0:20.0')
+    due = first.due_timers('reminder', 100.0)
+    assert second.due_timers('reminder', 100.0) == due
+    won = first.claim_timers('reminder', due[:1])
+    assert won == due[:1]
+    assert second.claim_timers('reminder', due) == due[1:]
+    assert first.claim_timers('reminder', due) == []
+    assert first.next_timer_due('reminder') is None
+
+def test_writes_record_snapshot_bytes(open_redis, monkeypatch):
+    monkeypatch.setattr(cotabot, 'metrics', cotabot.Metrics())
+    store = open_redis()
+    cota_chat = cotabot.CotaChat(1)
+    store.save(cota_chat)
+    store.archive_cota(cota_chat, make_cota(0, 7, 100.0))
+    histogram = cotabot.metrics.histograms['cotabot_snapshot_bytes', ()]
+    assert sum(histogram.counts) == 2 and histogram.sum > 0
@@ -0,0 +1,66 @@
+from types import SimpleNamespace
+
+import cotabot
+from conftest import make_chat, settle
+
+def cota(cota_id, name, description=None, closed_at=None):
+    c = cotabot.Cota(cota_id, 0, name=name, value=10.0, description=description)
+    c.closed_at = closed_at
+    return c
+
+def test_every_word_must_prefix_a_word_of_the_cota():
+    index = cotabot.CotaIndex()
+    for c in (cota(0, 'Churrasco da firma', 'Sábado no clube'), cota(1, 'Churros'),
+              cota(2, 'Pizza', 'Sabor calabresa')):
+        index.add(c)
+    assert [c._id for c in index.search('chur', 10)] == [1, 0]
+    assert [c._id for c in index.search('chur firm', 10)] == [0]
+    # Case and accents are ignored, descriptions count
+    assert [c._id for c in index.search('SABADO', 10)] == [0]
+    assert [c._id for c in index.search('sab', 10)] == [2, 0]
+    assert index.search('chur pizza', 10) == []
+
+def test_active_first_newest_first_and_limit():
+    index = cotabot.CotaIndex()
+    for c in (cota(0, 'Bolo'), cota(1, 'Bolo', closed_at=1.0), cota(2, 'Bolo'), cota(3, 'Bolo', closed_at=2.0)):
+        index.add(c)
+    assert [c._id for c in index.search('bolo', 10)] == [2, 0, 3, 1]
+    assert [c._id for c in index.search('', 2)] == [2, 0]
+
+def test_readding_a_cota_id_drops_the_old_words():
+    index = cotabot.CotaIndex()
+    index.add(cota(0, 'Pizza'))
+    c = cota(0, 'Sushi')
+    index.add(c)
+    assert index.search('pizza', 10) == []
+    assert index.search('sushi', 10) == [c]
+    index.remove(0)
+    assert index.search('sushi', 10) == []
+    assert index.tokens == [] and index.postings == {}
+
+def inline_query(user_id, text):
+    user = SimpleNamespace(id=user_id, first_name='User', last_name=None, username=None)
+    return SimpleNamespace(inline_query=SimpleNamespace(id='q', query=text, from_user=user),
+                           effective_chat=None, effective_user=user, effective_message=None,
+                           callback_query=None, message=None)
+
+def answered(bot):
+    settle()
+    return [result.title for result in [c for c in bot.calls if c[0] == 'answer_inline_query'][-1][2]]
+
+def test_chats_of_other_shards_are_searched_fresh(bot, monkeypatch):
+    # With the redis store, every process reads every chat
+    monkeypatch.setattr(cotabot, 'own_shard', (0, 2))
+    chat_id = next(c for c in range(1, 10) if cotabot.shard_of(c, 2) == 1)
+    cota_chat = make_chat(chat_id)
+    cotabot.store.save(cota_chat)
+    cotabot.store.add_members([(7, chat_id)])
+    cotabot.inline_search(None, inline_query(7, 'cota'))
+    assert answered(bot) == ['[ 0 ] Cota 0 - R$ 10.00']
+    assert chat_id not in cotabot.cota_chats.chats
+
+    # The other shard changes it, the next search sees that
+    cota_chat.active_cotas[0].name = 'Pizza'
+    cotabot.store.save(cota_chat)
+    cotabot.inline_search(None, inline_query(7, 'pizza'))
+    assert answered(bot) == ['[ 0 ] Pizza - R$ 10.00']
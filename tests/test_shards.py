@@ -0,0 +1,50 @@
+import os
+
+import cotabot
+from conftest import make_chat
+
+CHATS = range(-10, 10)
+
+def fill(path):
+    store = cotabot.ChatStore(path)
+    try:
+        for chat_id in CHATS:
+            cota_chat = make_chat(chat_id, n_cotas=2)
+            store.save(cota_chat)
+            closed = cota_chat.active_cotas.pop(1)
+            closed.closed_at = 1.0
+            store.archive_cota(cota_chat, closed)
+            store.add_timer(100.0, chat_id, 'deadline', '0:100.0')
+            store.add_members([(7, chat_id)])
+    finally:
+        store.close()
+
+def contents(path):
+    store = cotabot.ChatStore(path)
+    try:
+        chats = [r[0] for r in store.conn.execute('SELECT chat_id FROM chats')]
+        timers = [t[1] for t in store.due_timers('deadline', 1000.0)]
+        return chats, {chat_id: store.history_count(chat_id) for chat_id in chats}, timers, store.member_chats(7)
+    finally:
+        store.close()
+
+def check(shards):
+    for index in range(shards):
+        chats, history, timers, members = contents(cotabot.shard_db_file(index, shards))
+        owned = sorted(c for c in CHATS if cotabot.shard_of(c, shards) == index)
+        assert sorted(chats) == owned
+        assert history == {chat_id: 1 for chat_id in owned}
+        assert sorted(timers) == owned and sorted(members) == owned
+
+def test_rebalance_moves_chats_to_their_shard(sqlite_files):
+    fill(cotabot.DB_FILE)
+    cotabot.rebalance(3)
+    check(3)
+    assert contents(cotabot.DB_FILE)[0] == []
+    # Growing and shrinking again, a dropped shard's files are removed
+    cotabot.rebalance(2)
+    check(2)
+    assert not [name for name in os.listdir(str(sqlite_files)) if '.shard2.' in name]
+    cotabot.rebalance(1)
+    check(1)
+    assert cotabot.shard_db_files() == []
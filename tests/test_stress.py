@@ -0,0 +1,128 @@
+import random
+import threading
+import time
+from queue import Queue
+
+from telegram import Update
+from telegram.ext import Dispatcher
+
+import cotabot
+from conftest import fake_update, make_chat, newest_box, press, settle
+
+CHATS = 20
+THREADS = 8
+USERS_PER_THREAD = 5
+OPS = 600
+
+def tap(model, user_id, action):
+    # What the handlers are expected to do to (seats, paid) of a user
+    seats, paid = model.pop(user_id, (0, False))
+    if action == 'add':
+        seats += 1
+    elif action == 'remove' and seats:
+        seats -= 1
+    elif action == 'pay' and seats:
+        paid = not paid
+    if seats:
+        model[user_id] = (seats, paid)
+
+def test_concurrent_taps_on_many_chats(bot):
+    boxes = {}
+    for chat_id in range(1, CHATS + 1):
+        cota_chat = make_chat(chat_id)
+        cotabot.store.save(cota_chat)
+        # Two boxes per chat showing the cota, taps go to either of them
+        boxes[chat_id] = []
+        for _ in range(2):
+            cotabot.cotas(None, fake_update(chat_id, 0, text='/cotas'))
+            boxes[chat_id].append(newest_box(chat_id))
+            press(chat_id, 0, boxes[chat_id][-1], cotabot.open_cota_view, 0)
+
+    handlers = {'add': cotabot.new_participant, 'remove': cotabot.remove_participant,
+                'pay': cotabot.payed_or_not}
+    # Every user belongs to one thread, so the taps of a user happen in order
+    models = [{chat_id: {} for chat_id in boxes} for _ in range(THREADS)]
+    errors = []
+
+    def run(index):
+        rnd = random.Random(index)
+        users = range(1 + index * USERS_PER_THREAD, 1 + (index + 1) * USERS_PER_THREAD)
+        try:
+            for _ in range(OPS):
+                chat_id = rnd.choice(list(boxes))
+                user_id = rnd.choice(users)
+                action = rnd.choice(('add', 'add', 'remove', 'pay'))
+                press(chat_id, user_id, rnd.choice(boxes[chat_id]), handlers[action], 0)
+                tap(models[index][chat_id], user_id, action)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    settle()
+    assert not errors
+
+    stored = cotabot.ChatStore(cotabot.DB_FILE)
+    try:
+        for chat_id in boxes:
+            expected = {}
+            for model in models:
+                expected.update(model[chat_id])
+            cota_chat = cotabot.cota_chats.get(chat_id)
+            cota = cota_chat.active_cotas[0]
+            assert {p._id: (p.n, p.payed) for p in cota.going.values()} == expected
+            cota.check_aggregates()
+            # The store holds the same, and every box shows the last state
+            saved = stored.load(chat_id).active_cotas[0]
+            assert {p._id: (p.n, p.payed) for p in saved.going.values()} == expected
+            for message_id in boxes[chat_id]:
+                text, _ = cota_chat.iBoxes[message_id].current_state.render()
+                assert bot.texts[chat_id, message_id] == text
+    finally:
+        stored.close()
+
+def command(bot, chat_id, user_id, text):
+    return Update.de_json({'update_id': 1, 'message': {
+        'message_id': 1, 'date': 0, 'text': text, 'chat': {'id': chat_id, 'type': 'group'},
+        'from': {'id': user_id, 'first_name': 'User', 'is_bot': False},
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]}}, bot)
+
+def test_dispatcher_handles_chats_concurrently(bot):
+    # The dispatcher handles one update at a time, the runner must not
+    dispatcher = Dispatcher(bot, Queue(), workers=1)
+    runner = cotabot.ChatThreadRunner(4)
+    cotabot.add_handlers(dispatcher, runner.wrap)
+    busy = cotabot.cota_chats.get(1)
+    with busy.lock:
+        dispatcher.process_update(command(bot, 1, 7, '/cotas'))
+        dispatcher.process_update(command(bot, 2, 7, '/cotas'))
+        deadline = time.monotonic() + 5
+        while not any(chat_id == 2 for chat_id, _ in list(bot.texts)) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert [chat_id for chat_id, _ in bot.texts] == [2]
+    runner.stop()
+    settle()
+    assert sorted(chat_id for chat_id, _ in bot.texts) == [1, 2]
+
+def test_inline_queries_of_different_users_run_concurrently():
+    runner = cotabot.ChatTaskRunner(workers=4)
+    started, release = threading.Barrier(3, timeout=5), threading.Event()
+
+    def slow_search(bot, update):
+        started.wait()
+        release.wait(5)
+
+    submit = runner.wrap(slow_search)
+    try:
+        for user_id in (1, 2):
+            update = fake_update(None, user_id)
+            update.effective_chat = None
+            submit(None, update)
+        # Both wait at the barrier only when neither is queued behind the other
+        started.wait()
+    finally:
+        release.set()
+        runner.stop()
@@ -0,0 +1,47 @@
+import http.client
+import json
+import queue
+import threading
+
+import pytest
+
+import cotabot
+
+@pytest.fixture
+def webhook():
+    updates = queue.Queue()
+    server = cotabot.WebhookServer(('127.0.0.1', 0), None, updates, 'sekret', lambda: 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def post(body, path='/sekret', token='sekret'):
+        conn = http.client.HTTPConnection('127.0.0.1', server.server_address[1])
+        headers = {'X-Telegram-Bot-Api-Secret-Token': token} if token is not None else {}
+        conn.request('POST', path, body, headers)
+        status = conn.getresponse().status
+        conn.close()
+        return status
+
+    yield post, updates
+    server.shutdown()
+    server.server_close()
+
+UPDATE = json.dumps({'update_id': 1, 'message': {'message_id': 1, 'date': 0, 'text': 'oi',
+                                                 'chat': {'id': 1, 'type': 'group'}}}).encode('utf-8')
+
+def test_update_is_queued(webhook):
+    post, updates = webhook
+    assert post(UPDATE) == 200
+    assert updates.get_nowait().message.text == 'oi'
+
+def test_wrong_secret_is_refused(webhook):
+    post, updates = webhook
+    assert post(UPDATE, token='sekreT') == 403
+    assert post(UPDATE, token=None) == 403
+    assert post(UPDATE, path='/other') == 403
+    assert updates.empty()
+
+@pytest.mark.parametrize('body', [b'nope', b'[1]', b'5', b'{}', b'{"update_id": 1, "message": {"chat": 1}}'])
+def test_bodies_that_are_not_updates_are_bad_requests(webhook, body):
+    post, updates = webhook
+    assert post(body) == 400
+    assert updates.empty()